@@ -1,7 +1,6 @@
 import astropy.constants as const
 import astropy.units as u
 from collections import OrderedDict
-import copy
 from functools import wraps
 import h5py
 from mendeleev import element
@@ -437,9 +436,78 @@ class atomicData(OrderedDict):
     def __init__(self):
         super().__init__()
         self.folder = os.path.dirname(os.path.realpath(__file__))
-        self.lines = {}
+        self.tables, self.orders = {}, {}
         #self.readdatabase()
 
+    table_dtype = np.dtype([('l', float), ('f', float), ('g', float), ('ref', object),
+                            ('j_l', int), ('nu_l', int), ('j_u', int), ('nu_u', int), ('band', object)])
+
+    def table(self, e):
+        """
+        Columnar table of the lines of the species. It is read from the database once and shared between the calls.
+        parameters:
+            - e          :  name of the species
+        returns:
+            - t          :  read-only structured array with fields l, f, g, ref, j_l, nu_l, j_u, nu_u, band,
+                            in the order of the database. Missing quantum numbers are set to -1.
+        """
+        name = self.correct_name(e)
+        if name not in self.tables:
+            rows = []
+            if name in self.keys():
+                with h5py.File(self.folder + r'/data/atomic.hdf5', 'r') as data:
+                    for i, ref in enumerate(data[name]['ref'][:]):
+                        lin = data[name]['lines'][str(i)][0]
+                        rows.append((lin[0], lin[1], lin[2], lin[3])
+                                    + tuple(int(ref[attr]) if b'None' not in ref[attr] else -1 for attr in ['j_l', 'nu_l', 'j_u', 'nu_u'])
+                                    + (ref['band'].decode('UTF-8') if b'None' not in ref['band'] else '',))
+            t = np.array(rows, dtype=self.table_dtype)
+            t.flags.writeable = False
+            self.tables[name] = t
+            # wavelength index used by select():
+            order = np.argsort(t['l'], kind='stable')
+            self.orders[name] = (order, t['l'][order])
+        return self.tables[name]
+
+    def select(self, e, lmin=None, lmax=None):
+        """
+        Lines of the species within the wavelength range (the slice of the table, see table())
+        parameters:
+            - e          :  name of the species
+            - lmin       :  minimal rest-frame wavelength, if None no limit
+            - lmax       :  maximal rest-frame wavelength, if None no limit
+        returns:
+            - t          :  rows of the line table (in the order of the database)
+        """
+        t = self.table(e)
+        order, l = self.orders[self.correct_name(e)]
+        i_min = np.searchsorted(l, lmin, side='left') if lmin is not None else 0
+        i_max = np.searchsorted(l, lmax, side='right') if lmax is not None else len(t)
+        return t[np.sort(order[i_min:i_max])]
+
+    def make_lines(self, e, t=None):
+        """
+        Make the line objects from the rows of the line table.
+        The objects are created at each call, since they are modified by the fitting routines.
+        parameters:
+            - e          :  name of the species
+            - t          :  rows of the line table, if None take all the lines of the species
+        returns:
+            - lines      :  list of the line objects
+        """
+        name = self.correct_name(e)
+        if t is None:
+            t = self.table(name)
+        lines = []
+        for r in zip(*[t[k].tolist() for k in self.table_dtype.names]):
+            l = line(name, r[0], r[1], r[2], ref=r[3])
+            for attr, v in zip(['j_l', 'nu_l', 'j_u', 'nu_u'], r[4:8]):
+                if v != -1:
+                    setattr(l, attr, v)
+            l.band = r[8]
+            lines.append(l)
+        return lines
+
     def list(self, els=None, linelist=None):
         if els is not None and isinstance(els, str):
             els = [els]
@@ -449,34 +517,11 @@ class atomicData(OrderedDict):
             els = np.unique([l.split()[0] for l in linelist])
 
         lines = []
-
-        with h5py.File(self.folder + r'/data/atomic.hdf5', 'r') as data:
-            for e in els:
-                elist = []
-                if e not in self.lines.keys() or linelist is not None:
-                    if e not in self.lines.keys() and linelist is None:
-                        self.lines[e] = []
-                    t = Timer(e)
-                    name = self.correct_name(e)
-                    if name in self.keys():
-                        #print('ref', self.data[name]['ref'])
-                        for i, ref in enumerate(data[name]['ref']):
-                            #t.time('in')
-                            lin = data[name]['lines'][str(i)]
-                            l = line(name, lin[0][0], lin[0][1], lin[0][2], ref=lin[0][3])
-                            for attr in ['j_l', 'nu_l', 'j_u', 'nu_u']:
-                                if b'None' not in ref[attr]:
-                                    setattr(l, attr, int(ref[attr]))
-                            if b'None' not in ref['band']:
-                                setattr(l, 'band', ref['band'].decode('UTF-8'))
-                            if linelist is None or any([str(l) in lin or lin in str(l) for lin in linelist]):
-                                if linelist is None:
-                                    self.lines[e].append(l)
-                                elist.append(l)
-                            #t.time('out')
-                else:
-                    elist = self.lines[e]
-                lines += copy.deepcopy(elist)
+        for e in els:
+            elist = self.make_lines(e)
+            if linelist is not None:
+                elist = [l for l in elist if any([str(l) in lin or lin in str(l) for lin in linelist])]
+            lines += elist
         return lines
 
     def toascii(self, filename='', els=None, linelist=None):
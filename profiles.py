@@ -10,11 +10,12 @@ from astropy import units as u
 from dust_extinction.averages import G03_SMCBar
 from extinction import fitzpatrick99
 import matplotlib.pyplot as plt
-from numba import jit
+from numba import njit, prange
 import numpy as np
 from scipy.integrate import simps
 from scipy.interpolate import interp1d
 from scipy.special import wofz
+import time
 #from scipy.stats import lognormal
 
 from .stats import powerlaw
@@ -61,7 +62,8 @@ def voigt(a, x, calc='spec'):
     parameters:
         - a       : a parameter
         - x       : x parameter
-        - calc    : type of calculation
+        - calc    : type of calculation: 'spec' - direct calculation using Faddeeva function (wofz),
+                                     'table' - using precomputed table (see VoigtTable)
     
     return:
         voigt     : voigt function at x positions
@@ -70,7 +72,127 @@ def voigt(a, x, calc='spec'):
         v = Voigt(0)
         v.set(a, x, 0)
         return v.H
-        
+    elif calc == 'table':
+        return voigt_table(a, x)
+
+#==============================================================================
+# Table driven Voigt function
+#==============================================================================
+
+class VoigtTable():
+    """
+    Tabulated Faddeeva function w(u) at the real axis with its Taylor coefficients.
+    The Voigt function H(a, u) = Re w(u + i a) is calculated by Taylor expansion around the nearest node u_j:
+        w(u_j + d) = sum_n c_n(u_j) d^n,    d = (u - u_j) + i a,
+    where coefficients c_n = w^(n) / n! follow the recurrence c_(n+1) = -2 (z c_n + c_(n-1)) / (n + 1).
+    For |u| > umax the asymptotic expansion is used, and for a > amax the Faddeeva function is called directly (wofz).
+
+    Accuracy: with default parameters (step=0.02, order=8, umax=15, amax=0.1) the maximal absolute deviation
+    from scipy.special.wofz is below 1e-10 (in units of H(0, 0) = 1), see voigt_table_accuracy().
+    """
+    def __init__(self, step=0.02, order=8, umax=15.0, amax=0.1):
+        self.step, self.order, self.umax, self.amax = step, order, umax, amax
+        u = np.arange(int(umax / step) + 2) * step
+        self.c = np.zeros((u.shape[0], order + 1), dtype=complex)
+        self.c[:, 0] = wofz(u)
+        self.c[:, 1] = -2 * u * self.c[:, 0] + 2j / np.sqrt(np.pi)
+        for n in range(1, order):
+            self.c[:, n + 1] = -2 * (u * self.c[:, n] + self.c[:, n - 1]) / (n + 1)
+
+    def __call__(self, a, x):
+        a, x = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(x, dtype=float))
+        shape = x.shape
+        a, x = a.flatten(), x.flatten()
+        h = _voigt_table(a, x, self.c, self.step, self.umax)
+        mask = a > self.amax
+        if np.any(mask):
+            h[mask] = wofz(x[mask] + 1j * a[mask]).real
+        return h.reshape(shape)
+
+@njit(cache=True)
+def _voigt_table(a, x, c, step, umax):
+    h = np.empty(x.shape[0])
+    order = c.shape[1] - 1
+    for i in range(x.shape[0]):
+        u = abs(x[i])
+        if u < umax:
+            j = int(u / step + 0.5)
+            d = complex(u - j * step, a[i])
+            r = c[j, order]
+            for n in range(order - 1, -1, -1):
+                r = r * d + c[j, n]
+            h[i] = r.real
+        else:
+            z = complex(u, a[i])
+            z2 = 1 / (z * z)
+            h[i] = (1j / np.sqrt(np.pi) / z * (1 + z2 * (0.5 + z2 * (0.75 + z2 * (1.875 + z2 * 6.5625))))).real
+    return h
+
+_voigt_tables = {}
+
+def voigt_table(a, x, **kwargs):
+    """
+    Returns voigt function calculated using precomputed table (see VoigtTable), the table is created once at the first call
+
+    parameters:
+        - a       : a parameter
+        - x       : x parameter
+        - kwargs  : parameters of the table (step, order, umax, amax)
+
+    return:
+        voigt     : voigt function at x positions
+    """
+    key = tuple(sorted(kwargs.items()))
+    if key not in _voigt_tables:
+        _voigt_tables[key] = VoigtTable(**kwargs)
+    return _voigt_tables[key](a, x)
+
+def voigt_table_accuracy(a=None, x=None, verbose=True, **kwargs):
+    """
+    Returns the maximal absolute deviation of table driven Voigt function from the direct calculation (wofz)
+
+    parameters:
+        - a       : array of a parameters to check, if None: logarithmic grid from 1e-7 to 1 with 0
+        - x       : array of x parameters to check, if None: uniform grid from -30 to 30
+        - kwargs  : parameters of the table (step, order, umax, amax)
+
+    return:
+        - delta   : float array, shape(len(a))
+                        maximal absolute deviation for each a
+    """
+    a = np.append(0, np.logspace(-7, 0, 29)) if a is None else np.atleast_1d(a)
+    x = np.linspace(-30, 30, 600001) if x is None else np.asarray(x)
+    delta = np.array([np.max(np.abs(voigt_table(ai, x, **kwargs) - voigt(ai, x))) for ai in a])
+    if verbose:
+        for ai, d in zip(a, delta):
+            print('a = {0:.1e}: max deviation {1:.1e}'.format(ai, d))
+    return delta
+
+def voigt_benchmark(n=1000000, num=5, seed=1, verbose=True):
+    """
+    Benchmark of table driven and direct (wofz) calculations of Voigt function for typical parameters of absorption lines
+
+    parameters:
+        - n         : number of points
+        - num       : number of repeats
+        - seed      : seed for random generator
+
+    return:
+        - t_spec, t_table  : time of direct and table driven calculations (in seconds per call)
+    """
+    rng = np.random.default_rng(seed)
+    a, x = 10 ** rng.uniform(-6, -2, n), rng.normal(0, 5, n)
+    voigt_table(a[:10], x[:10])
+    times = []
+    for calc in ['spec', 'table']:
+        t = time.time()
+        for i in range(num):
+            voigt(a, x, calc=calc)
+        times.append((time.time() - t) / num)
+    if verbose:
+        print('wofz: {0:.4f} s, table: {1:.4f} s, speedup: {2:.1f}'.format(times[0], times[1], times[0] / times[1]))
+    return times
+
 #==============================================================================
 # 
 #==============================================================================
@@ -87,9 +209,10 @@ class tau:
 
     Notes:
         default settings - lyman alpha line of LLS system
+        calc specifies the calculation of Voigt function: 'spec' - direct (wofz), 'table' - table driven (see VoigtTable)
 
     """
-    def __init__(self, line=None, logN=19, b=5.0, l=1215.6701, f=0.4164, g=6.265e8, z=0.0, resolution=50000):
+    def __init__(self, line=None, logN=19, b=5.0, l=1215.6701, f=0.4164, g=6.265e8, z=0.0, resolution=50000, calc='spec'):
         items = ['logN', 'b', 'l', 'f', 'g', 'z']
         if line is None:
             d = locals()
@@ -102,6 +225,7 @@ class tau:
                 else:
                     setattr(self, k, getattr(line, k))
         self.resolution = resolution
+        self.calc = calc
         self.update()
 
     def calctau0(self, A=None, gu=None, gl=None):
@@ -179,7 +303,7 @@ class tau:
         mask = np.logical_and(u > -xlim, u < xlim)
 
         tau = np.zeros_like(x)
-        tau[mask] = self.tau0 * voigt(self.a, u[mask])  # dimensionless
+        tau[mask] = self.tau0 * voigt(self.a, u[mask], calc=self.calc)  # dimensionless
 
         self.x = x
         self.tau = tau
@@ -300,6 +424,125 @@ class tau:
         n[ind_s:ind_e-1] = num
         return n
 
+#==============================================================================
+# Batched optical depth calculation for the set of lines
+#==============================================================================
+
+def lines_a_tau0(l, f, g, logN, b):
+    """
+    Returns a parameters and optical depths at the line centers for the arrays of lines
+
+    parameters:
+        - l, f, g   : float arrays, shape(M)
+                        rest wavelengths, oscillator strengths and natural linewidths of the lines
+        - logN, b   : float arrays, shape(M)
+                        log10 column densities and doppler parameters in km/s
+
+    return:
+        - a         : a parameters, shape(M)
+        - tau0      : optical depths at the line centers, shape(M)
+    """
+    e2_me_c = const.e.gauss.value ** 2 / const.m_e.cgs.value / const.c.cgs.value
+    a = g / 4 / np.pi / b / 1e5 * l * 1e-8
+    tau0 = np.sqrt(np.pi) * e2_me_c * (l * 1e-8) * f * np.power(10.0, logN) / (b * 1e5)
+    return a, tau0
+
+def lines_range(l, f, g, logN, b, z, resolution=None, tlim=0.001, instr=3):
+    """
+    Returns the ranges of the absorption lines in wavelengths (vectorized version of tau.getrange)
+
+    parameters:
+        - l, f, g, logN, b, z  : float arrays, shape(M)
+                                    parameters of the lines
+        - resolution           : resolution of the instrument function
+        - tlim                 : optical depth level
+        - instr                : number of instrument function offset
+
+    return:
+        - xmin, xmax           : float arrays, shape(M)
+                                    left and right borders of the lines in wavelengths
+    """
+    a, tau0 = lines_a_tau0(l, f, g, logN, b)
+    x_0 = interp1d([-2, -3, -4], [2.67, 3.12, 3.51], bounds_error=False, fill_value='extrapolate')(np.log10(a))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dx = np.fmax(np.sqrt(-np.log(tlim / tau0)), np.sqrt(tau0 / tlim * a / np.sqrt(np.pi)))
+    dx = np.where(tau0 < tlim, 0, dx)
+    dx = np.where((dx > x_0 / 1.2) * (dx < x_0 * 1.2), dx * 1.2, dx)
+    x_instr = 1.0 / resolution / 2.355 if resolution not in [None, 0] else 0
+    dx = dx * b / const.c.to('km/s').value + instr * x_instr
+    return l * (1 - dx) * (1 + z), l * (1 + dx) * (1 + z)
+
+def tau_lines_sparse(x, l, f, g, logN, b, z, resolution=None, tlim=0.01, calc='spec'):
+    """
+    Returns the optical depths of the set of lines in the sparse form, i.e. only within the windows of each line (given by tlim).
+    The Voigt function for all the lines is evaluated by the single call of Faddeeva function.
+
+    parameters:
+        - x                    : float array, shape(N)
+                                    sorted wavelength grid
+        - l, f, g, logN, b, z  : float arrays, shape(M)
+                                    parameters of the lines
+        - resolution           : resolution of the instrument function (used to extend the windows, as in tau.calctau)
+        - tlim                 : optical depth level, that specify the windows of the lines
+        - calc                 : calculation of Voigt function: 'spec' - direct (wofz), 'table' - table driven (see VoigtTable)
+
+    return:
+        - k                    : int array, shape(K)
+                                    index of the line
+        - ind                  : int array, shape(K)
+                                    index of the pixel in x
+        - tau                  : float array, shape(K)
+                                    optical depth of the line k at pixel ind
+    """
+    l, f, g, logN, b, z = [np.atleast_1d(np.asarray(p, dtype=float)) for p in (l, f, g, logN, b, z)]
+
+    a, tau0 = lines_a_tau0(l, f, g, logN, b)
+    xmin, xmax = lines_range(l, f, g, logN, b, z, resolution=resolution, tlim=tlim)
+
+    # >>> indices of the pixels within the windows of the lines:
+    i_s, i_e = np.searchsorted(x, xmin, side='right'), np.searchsorted(x, xmax, side='left')
+    num = np.maximum(i_e - i_s, 0)
+    k = np.repeat(np.arange(l.shape[0]), num)
+    ind = np.arange(np.sum(num)) - np.repeat(np.cumsum(num) - num, num) + np.repeat(i_s, num)
+
+    # >>> single call of Voigt function for all lines:
+    u = (x[ind] / (1 + z[k]) / l[k] - 1) * const.c.to('km/s').value / b[k]
+
+    return k, ind, tau0[k] * voigt(a[k], u, calc=calc)
+
+def calctau_lines(x, l, f, g, logN, b, z, resolution=None, tlim=0.01, groups=None, ngroups=None, calc='spec'):
+    """
+    Returns the summed optical depth of the set of lines at the common wavelength grid.
+    The profiles are calculated only within the windows of each line (given by tlim) and
+    the Voigt function for all the lines is evaluated by the single call of Faddeeva function.
+
+    parameters:
+        - x                    : float array, shape(N)
+                                    sorted wavelength grid
+        - l, f, g, logN, b, z  : float arrays, shape(M)
+                                    parameters of the lines
+        - resolution           : resolution of the instrument function (used to extend the windows, as in tau.calctau)
+        - tlim                 : optical depth level, that specify the windows of the lines
+        - groups               : int array, shape(M)
+                                    if given, the optical depths are summed separately for each group,
+                                    e.g. lines with the same partial covering factor
+        - ngroups              : number of groups, if None than max(groups) + 1
+        - calc                 : calculation of Voigt function: 'spec' - direct (wofz), 'table' - table driven (see VoigtTable)
+
+    return:
+        - tau                  : float array, shape(N) or shape(ngroups, N) if groups is given
+                                    optical depth
+    """
+    k, ind, t = tau_lines_sparse(x, l, f, g, logN, b, z, resolution=resolution, tlim=tlim, calc=calc)
+    n = x.shape[0]
+
+    if groups is None:
+        return np.bincount(ind, weights=t, minlength=n)
+    else:
+        groups = np.atleast_1d(np.asarray(groups, dtype=int))
+        ngroups = np.max(groups) + 1 if ngroups is None else ngroups
+        return np.bincount(groups[k] * n + ind, weights=t, minlength=ngroups * n).reshape(ngroups, n)
+
 def convolveflux(l, f, res, vel=False, kind='astropy', verbose=False, debug=False):
     """
     Convolve flux with instrument function. 
@@ -375,30 +618,108 @@ def convolveflux(l, f, res, vel=False, kind='astropy', verbose=False, debug=Fals
     return fc
 
 
-# jit decorator tells Numba to compile this function.
+# njit decorator tells Numba to compile this function in nopython mode.
 # The argument types will be inferred by Numba when function is called.
-@jit(forceobj=True, looplift=True)
+@njit(cache=True)
 def gauss(x, s):
     return 1 / np.sqrt(2 * np.pi) / s * np.exp(-.5 * (x / s) ** 2)
 
-@jit(forceobj=True, looplift=True)
+@njit(cache=True)
 def errf(x):
-    a = [0.3480242, -0.0958798, 0.7478556]
     t = 1 / (1 + 0.47047 * np.abs(x))
-    return np.sign(x) * (1 - t * (a[0] + t * (a[1] + t * a[2])) * np.exp(-x**2))
+    return np.sign(x) * (1 - t * (0.3480242 + t * (-0.0958798 + t * 0.7478556)) * np.exp(-x**2))
 
-@jit(forceobj=True, looplift=True)
+@njit(cache=True)
 def errf_v2(x):
-    a = [-1.26551223, 1.00002368, 0.37409196, 0.09678418, -0.18628806, 0.27886807, -1.13520398, 1.48851587, -0.82215223, 0.17087277]
     t = 1 / (1 + 0.5 * np.abs(x))
-    tau = t * np.exp(-x ** 2 + a[0] + t * (a[1] + t * (a[2] + t * (a[3] + t * (a[4] + t * (a[5] + t * (a[6] + t * (a[7] + t * (a[8] + t * a[9])))))))))
+    tau = t * np.exp(-x ** 2 - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
     if x >= 0:
         return 1 - tau
     else:
         return tau - 1
 
-@jit(forceobj=True, looplift=True)
-def convolve_res(l, f, R):
+@njit(cache=True)
+def _convolve_res_pixel(l, f, R, d, i, delta):
+    """
+    convolved flux of convolve_res in the pixel i, R is the array of resolutions at each pixel
+    """
+    n = l.shape[0]
+    x = l[i]
+    sig = x / R[i] / 2.355
+    k = np.searchsorted(l, x - delta * sig)
+    s = f[k] * (1 - errf(np.abs(l[k] - x - d[0] / 2) / np.sqrt(2) / sig)) / 2
+    while k < n and l[k] < x + delta * sig:
+        s += f[k] * gauss(l[k] - x, sig) * d[k]
+        k += 1
+    k -= 1
+    s += f[k] * (1 - errf(np.abs(l[k] - x + d[k] / 2) / np.sqrt(2) / sig)) / 2
+    return s
+
+@njit(cache=True)
+def _convolve_res_steps(l):
+    n = l.shape[0]
+    d = np.empty_like(l)
+    d[0] = l[1] - l[0]
+    d[1:n-1] = (l[2:] - l[:n-2]) / 2
+    d[n-1] = l[n-1] - l[n-2]
+    return d
+
+# serial and parallel kernels are separate functions (not two dispatchers of the same one),
+# since numba indexes the disk cache by the function, and they would share the compiled code
+@njit(cache=True)
+def _convolve_res_serial(l, f, R, delta=3.0):
+    fc = np.zeros_like(f)
+    d = _convolve_res_steps(l)
+    for i in range(l.shape[0]):
+        fc[i] = _convolve_res_pixel(l, f, R, d, i, delta)
+    return fc
+
+@njit(cache=True, parallel=True)
+def _convolve_res_parallel(l, f, R, delta=3.0):
+    fc = np.zeros_like(f)
+    d = _convolve_res_steps(l)
+    for i in prange(l.shape[0]):
+        fc[i] = _convolve_res_pixel(l, f, R, d, i, delta)
+    return fc
+
+@njit(cache=True)
+def _convolve_res2_pixel(l, f, R, i, delta):
+    """
+    convolved (1 - flux) of convolve_res2 in the pixel i, R is the array of resolutions at each pixel
+    """
+    n = l.shape[0]
+    x = l[i]
+    sig = x / R[i] / 2.355
+    k = np.searchsorted(l, x - delta * sig)
+    s = f[k] * (1 - errf_v2((x - l[k]) / np.sqrt(2) / sig)) / 2
+    while k < n - 1 and l[k + 1] < x + delta * sig:
+        s += (f[k + 1] * gauss(l[k + 1] - x, sig) + f[k] * gauss(l[k] - x, sig)) / 2 * (l[k + 1] - l[k])
+        k += 1
+    s += f[k] * (1 - errf_v2(np.abs(l[k] - x) / np.sqrt(2) / sig)) / 2
+    return s
+
+@njit(cache=True)
+def _convolve_res2_serial(l, f, R, delta=3.0):
+    fc = np.zeros_like(f)
+    f = 1 - f
+    for i in range(l.shape[0]):
+        fc[i] = _convolve_res2_pixel(l, f, R, i, delta)
+    return 1 - fc
+
+@njit(cache=True, parallel=True)
+def _convolve_res2_parallel(l, f, R, delta=3.0):
+    fc = np.zeros_like(f)
+    f = 1 - f
+    for i in prange(l.shape[0]):
+        fc[i] = _convolve_res2_pixel(l, f, R, i, delta)
+    return 1 - fc
+
+def _convolve_args(l, f, R):
+    l, f = np.ascontiguousarray(l, dtype=np.float64), np.ascontiguousarray(f, dtype=np.float64)
+    R = np.ascontiguousarray(np.broadcast_to(np.asarray(R, dtype=np.float64), l.shape))
+    return l, f, R
+
+def convolve_res(l, f, R, parallel=False):
     """
     Convolve flux with instrument function specified by resolution R
     Data can be unevenly spaced. 
@@ -408,46 +729,23 @@ def convolve_res(l, f, R):
                         wavelength array (or velocity in km/s)
         - f         : float array, shape(N)
                         flux
-        - R         : float
-                        resolution of the instrument function. Assumed to be constant with wavelength. 
-                        i.e. the width of the instrument function is linearly dependent on wavelenth.  
+        - R         : float or float array, shape(N)
+                        resolution of the instrument function. If float, assumed to be constant with wavelength,
+                        i.e. the width of the instrument function is linearly dependent on wavelenth.
+                        If array, specify the resolution (i.e. width of LSF) at each pixel.
+        - parallel  : boolean
+                        if True the pixels are processed in parallel chunks
 
     returns:
         - fc        : float array, shape(N)
                         convolved flux
     """
-    #sig = 127301 / R
-    delta = 3.0
-
-    n = len(l)
-    fc = np.zeros_like(f)
-
-    d = [l[1] - l[0]]
-    for i in range(1, n-1):
-        d.append((l[i + 1] - l[i - 1]) / 2)
-    d.append(l[-1]-l[-2])
-
-    il = 0
-    for i, x in enumerate(l):
-        sig = x / R / 2.355
-        k = il
-        while l[k] < x - delta * sig:
-            k += 1
-        il = k
-        s = f[k] * (1 - errf(np.abs(l[k] - x - d[0]/2) / np.sqrt(2) / sig)) / 2
-        while k < n and l[k] < x + delta * sig:
-            #s += f[k] * 1 / np.sqrt(2 * np.pi) / sig * np.exp(-.5 * ((l[k] - x) / sig) ** 2) * d[k]
-            s += f[k] * gauss(l[k] - x, sig) * d[k]
-            k += 1
-
-        k -= 1
-        s += f[k] * (1 - errf(np.abs(l[k] - x + d[k]/2) / np.sqrt(2) / sig)) / 2
-        fc[i] = s
-
-    return fc
+    if parallel:
+        return _convolve_res_parallel(*_convolve_args(l, f, R))
+    else:
+        return _convolve_res_serial(*_convolve_args(l, f, R))
 
-@jit(forceobj=True, looplift=True)
-def convolve_res2(l, f, R):
+def convolve_res2(l, f, R, parallel=False):
     """
     Convolve flux with instrument function specified by resolution R
     Data can be unevenly spaced. 
@@ -457,51 +755,82 @@ def convolve_res2(l, f, R):
                         wavelength array (or velocity in km/s)
         - f         : float array, shape(N)
                         flux
-        - R         : float
-                        resolution of the instrument function. Assumed to be constant with wavelength. 
-                        i.e. the width of the instrument function is linearly dependent on wavelenth.  
+        - R         : float or float array, shape(N)
+                        resolution of the instrument function. If float, assumed to be constant with wavelength,
+                        i.e. the width of the instrument function is linearly dependent on wavelenth.
+                        If array, specify the resolution (i.e. width of LSF) at each pixel.
+        - parallel  : boolean
+                        if True the pixels are processed in parallel chunks
 
     returns:
         - fc        : float array, shape(N)
                         convolved flux
     """
-    #sig = 127301 / R
-    delta = 3.0
+    if parallel:
+        return _convolve_res2_parallel(*_convolve_args(l, f, R))
+    else:
+        return _convolve_res2_serial(*_convolve_args(l, f, R))
 
-    n = len(l)
-    fc = np.zeros_like(f)
+def convolve_res2_update(l, f, R, fc, ranges, parallel=False):
+    """
+    Update the flux convolved by convolve_res2 only in the pixels affected by the change of intrinsic flux
+    within the given ranges of pixels. The other pixels of fc are kept, the result is the same as full convolution.
 
-    f = 1 - f
+    parameters:
+        - l, f, R   : as in convolve_res2
+        - fc        : float array, shape(N)
+                        previously convolved flux, it is modified inplace
+        - ranges    : list of (start, end)
+                        pixel index ranges, where intrinsic flux f was changed
+        - parallel  : boolean
+                        if True the pixels are processed in parallel chunks
 
-    il = 0
-    for i, x in enumerate(l):
-        sig = x / R / 2.355
-        k = il
-        while l[k] < x - delta * sig:
-            k += 1
-        il = k
-        s = f[il] * (1 - errf_v2((x - l[il]) / np.sqrt(2) / sig)) / 2
-        #ie = il + 30
-        while k < n-1 and l[k+1] < x + delta * sig:
-            #s += f[k] * 1 / np.sqrt(2 * np.pi) / sig * np.exp(-.5 * ((l[k] - x) / sig) ** 2) * d[k]
-            s += (f[k+1] * gauss(l[k+1] - x, sig) + f[k] * gauss(l[k] - x, sig)) / 2 * (l[k+1] - l[k])
-            #print(i, k , gauss(l[k] - x, sig))
-            k += 1
-        #input()
-        s += f[k] * (1 - errf_v2(np.abs(l[k] - x) / np.sqrt(2) / sig)) / 2
-        fc[i] = s
+    returns:
+        - fc        : float array, shape(N)
+                        convolved flux
+    """
+    if len(ranges) > 0:
+        # >>> margin of the instrument function (slightly wider than used in kernel):
+        d = 3.3 / np.min(R) / 2.355
+        n = l.shape[0]
+        ranges = np.asarray(ranges, dtype=int).reshape(-1, 2)
+        o_s = np.maximum(np.searchsorted(l, l[ranges[:, 0]] * (1 - d)) - 1, 0)
+        o_e = np.minimum(np.searchsorted(l, l[np.maximum(ranges[:, 1] - 1, 0)] * (1 + d)) + 1, n)
+        order = np.argsort(o_s)
+        merged = [[o_s[order[0]], o_e[order[0]]]]
+        for s, e in zip(o_s[order[1:]], o_e[order[1:]]):
+            if s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s, e])
+        R = np.broadcast_to(np.asarray(R, dtype=np.float64), l.shape)
+        for s, e in merged:
+            i_s, i_e = max(np.searchsorted(l, l[s] * (1 - d)) - 1, 0), min(np.searchsorted(l, l[e - 1] * (1 + d)) + 1, n)
+            fc[s:e] = convolve_res2(l[i_s:i_e], f[i_s:i_e], R[i_s:i_e], parallel=parallel)[s - i_s:e - i_s]
 
-    return 1 - fc
+    return fc
 
-#@jit
 def makegrid(x, n):
-    ind = np.argwhere(n)
-    l = x[ind]
-    for k, i in zip(range(len(ind)-2, -1, -1), reversed(ind[:-1])):
-        d = (x[i+1] - x[i]) / (int(n[i]) + 1)
-        l = np.insert(l, np.ones(int(n[i][0]), dtype=int) * (k+1), x[i] + d * (np.arange(int(n[i])) + 1))
+    """
+    Make the grid from the pixels x, where n is non zero, with n additional points inserted between pixel and the next one
 
-    return l
+    parameters:
+        - x         : float array, shape(N)
+                        pixels
+        - n         : array, shape(N)
+                        number of points to insert after each pixel (pixels with n == 0 are skipped)
+
+    returns:
+        - grid      : float array
+    """
+    ind = np.flatnonzero(n)
+    if ind.shape[0] < 2:
+        return x[ind]
+    num = np.append(np.asarray(n)[ind[:-1]].astype(int), 0)
+    base = np.repeat(ind, num + 1)
+    j = np.arange(base.shape[0]) - np.repeat(np.cumsum(num + 1) - num - 1, num + 1)
+    d = (x[np.minimum(base + 1, x.shape[0] - 1)] - x[base]) / (np.repeat(num, num + 1) + 1)
+    return x[base] + d * j
 
 def add_LyaForest(x, z_em=0, factor=1, kind='trans'):
     """
@@ -496,19 +496,86 @@ class coll_list():
     def __init__(self):
         self.c = []
         self.f = None
+        self.T = None
+        self.cache = collections.OrderedDict()
+        self.cache_size = 128
 
     def append(self, object):
         self.c.append(object)
 
     def make_table(self, num):
-        self.f = np.empty([num, num])
-        for i in range(num):
-            self.f[i, i] = 0
+        self.f = np.zeros([num, num])
         for k, s in enumerate(self.c):
             self.f[s.i, s.j] = k + 1
             self.f[s.j, s.i] = -(k + 1)
         #print(self.f)
 
+    def tabulate(self, num, T=None):
+        """
+        precompute the cube of collisional rates for the first <num> levels on the fine grid of log temperatures.
+        The spline part of the rates is interpolated from the cube by cubic Hermite polynomials,
+        while the detailed balance (and electron) factors are calculated analytically.
+        parameters:
+            - num      : number of levels
+            - T        : grid of log temperatures, if None use logT from 0 to 5.5 with 0.01 step.
+                         The knots of the splines are added to the grid, so the interpolation is exact for quadratic splines.
+        """
+        if len(self.c) > 0:
+            self.make_table(max(num, max([max(s.i, s.j) for s in self.c]) + 1))
+        if T is None:
+            T = np.linspace(0, 5.5, 551)
+            knots = [s.rate_int.get_knots() for s in self.c if s.rates is not None and s.i < num and s.j < num]
+            if len(knots) > 0:
+                knots = np.concatenate(knots)
+                T = np.unique(np.round(np.append(T, knots[(knots > T[0]) & (knots < T[-1])]), 10))
+        self.T = np.asarray(T)
+        self.logr = np.zeros([len(self.T), num, num])
+        self.dlogr = np.zeros([len(self.T), num, num])
+        self.fac = np.zeros([3, num, num])
+        self.mask = np.zeros([num, num], dtype=bool)
+        for u in range(num):
+            for l in range(num):
+                s, sign = self.find(u, l)
+                if u != l and sign != 0 and s.rates is not None:
+                    self.logr[:, u, l] = s.rate_int(self.T)
+                    self.dlogr[:, u, l] = s.rate_int(self.T, 1)
+                    self.fac[:, u, l] = s.factors(sign=sign)
+                    self.mask[u, l] = True
+        self.cache.clear()
+
+    def interpolate(self, T):
+        """
+        collisional rates from the precomputed cube, see tabulate()
+        parameters:
+            - T        : array of log temperatures within the grid
+        returns:
+            - r        : array of rates with shape (len(T), num, num)
+        """
+        T = np.atleast_1d(T)
+        ind = np.clip(np.searchsorted(self.T, T) - 1, 0, len(self.T) - 2)
+        h = (self.T[ind + 1] - self.T[ind])[:, np.newaxis, np.newaxis]
+        t = (T[:, np.newaxis, np.newaxis] - self.T[ind][:, np.newaxis, np.newaxis]) / h
+        logr = (2 * t ** 3 - 3 * t ** 2 + 1) * self.logr[ind] + (t ** 3 - 2 * t ** 2 + t) * h * self.dlogr[ind] \
+               + (3 * t ** 2 - 2 * t ** 3) * self.logr[ind + 1] + (t ** 3 - t ** 2) * h * self.dlogr[ind + 1]
+        logr += self.fac[0] + self.fac[1] * 10.0 ** (-T[:, np.newaxis, np.newaxis]) + self.fac[2] * T[:, np.newaxis, np.newaxis]
+        return np.where(self.mask, 10 ** logr, 0)
+
+    def matrix(self, T):
+        """
+        collisional rates matrix at single log temperature <T>, recently used temperatures are cached
+        """
+        T = float(T)
+        if T in self.cache:
+            self.cache.move_to_end(T)
+        else:
+            self.cache[T] = self.interpolate(T)[0]
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.cache[T]
+
+    def in_table(self, i, j, T):
+        return self.T is not None and i < self.mask.shape[0] and j < self.mask.shape[1] and np.all((self.T[0] <= T) & (T <= self.T[-1]))
+
     def find(self, i, j):
         if self.f is None:
             for s in self.c:
@@ -517,12 +584,17 @@ class coll_list():
                 elif s.i == j and s.j == i:
                     return s, -1
         else:
-            if self.f[i, j] != 0:
+            if i < self.f.shape[0] and j < self.f.shape[1] and self.f[i, j] != 0:
                 return self.c[int(np.abs(self.f[i, j])-1)], np.sign(self.f[i, j])
 
         return None, 0
 
     def rate(self, i, j, T):
+        if self.in_table(i, j, T):
+            if np.ndim(T) == 0:
+                return self.matrix(T)[i, j]
+            else:
+                return self.interpolate(np.asarray(T).flatten())[:, i, j].reshape(np.shape(T))
         s, l = self.find(i, j)
         if l != 0:
             r = s.rate(T, sign=l)
@@ -530,6 +602,29 @@ class coll_list():
         else:
             return 0
 
+    def rate_matrix(self, num, T):
+        """
+        collisional rates for all pairs of the first <num> levels at once
+        parameters:
+            - num      : number of levels
+            - T        : array of log temperatures
+        returns:
+            - r        : array of rates with shape (len(T), num, num), r[:, u, l] is the rate for l -> u
+        """
+        T = np.atleast_1d(T)
+        if self.in_table(num - 1, num - 1, T):
+            if not np.any(self.mask):
+                return np.zeros([T.shape[0], num, num])
+            if T.shape[0] == 1:
+                return self.matrix(T[0])[np.newaxis, :num, :num]
+            return self.interpolate(T)[:, :num, :num]
+        r = np.zeros([T.shape[0], num, num])
+        for u in range(num):
+            for l in range(num):
+                if u != l:
+                    r[:, u, l] = self.rate(u, l, T)
+        return r
+
     def plot(self, i, j, ax=None, label=None):
         s, l = self.find(i, j)
         if l != 0:
@@ -570,22 +665,25 @@ class collision():
         if self.rates is None:
             return 0
 
-        #l, u = max(self.i, self.j), min(self.i, self.j)
-        #if self.i > self.j:
-        #    u, l = l, u
+        a, b, c = self.factors(sign=sign)
+        return 10 ** (self.rate_int(T) + a + b * 10.0 ** (-T) + c * T)
 
+    def factors(self, sign=1):
+        """
+        coefficients of the electron and detailed balance factors of the rate:
+        log10(rate) = rate_int(T) + a + b * 10**(-T) + c * T
+        """
+        a, b, c = 0, 0, 0
         if self.part == 'e':
-            c1 = self.parent.const2 * 10 ** (- T * 0.5) / self.parent.g[self.i] * np.exp(-(self.parent.E[self.j] - self.parent.E[self.i]) / 0.695 / 10**T)
-        else:
-            c1 = 1
+            a += np.log10(self.parent.const2 / self.parent.g[self.i])
+            b += -(self.parent.E[self.j] - self.parent.E[self.i]) / 0.695 / np.log(10)
+            c += -0.5
 
-        if sign == 1:
-            Bf = 1
-        else:
-            Bf = self.parent.g[self.i] / self.parent.g[self.j] * np.exp(-(self.parent.E[self.i] - self.parent.E[self.j]) / 0.695 / 10 ** T)
-            #Bf = self.parent.g[u] / self.parent.g[l] * np.exp(-(self.parent.E[u] - self.parent.E[l]) / 0.695 / 10**T)
+        if sign != 1:
+            a += np.log10(self.parent.g[self.i] / self.parent.g[self.j])
+            b += -(self.parent.E[self.i] - self.parent.E[self.j]) / 0.695 / np.log(10)
 
-        return 10 ** self.rate_int(T) * c1 * Bf
+        return a, b, c
 
     def plot(self, ax=None, label=None, sign=1):
         if self.rates is not None:
@@ -701,6 +799,105 @@ class par():
     def __str__(self):
         return '{:s}: {:.2f}'.format(self.name, self.value)
         
+# transformations of the axes of the emulator grid (and their inverses), in which the log populations are close to linear,
+# e.g. the Boltzmann factors are linear in 1/T
+emulator_axes = {'T': (lambda x: 10 ** (-x), lambda u: -np.log10(u)),
+                 'CMB': (lambda x: 1 / np.maximum(x, 1), lambda u: 1 / u),
+                 }
+
+class emulator():
+    """
+    Precomputed populations of the levels of the species on the regular grid of the physical parameters.
+    The log populations are interpolated multilinearly (in 1/T for the temperatures, see emulator_axes),
+    the points outside the grid are calculated exactly by balance_grid.
+    The accuracy is checked after tabulation at the centers of random cells (where the error of multilinear interpolation is the largest),
+    and if it is worse than tol (with the safety margin), all points are calculated exactly.
+    The object does not change the state of the pyratio instance, so it can be shared between the absorption systems
+    and sent to the worker processes.
+    parameters:
+        - parent      :  pyratio object
+        - name        :  name of the species
+        - ranges      :  dict of the ranges of the tabulated parameters, e.g. {'T': [1, 3], 'n': [0, 4]}
+        - fixed       :  dict of the values of other parameters (if not specified, the current values are used)
+        - size        :  maximal total number of the grid points
+        - chunk       :  number of the grid points solved at once during tabulation
+        - tol         :  tolerance of the log populations (of the levels with fraction > 1e-6)
+        - check       :  number of random cells to check accuracy
+        - margin      :  factor of the checked error, that has to be below tol, since the worst cells can be missed by the check
+    """
+    def __init__(self, parent, name, ranges, fixed=None, size=100000, chunk=20000, tol=0.01, check=1000, margin=2):
+        self.parent = parent
+        self.name = name
+        self.fixed = fixed if fixed is not None else {}
+        num = int(min(200, max(8, size ** (1 / max(len(ranges), 1)))))
+        self.pars = list(ranges.keys())
+        self.axes, nodes = [], []
+        for p in self.pars:
+            tr, inv = emulator_axes.get(p, (lambda x: x, lambda u: u))
+            u = np.sort(tr(np.asarray(ranges[p], dtype=float)))
+            self.axes.append(np.linspace(u[0], u[-1], num))
+            nodes.append(inv(self.axes[-1]))
+        self.shape = tuple(len(u) for u in self.axes)
+        mesh = [m.flatten() for m in np.meshgrid(*nodes, indexing='ij')]
+        self.table = np.empty((len(mesh[0]), self.parent.species[name].num))
+        for i in range(0, self.table.shape[0], chunk):
+            values = {p: m[i:i + chunk] for p, m in zip(self.pars, mesh)}
+            self.table[i:i + chunk] = np.log10(self.parent.balance_grid(name, self.full(values)))
+        self.corners = np.array(list(itertools.product([0, 1], repeat=len(self.pars))), dtype=int)
+        self.strides = np.array([int(np.prod(self.shape[k + 1:])) for k in range(len(self.shape))], dtype=int)
+
+        # >>> check the accuracy at the centers of random cells:
+        self.valid = True
+        rng = np.random.default_rng(1)
+        ind = np.column_stack([rng.integers(0, len(u) - 1, check) for u in self.axes])
+        values = {p: emulator_axes.get(p, (None, lambda u: u))[1]((u[ind[:, k]] + u[ind[:, k] + 1]) / 2) for k, (p, u) in enumerate(zip(self.pars, self.axes))}
+        le, lm = [np.log10(x / np.sum(x, axis=1)[:, np.newaxis]) for x in (self.parent.balance_grid(name, self.full(values)), self(values))]
+        self.error = np.nanmax(np.where(le > -6, np.abs(le - lm), 0))
+        self.valid = self.error * margin < tol
+
+    def full(self, values):
+        """
+        add the fixed parameters to the dict of the parameter values
+        """
+        num = len(next(iter(values.values())))
+        values = dict(values)
+        values.update({p: np.full(num, v) for p, v in self.fixed.items() if p not in values})
+        return values
+
+    def interpolate(self, u):
+        """
+        multilinear interpolation of the table
+        parameters:
+            - u          :  array of the transformed coordinates with shape (number of points, number of axes)
+        returns:
+            - logx       :  log populations, nan outside the grid
+        """
+        ind = np.column_stack([np.clip(np.searchsorted(a, u[:, k]) - 1, 0, len(a) - 2) for k, a in enumerate(self.axes)])
+        t = np.column_stack([(u[:, k] - a[ind[:, k]]) / (a[ind[:, k] + 1] - a[ind[:, k]]) for k, a in enumerate(self.axes)])
+        w = np.prod(np.where(self.corners[np.newaxis], t[:, np.newaxis], 1 - t[:, np.newaxis]), axis=2)
+        logx = np.einsum('nc,ncl->nl', w, self.table[(ind[:, np.newaxis] + self.corners[np.newaxis]).dot(self.strides)])
+        logx[np.any((t < 0) | (t > 1), axis=1)] = np.nan
+        return logx
+
+    def __call__(self, values):
+        """
+        populations of the levels (normalized to the ground level)
+        parameters:
+            - values     :  dict of arrays of the parameter values (the tabulated ones are required)
+        returns:
+            - x          :  populations with shape (number of points, number of levels), as from balance_grid()
+        """
+        v = [np.atleast_1d(np.asarray(x, dtype=float)) for x in values.values()]
+        v = dict(zip(values.keys(), [x.flatten() for x in np.broadcast_arrays(*v)]))
+        if self.valid:
+            x = self.interpolate(np.column_stack([emulator_axes.get(p, (lambda x: x, None))[0](v[p]) for p in self.pars]))
+        else:
+            x = np.full((len(v[self.pars[0]]), self.table.shape[1]), np.nan)
+        out = np.isnan(x[:, 0])
+        if np.any(out):
+            x[out] = np.log10(self.parent.balance_grid(self.name, self.full({p: x[out] for p, x in v.items()})))
+        return 10 ** x
+
 class pyratio():
     """
     class for population ratio calculations:
@@ -782,6 +979,8 @@ class pyratio():
 
         #print('add_spec:', n)
         self.species[name] = speci(self, name, n, num)
+        for c in self.species[name].coll.values():
+            c.tabulate(self.species[name].num)
         if self.pumping == 'simple' and 'rad' in self.pars.keys():
             self.pars['rad'].value = 0
             self.pump_matrix(name)
@@ -968,10 +1167,8 @@ class pyratio():
             W += speci.Aij
 
         if debug in [None, 'C', 'total']:
-            for u in range(speci.num):
-                for l in range(speci.num):
-                    if any(x in self.pars.keys() for x in ['n', 'e', 'H2', 'H']):
-                        W[u, l] += self.collision_rate(speci, u, l)
+            if any(x in self.pars.keys() for x in ['n', 'e', 'H2', 'H']):
+                W += self.collision_rate_grid(speci, self.grid_values({}))[0]
 
         if debug in [None, 'CMB', 'total']:
             if 'CMB' in self.pars:
@@ -1011,6 +1208,170 @@ class pyratio():
         else:
             return None
     
+    def grid_values(self, values):
+        """
+        broadcast parameter values to the grid of points
+        parameters:
+            - values     :  dict of arrays of the parameter values, e.g. {'n': n, 'T': T},
+                            parameters that are not specified are taken at their current values
+        returns:
+            - v          :  dict of 1d arrays for all parameters in self.pars
+        """
+        if len(values) > 0:
+            shape = np.broadcast(*[np.asarray(x) for x in values.values()]).shape
+        else:
+            shape = (1,)
+        v = {}
+        for p in self.pars:
+            v[p] = np.broadcast_to(np.asarray(values[p] if p in values else self.pars[p].value, dtype=float), shape).flatten()
+        return v
+
+    def rad_field_grid(self, e, v):
+        """
+        radiation field density in [erg/cm^3/Hz] for the grid of parameters, see rad_field()
+        parameters:
+            - e       :      energy of the transition in [cm^-1]
+            - v       :      dict of the parameter values from grid_values()
+        return:
+            field     : energy density with shape (number of points, *e.shape)
+        """
+        e = np.asarray(e)
+        num = len(next(iter(v.values())))
+        field = np.zeros((num,) + e.shape)
+        m = e != 0
+
+        if self.CMB:
+            field += self.cmb_field_grid(e, v)
+
+        if self.EBL:
+            field[:, m] += self.ebl(e[m]) * 4 * np.pi / ac.c.cgs.value
+
+        if self.sed_type is not None:
+            CMB, EBL, rad = self.CMB, self.EBL, self.pars['rad'].value
+            self.CMB, self.EBL, self.pars['rad'].value = False, False, 0
+            field += self.rad_field(e)[np.newaxis] * 10 ** v['rad'].reshape((-1,) + (1,) * e.ndim)
+            self.CMB, self.EBL, self.pars['rad'].value = CMB, EBL, rad
+
+        return field
+
+    def cmb_field_grid(self, e, v):
+        """
+        CMB radiation field density in [erg/cm^3/Hz] for the grid of parameters
+        """
+        e = np.asarray(e)
+        num = len(next(iter(v.values())))
+        temp = v['CMB'] if 'CMB' in v else np.full(num, 2.72548 * (1 + self.z))
+        field = np.zeros((num,) + e.shape)
+        m = e != 0
+        field[:, m] = self.Planck1 * e[m] ** 3 / (np.exp(self.Planck2 / temp[:, np.newaxis] * e[m]) - 1)
+        return field
+
+    def balance_grid(self, name=None, values=None):
+        """
+        calculate population of levels for the grid of parameters at once.
+        The balance matrices are stacked and solved by single batched np.linalg.solve,
+        the result at each point is the same as of balance().
+        parameters:
+            - name       :  name of the species
+            - values     :  dict of arrays of the parameter values, see grid_values()
+        returns:
+            - x          :  populations (normalized to the ground level) with shape (number of points, number of levels)
+        """
+        if name is None:
+            name = next(iter(self.species))
+
+        speci = self.species[name]
+        v = self.grid_values(values if values is not None else {})
+        num = len(next(iter(v.values())))
+
+        W = np.zeros([num, speci.num, speci.num])
+        W += speci.Aij
+
+        if any(x in self.pars.keys() for x in ['n', 'e', 'H2', 'H']):
+            W += self.collision_rate_grid(speci, v)
+
+        if 'CMB' in self.pars:
+            W += speci.Bij * self.cmb_field_grid(speci.Eij, v)
+
+        if 'rad' in self.pars:
+            if self.pumping == 'full':
+                if 'UV' in self.pars:
+                    pars = {p: self.pars[p].value for p in self.pars}
+                    for k in range(num):
+                        for p in self.pars:
+                            self.pars[p].value = v[p][k]
+                        for u in range(speci.num):
+                            for l in range(speci.num):
+                                W[k, u, l] += self.pumping_rate(speci, u, l)
+                    for p in self.pars:
+                        self.pars[p].value = pars[p]
+            elif self.pumping == 'simple':
+                W += speci.pump_rate * 10 ** v['rad'][:, np.newaxis, np.newaxis]
+
+            if self.radiation == 'full':
+                W += speci.Bij * self.rad_field_grid(speci.Eij, v)
+
+            if self.radiation == 'simple':
+                W += speci.rad_rate * 10 ** v['rad'][:, np.newaxis, np.newaxis]
+
+        K = np.transpose(W, (0, 2, 1)).copy()
+        K[:, np.arange(speci.num), np.arange(speci.num)] -= np.sum(W, axis=2)
+        x = np.abs(np.linalg.solve(K[:, 1:, 1:], -K[:, 1:, :1])[:, :, 0])
+        return np.insert(x, 0, 1, axis=1)
+
+    def emulate(self, name, ranges, fixed=None, cache_size=16):
+        """
+        return the emulator of the level populations of the species tabulated on the grid of parameters (see emulator class).
+        The emulators are cached by the species, ranges and fixed values, so they are built once and reused.
+        parameters:
+            - name       :  name of the species
+            - ranges     :  dict of the ranges of the tabulated parameters
+            - fixed      :  dict of the values of other parameters
+            - cache_size :  maximal number of the cached emulators
+        returns:
+            - emulator
+        """
+        if not hasattr(self, 'emulators'):
+            self.emulators = collections.OrderedDict()
+        fixed = fixed if fixed is not None else {}
+        key = (name, tuple((p, tuple(r)) for p, r in ranges.items()), tuple(sorted(fixed.items())))
+        if key not in self.emulators:
+            self.emulators[key] = emulator(self, name, ranges, fixed=fixed)
+            if len(self.emulators) > cache_size:
+                self.emulators.popitem(last=False)
+        return self.emulators[key]
+
+    def collision_rate_grid(self, speci, v):
+        """
+        calculates collisional excitation rates matrices for the grid of parameters, see collision_rate()
+        parameters:
+            - speci      :  species object
+            - v          :  dict of the parameter values from grid_values()
+        returns:
+            - coll       :  array of rates with shape (number of points, speci.num, speci.num)
+        """
+        T = v['T']
+        coll = np.zeros([len(T), speci.num, speci.num])
+        for p in self.pars:
+            if p in ['e', 'H']:
+                coll += (10 ** v[p])[:, np.newaxis, np.newaxis] * speci.coll[p].rate_matrix(speci.num, T)
+            if p in ['H2']:
+                otop = (9 * np.exp(-170. / 10 ** T))[:, np.newaxis, np.newaxis]
+                coll += (10 ** v[p])[:, np.newaxis, np.newaxis] / (1 + otop) * speci.coll['pH2'].rate_matrix(speci.num, T)
+                coll += (10 ** v[p])[:, np.newaxis, np.newaxis] * otop / (1 + otop) * speci.coll['oH2'].rate_matrix(speci.num, T)
+            if p in 'n':
+                m_fr = 10 ** v['f'] if 'f' in v else np.zeros_like(T)
+                f_HI, f_H2 = (1 - m_fr) / (self.f_He + 1 - m_fr / 2), m_fr / 2 / (self.f_He + 1 - m_fr / 2)
+                otop = 9 * np.exp(-170.6 / 10 ** T)
+                n = 10 ** v['n']
+                w = {'H': n * f_HI, 'pH2': n * f_H2 / (1 + otop), 'oH2': n * f_H2 * otop / (1 + otop)}
+                if self.f_He != 0:
+                    w['He4'] = n * self.f_He / (self.f_He + 1 - m_fr / 2)
+                for part, wi in w.items():
+                    coll += wi[:, np.newaxis, np.newaxis] * speci.coll[part].rate_matrix(speci.num, T)
+
+        return coll
+
     def collision_rate(self, speci, u, l, verbose=False):
         """
         calculates collisional excitation rates for l -> u levels of given species
@@ -1296,6 +1657,96 @@ class pyratio():
             return -np.inf
         return lp + self.lnlike()
     
+    def lnlike_grid(self, values):
+        """
+        Calculates the likelihood function for the grid of parameters at once, see lnlike()
+        parameters:
+            - values     :  dict of arrays of the parameter values, see grid_values()
+
+        return: ln
+            - ln        : array of log likelihood values
+        """
+        v = self.grid_values(values)
+        ln = np.zeros(len(next(iter(v.values()))))
+
+        if self.calctype == 'popratios':
+            for sp in self.species.values():
+                f = self.balance_grid(sp.name, v)
+                for y in sp.y:
+                    z = f[:, y[1]] / f[:, y[0]]
+                    if self.logs:
+                        y[2].log()
+                        z = np.log10(z)
+                    if y[2].type == 'm':
+                        ln += y[2].lnL(z, ind=2)
+                    elif y[2].type == 'u':
+                        delta = 0.2
+                        ln += -0.5 * ((1 - smooth_step(y[2].val - z + delta, delta)) * 2) ** 2
+                    elif y[2].type == 'l':
+                        delta = 0.2
+                        ln += -0.5 * (smooth_step(y[2].val - z + delta, delta) * 2) ** 2
+
+        elif self.calctype == 'numbdens':
+            for sp in self.species.values():
+                f = self.balance_grid(sp.name, v)
+                f /= np.sum(f[:, sp.mask], axis=1)[:, np.newaxis]
+                if self.logs:
+                    y = np.log10(f[:, sp.mask]) + v['Ntot'][:, np.newaxis]
+                else:
+                    y = f[:, sp.mask] * 10 ** v['Ntot'][:, np.newaxis]
+                for y, n in zip(y.transpose(), np.asarray(sp.n)[sp.mask]):
+                    if self.logs:
+                        n.log()
+                    if n.type == 'm':
+                        ln += n.lnL(y, ind=2)
+                    elif n.type == 'u':
+                        delta = 0.2
+                        ln += -0.5 * ((1 - smooth_step(n.val - y + delta, delta)) * 2) ** 2
+                    elif n.type == 'l':
+                        delta = 0.2
+                        ln += -0.5 * (smooth_step(n.val - y + delta, delta) * 2) ** 2
+
+        else:
+            pars = {p: self.pars[p].value for p in self.pars}
+            for k in range(len(ln)):
+                for p in self.pars:
+                    self.pars[p].value = v[p][k]
+                ln[k] = self.lnlike()
+            for p in self.pars:
+                self.pars[p].value = pars[p]
+
+        return ln
+
+    def lnprob_grid(self, values):
+        """
+        Calculates likelihood with priors for the grid of parameters at once, see lnprob()
+        parameters:
+            - values     :  dict of arrays of the parameter values, see grid_values()
+
+        return: ln
+            - ln        : array of log likelihood values
+        """
+        v = self.grid_values(values)
+        lp = self.lnprior_grid(v)
+        ln = np.full_like(lp, -np.inf)
+        m = np.isfinite(lp)
+        if np.sum(m) > 0:
+            ln[m] = lp[m] + self.lnlike_grid({p: x[m] for p, x in v.items()})
+        return ln
+
+    def lnprior_grid(self, values):
+        """
+        Prior on the parameters for the grid of parameters at once, see lnprior()
+        """
+        v = self.grid_values(values)
+        pri = np.zeros(len(next(iter(v.values()))))
+        for p in self.pars.values():
+            pri[(v[p.name] < p.range[0]) | (v[p.name] > p.range[1])] = -np.inf
+            if p.prior is not None:
+                if p.prior.plus != 0 and p.prior.minus != 0:
+                    pri += p.prior.lnL(v[p.name])
+        return pri
+
     def lnprior(self):
         """
         Adding prior on the parameters to the likelihood
@@ -1400,13 +1851,7 @@ class pyratio():
                 axi.axhspan(yg.val + yg.plus, yg.val - yg.minus, facecolor=colors[2*k], alpha=0.5, zorder=0)
 
             # calc theoretical curves:
-            f = np.zeros([len(x), s.num-1])
-            for k, z in enumerate(x):
-                self.pars[par].value = z
-                #print(self.sp.g[1]/sp.g[0], (sp.E[1]-sp.E[0])/0.695,10**t)
-                #ax.axhline(np.log10(sp.g[1]/sp.g[0]*np.exp(-(sp.E[1]-sp.E[0])/0.695/10**t)), ls=':', c=colors[1])
-                f[k] = self.balance(s.name)[1:]
-            f = np.log10(f)
+            f = np.log10(self.balance_grid(s.name, {par: x})[:, 1:])
 
             # plot theoretical curves:
             for k in range(s.num-1):
@@ -1510,12 +1955,7 @@ class pyratio():
 
         out = []
         X1 = np.linspace(self.pars[vary[0]].range[0], self.pars[vary[0]].range[1], grid_num)
-        Z = np.zeros_like(X1)
-        printProgressBar(0, grid_num, prefix='Progress:')
-        for i in range(len(X1)):
-            self.pars[vary[0]].value = X1[i]
-            Z[i] = self.lnprob()
-            printProgressBar(i + 1, grid_num, prefix='Progress:')
+        Z = self.lnprob_grid({vary[0]: X1})
 
         if verbose == 1:
             print(-max(Z))
@@ -1588,16 +2028,8 @@ class pyratio():
 
         X1 = np.linspace(self.pars[vary[0]].range[0], self.pars[vary[0]].range[1], grid_num)
         X2 = np.linspace(self.pars[vary[1]].range[0], self.pars[vary[1]].range[1], grid_num)
-        Z = np.zeros([len(X1), len(X2)])
-        if verbose:
-            printProgressBar(0, grid_num, prefix='Progress:')
-        for i in range(len(X1)):
-            print(i)
-            self.pars[vary[0]].value = X1[i]
-            for k in range(len(X2)):
-                self.pars[vary[1]].value = X2[k]
-                Z[k, i] = self.lnprob()
-            printProgressBar(i + 1, grid_num, prefix='Progress:')
+        x1, x2 = np.meshgrid(X1, X2)
+        Z = self.lnprob_grid({vary[0]: x1.flatten(), vary[1]: x2.flatten()}).reshape(x1.shape)
         if verbose == 1:
             print(max(Z.flatten()))
 
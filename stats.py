@@ -3,7 +3,7 @@ from matplotlib.colors import ListedColormap, LogNorm
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy import interpolate, integrate, optimize
-from scipy.stats import gaussian_kde, rv_continuous, norm
+from scipy.stats import gaussian_kde
 
 class distr1d():
     """
@@ -22,6 +22,9 @@ class distr1d():
 
     Make plot:
     d.plot(conf=0.683)
+
+    The intervals, quantiles and random samples are calculated from the cumulative distribution of the linearly interpolated pdf,
+    that is precomputed once in interpolate(), see cdf() and ppf().
     """
     def __init__(self, x, y=None, xtol=1e-5, debug=False, name='par'):
         self.x = x
@@ -48,7 +51,58 @@ class distr1d():
         self.ymax = np.max(self.y)
 
     def interpolate(self, kind='linear'):
+        self.kind = kind
         self.inter = interpolate.interp1d(self.x, self.y, kind=kind, bounds_error=False, fill_value=0)
+        self.x, self.y = np.asarray(self.x, dtype=float), np.asarray(self.y, dtype=float)
+
+        # >>> cumulative distribution of the piecewise linear pdf (exact trapezoids)
+        self.slope = np.diff(self.y) / np.diff(self.x)
+        self.F = np.r_[0, np.cumsum((self.y[1:] + self.y[:-1]) / 2 * np.diff(self.x))]
+
+        # >>> monotonic envelopes of the pdf from the both edges up to the maximum to find the outer crossings with the level
+        ind = np.argmax(self.y)
+        self.env = [np.maximum.accumulate(self.y[:ind + 1]), np.maximum.accumulate(self.y[ind:][::-1])]
+
+    def cdf(self, x):
+        """
+        Cumulative distribution of the linearly interpolated pdf
+        parameters:
+            - x           :  values (scalar or array)
+        return: cdf
+        """
+        x = np.clip(np.asarray(x, dtype=float), self.x[0], self.x[-1])
+        i = np.clip(np.searchsorted(self.x, x, side='right') - 1, 0, len(self.x) - 2)
+        t = x - self.x[i]
+        return self.F[i] + self.y[i] * t + self.slope[i] * t ** 2 / 2
+
+    def ppf(self, q):
+        """
+        Inverse of the cumulative distribution (quantile function) of the linearly interpolated pdf
+        parameters:
+            - q           :  probabilities (scalar or array), they are counted from the total probability self.F[-1]
+        return: x
+        """
+        q = np.clip(np.asarray(q, dtype=float), 0, self.F[-1])
+        i = np.clip(np.searchsorted(self.F, q, side='right') - 1, 0, len(self.x) - 2)
+        d = q - self.F[i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = 2 * d / (self.y[i] + np.sqrt(np.maximum(self.y[i] ** 2 + 2 * self.slope[i] * d, 0)))
+        t = np.where(np.isfinite(t), t, 0)
+        return np.minimum(self.x[i] + t, self.x[i + 1])
+
+    def crossing(self, level, side=0):
+        """
+        Outer crossing of the pdf with the level at the left (side=0) or right (side=1) of the maximum,
+        so the interval between the crossings contains all the pdf above the level
+        """
+        env = self.env[side]
+        x, y = (self.x, self.y) if side == 0 else (self.x[::-1], self.y[::-1])
+        j = np.searchsorted(env, level, side='left')
+        if j == 0:
+            return x[0]
+        if j == len(env):
+            return x[-1]
+        return x[j - 1] + (level - y[j - 1]) / (y[j] - y[j - 1]) * (x[j] - x[j - 1])
 
     def minter(self, x):
         return -self.inter(x)
@@ -85,23 +139,9 @@ class distr1d():
         return ax
 
     def minmax(self, level):
-        ind = np.argmax(self.y)
         if level > 0 and level < self.ymax:
-            if 1:
-                try:
-                    self.xmin = optimize.bisect(self.level, self.x[0], self.x[ind], args=(level), xtol=(self.x[ind] - self.x[0]) / 1e6, rtol=1e-15)
-                except ValueError:
-                    self.xmin = self.x[0]
-                try:
-                    self.xmax = optimize.bisect(self.level, self.x[ind], self.x[-1], args=(level), xtol=(self.x[-1] - self.x[ind]) / 1e6, rtol=1e-15)
-                except ValueError:
-                    self.xmax = self.x[-1]
-            else:
-                step = (self.x[ind + 1] - self.x[ind - 1]) / 10
-                o = {'xtol': self.xtol, 'epsfcn': step}
-                self.xmin = optimize.root(self.level, self.x[ind-3], args=(level), method='lm', disp=self.debug, options=o).x
-                self.xmax = optimize.root(self.level, self.x[ind+3], args=(level), method='lm', disp=self.debug, options=o).x
-        elif level > self.ymax:
+            self.xmin, self.xmax = self.crossing(level, side=0), self.crossing(level, side=1)
+        elif level >= self.ymax:
             self.xmin, self.xmax = self.point, self.point
         elif level <= 0:
             self.xmin, self.xmax = self.x[0], self.x[-1]
@@ -110,13 +150,13 @@ class distr1d():
 
     def func_twoside(self, level, conf, epsrel=1e-4):
         xmin, xmax = self.minmax(level)
-        return integrate.quad(self.inter, xmin, xmax, epsrel=epsrel)[0] - conf
+        return self.cdf(xmax) - self.cdf(xmin) - conf
 
     def func_oneside(self, x, conf, kind='left', epsrel=1e-4):
         if kind == 'right':
-            return integrate.quad(self.inter, x, self.x[-1], epsrel=epsrel)[0] - conf
+            return self.F[-1] - self.cdf(x) - conf
         elif kind == 'left':
-            return integrate.quad(self.inter, self.x[0], x, epsrel=epsrel)[0] - conf
+            return self.cdf(x) - conf
 
     def dopoint(self, verbose=False):
         """
@@ -124,7 +164,11 @@ class distr1d():
         :return:
             - point estimate?
         """
-        self.point = optimize.fmin(self.minter, self.x[np.argmax(self.y)], xtol=self.xtol, disp=self.debug)[0]
+        if self.kind == 'linear':
+            # maximum of the piecewise linear pdf is at the node
+            self.point = self.x[np.argmax(self.y)]
+        else:
+            self.point = optimize.fmin(self.minter, self.x[np.argmax(self.y)], xtol=self.xtol, disp=self.debug)[0]
         self.ymax = self.inter(self.point)
         if self.debug or verbose:
             print('point:', self.point, self.x[np.argmax(self.y)])
@@ -141,16 +185,20 @@ class distr1d():
             - interval    :  estimated interval
             - level       :  level of pdf
         """
-        nd = norm()
         self.dopoint(verbose=False)
         if kind == 'center':
-            res = optimize.fsolve(self.func_twoside, self.ymax / (nd.pdf(0) / (nd.pdf(nd.interval(conf)[0]) / 2)), args=(conf), xtol=self.xtol, full_output=self.debug)
+            # the mass between the crossings decreases monotonically with level, each evaluation is O(log n)
+            if self.func_twoside(0, conf) <= 0:
+                res = [0]
+            else:
+                res = [optimize.brentq(self.func_twoside, 0, float(self.ymax), args=(conf), xtol=self.ymax * 1e-12, rtol=1e-12)]
             self.interval = self.minmax(res[0])
         else:
-            res = optimize.fsolve(self.func_oneside, self.point, args=(conf, kind), xtol=self.xtol, full_output=self.debug)
             if kind == 'right':
+                res = [float(self.ppf(self.F[-1] - conf))]
                 self.interval = [res[0], self.x[-1]]
             elif kind == 'left':
+                res = [float(self.ppf(conf))]
                 self.interval = [self.x[0], res[0]]
 
         if self.debug or verbose:
@@ -177,19 +225,39 @@ class distr1d():
         return self.inter(x)
 
     def rvs(self, n=1):
-        class gen(rv_continuous):
-            def __init__(self, parent, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.parent = parent
-
-            def _pdf(self, x):
-                return self.parent.pdf(x)
-
-        return gen(self, a=self.x[0], b=self.x[-1]).rvs(size=n)
+        """
+        Generate the random sample from the distribution by inverse transform sampling
+        parameters:
+            - n            : sample size to generate
+        return: sample
+        """
+        return self.ppf(np.random.uniform(0, self.F[-1], size=n))
 
     def latex(self, f=2):
         return r"${0:.{n}f}^{{+{1:.{n}f}}}_{{-{2:.{n}f}}}$".format(self.point, self.interval[1] - self.point, self.point - self.interval[0], n=f)
 
+class grid_interp():
+    """
+    Cubic spline interpolation of the 2d pdf on rectangular grid by RectBivariateSpline.
+    Keeps the call signature of interp2d(..., fill_value=0): inter(x, y) gives array of shape (len(y), len(x))
+    on sorted x and y (squeezed if y is scalar) and zero outside the grid.
+    parameters:
+        - x, y     :  grid along the axes
+        - z        :  values of shape (len(y), len(x))
+    """
+    def __init__(self, x, y, z, k=3):
+        ix, iy = np.argsort(x), np.argsort(y)
+        self.x, self.y = np.asarray(x)[ix], np.asarray(y)[iy]
+        self.spline = interpolate.RectBivariateSpline(self.y, self.x, np.asarray(z)[iy][:, ix],
+                                                      kx=min(k, len(y) - 1), ky=min(k, len(x) - 1))
+
+    def __call__(self, x, y):
+        x, y = np.sort(np.atleast_1d(x).astype(float)), np.sort(np.atleast_1d(y).astype(float))
+        z = self.spline(y, x, grid=True)
+        z[(y < self.y[0]) | (y > self.y[-1]), :] = 0
+        z[:, (x < self.x[0]) | (x > self.x[-1])] = 0
+        return z[0] if len(y) == 1 else z
+
 class distr2d():
     def __init__(self, x, y, z=None, num=None, xtol=1e-5, debug=False):
         if z is None:
@@ -202,14 +270,11 @@ class distr2d():
             self.z = z(np.vstack([X.flatten(), Y.flatten()])).reshape(X.shape)
 
         elif len(z.shape) == 1 and len(x.shape) == 1 and len(y.shape) == 1:
-            self.x = np.unique(sorted(x))
-            self.y = np.unique(sorted(y))
+            self.x, ix = np.unique(x, return_inverse=True)
+            self.y, iy = np.unique(y, return_inverse=True)
             self.z = np.zeros([len(self.y), len(self.x)])
-            for i, xi in enumerate(self.x):
-                for k, yk in enumerate(self.y):
-                    ind = np.where((xi == x) * (yk == y))[0]
-                    if len(ind) > 0:
-                        self.z[k, i] = z[ind[0]]
+            cells, first = np.unique(iy * len(self.x) + ix, return_index=True)
+            self.z.flat[cells] = z[first]
         elif len(x) in z.shape and len(y) in z.shape:
             self.x = x
             self.y = y
@@ -236,10 +301,11 @@ class distr2d():
 
     def interpolate(self):
         if 1:
-            self.inter = interpolate.interp2d(self.x, self.y, self.z, kind='cubic', fill_value=0)
+            self.inter = grid_interp(self.x, self.y, self.z)
             #self.inter = interpolate.Rbf(self.x, self.y, self.z, function='multiquadric', smooth=0.1)
         else:
-            self.inter = interpolate.RectBivariateSpline(self.x, self.y, self.z, kx=3, ky=3)
+            self.inter = interpolate.interp2d(self.x, self.y, self.z, kind='cubic', fill_value=0)
+        self.masses = None
         #xi, yi = 5, 14
         #print(self.inter(self.x[xi], self.y[yi]), self.z[yi, xi], self.x[xi], self.y[yi])
         #print(self.inter(self.x[xi+1], self.y[yi+1]), self.z[yi+1, xi+1], self.x[xi+1], self.y[yi+1])
@@ -290,9 +356,28 @@ class distr2d():
             print('point estimate:', self.point[0], self.point[1], self.zmax)
         return self.point
 
+    def cell_masses(self, num=300):
+        """
+        Sorted pdf values and cumulative probability masses of the cells of the fine grid (cached until the next interpolate)
+        parameters:
+            - num            :  number of the fine grid points along each axis
+
+        return: z, mass
+            - z              :  pdf values at the fine grid sorted in descending order
+            - mass           :  probability contained in the cells with pdf above z
+        """
+        if self.masses is None:
+            x, y = np.linspace(np.min(self.x), np.max(self.x), num), np.linspace(np.min(self.y), np.max(self.y), num)
+            z = np.maximum(self.inter(x, y), 0).flatten()
+            wx, wy = np.gradient(x), np.gradient(y)
+            wx[[0, -1]], wy[[0, -1]] = wx[[0, -1]] / 2, wy[[0, -1]] / 2
+            ind = np.argsort(z)[::-1]
+            self.masses = z[ind], np.cumsum(np.outer(wy, wx).flatten()[ind] * z[ind])
+        return self.masses
+
     def level(self, conf=0.683):
         """
-        Level of pdf at given confidence level
+        Level of pdf at given confidence level (highest density region), found from the sorted cumulative masses of the cells.
         parameters:
             - conf           :  confidence level
 
@@ -302,14 +387,10 @@ class distr2d():
         if conf == 0:
             return self.zmax
         else:
-            x, y = np.linspace(np.min(self.x), np.max(self.x), 300), np.linspace(np.min(self.y), np.max(self.y), 300)
-            z = self.inter(x, y)
-            if 1:
-                res = optimize.bisect(self.func, 0, self.zmax, args=(conf, x, y, z), xtol=self.xtol, disp=self.debug)
-            else:
-                res = optimize.fsolve(self.func, self.zmax/2, args=(conf, x, y, z), xtol=self.xtol, disp=self.debug)[0]
+            z, mass = self.cell_masses()
+            res = np.interp(conf, mass, z)
             if self.debug:
-                print('fsolve:', res)
+                print('level:', res)
 
             return res
 
@@ -324,17 +405,12 @@ class distr2d():
             - y_interval      :  interval values for y
             - level           :  level of pdf corresponding to area equal confidence.
         """
-        nd = norm()
         self.dopoint()
-        n = self.zmax / (nd.pdf(0) / (nd.pdf(nd.interval(conf)[0]) / 2))
-        res = optimize.fsolve(self.func, n, args=(conf), xtol=self.xtol, full_output=self.debug)
-        self.interval = self.minmax(res[0])
-
         level = self.level(conf=conf)
         self.interval = self.minmax(level)
         if self.debug or verbose:
             print('interval:', self.interval[0], self.interval[1])
-        return self.interval[0], self.interval[1], res[0]
+        return self.interval[0], self.interval[1], level
 
     def plot_3d(self, conf_levels=None):
         from pyqtgraph.Qt import QtGui
@@ -11,6 +11,17 @@ import sys, os
 sys.path.append(os.path.dirname(os.path.realpath(__file__))[:-16])
 #sys.path.append('C:/science/python')
 #sys.path.append('/media/serj/3078FE3678FDFB04/science/python')
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'fit':
+    # headless batch fitting of .spv files, see batch.main()
+    from spectro.sviewer.batch import main
+    sys.exit(main(sys.argv[2:]))
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'lyaforest':
+    # headless scan of the Lya forest over the catalog of spectra, see lyaforest.main()
+    from spectro.sviewer.lyaforest import main
+    sys.exit(main(sys.argv[2:]))
+
 import spectro.sviewer.sviewer as sv
 
 
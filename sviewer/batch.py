@@ -0,0 +1,358 @@
+import argparse
+import emcee
+from lmfit import Minimizer, Parameters
+from multiprocessing import Pool
+import numpy as np
+import os
+from scipy.interpolate import splrep, splev
+import time
+
+from ..a_unc import a
+from ..atomic import atomicData
+from .fit import fitPars, calc_fit, bootstrap
+from .utils import Timer
+
+def options(opt, config='config/options.ini'):
+    """
+    Read the option from the config file of sviewer (as sviewer.options, without writing)
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), config)) as f:
+        for line in f:
+            if len(line.split()) > 2 and line.split()[0] == opt and not any([line.startswith(st) for st in ['#', '!', '$', '%']]):
+                return ' '.join(line.split()[2:])
+
+class spvSession:
+    """
+    GUI-free model of the .spv session file (spectra, continuum, fitting regions and fit parameters),
+    which is used for batch fitting, see main() and fit_file().
+    Spectra can be embedded in the .spv file or given by the name of ascii (.dat, .txt, .spec) or hdf5 file,
+    the other formats (e.g. instrument specific fits files) require GUI and raise ValueError.
+    """
+    def __init__(self, filename=None, num_between=3, tau_limit=0.01, voigt_calc='spec', fit_type=None, pyratio_emulate=None):
+        self.s = []
+        self.regions = []
+        self.num_between = num_between
+        self.tau_limit = tau_limit
+        self.voigt_calc = voigt_calc
+        # the fit type and the use of pyratio emulator are the same as in GUI, if not specified
+        self.fit_type = fit_type if fit_type is not None else options('fitType')
+        self.pyratio_emulate = pyratio_emulate if pyratio_emulate is not None else options('pyratio_emulate') == 'True'
+        self.fit = fitPars(self)
+        self.text = []
+        if filename is not None:
+            self.load(filename)
+
+    def readSpectrum(self, specname):
+        if specname.endswith('.hdf5'):
+            import h5py
+            with h5py.File(specname, 'r') as f:
+                data = [np.asarray(f[[k for k in keys if k in f.keys()][0]][:], dtype=float) for keys in [['wavelength', 'wave', 'x'], ['flux', 'f', 'y'], ['err', 'unc', 's', 'error', 'errors']]]
+        elif specname.endswith(('.fits', '.fit', 'tar.gz')):
+            raise ValueError('spectrum {} can be read only in the GUI'.format(specname))
+        else:
+            data = np.genfromtxt(specname, comments='#', unpack=True, delimiter=',' if specname.endswith('.dat') and ',' in open(specname, 'r').readline() else None)
+            if specname.endswith('.spec') and np.median(data[1]) < 1e-15:
+                data[1:3] *= 1e17
+        return data
+
+    def load(self, filename):
+        """
+        Read the .spv file. The format is the same as in sviewer.openFile and sviewer.saveFile.
+        """
+        self.filename = filename
+        folder = os.path.dirname(filename)
+
+        with open(filename) as f:
+            d = f.readlines()
+        self.text = d
+
+        i = -1
+        while i < len(d) - 1:
+            i += 1
+            if '%' in d[i]:
+                specname = d[i][1:].strip()
+                s = {'name': specname, 'x': None, 'spline': [], 'points': [], 'bad': [], 'resolution': None, 'scaling_factor': 1}
+                i += 1
+                while i < len(d) and all([x not in d[i] for x in ['%', '----', 'doublet', 'region', 'fit_model']]):
+                    if 'spectrum' in d[i]:
+                        n = int(d[i].split()[1])
+                        data = np.array([[float(v) for v in line.split()[:3]] for line in d[i+1:i+1+n]])
+                        s['x'], s['y'], s['err'] = data[:, 0], data[:, 1], data[:, 2] if data.shape[1] > 2 else np.zeros(n)
+                        i += n
+                    if 'Bcont' in d[i]:
+                        n = int(d[i].split()[1])
+                        s['spline'] = [[float(v) for v in line.split()[:2]] for line in d[i+1:i+1+n]]
+                        i += n
+                    if 'fitting_points' in d[i] or 'bad_pixels' in d[i]:
+                        n = int(d[i].split()[1])
+                        s['points' if 'fitting_points' in d[i] else 'bad'] = [float(line.split()[0]) for line in d[i+1:i+1+n]]
+                        i += n
+                    if 'resolution' in d[i]:
+                        s['resolution'] = int(float(d[i].split()[1]))
+                    if 'scaling_factor' in d[i]:
+                        s['scaling_factor'] = float(d[i].split()[1])
+                    i += 1
+                if s['x'] is None:
+                    if all([slash not in specname for slash in ['/', '\\']]):
+                        specname = folder + '/' + specname
+                    data = self.readSpectrum(specname)
+                    s['x'], s['y'] = data[0], data[1]
+                    s['err'] = data[2] if len(data) > 2 else np.zeros_like(data[0])
+                s['y'], s['err'] = s['y'] * s['scaling_factor'], s['err'] * s['scaling_factor']
+                self.s.append(s)
+                i -= 1
+                continue
+
+            if 'regions' in d[i]:
+                ns = int(d[i].split()[1])
+                self.regions = [[float(v) for v in d[i+1+r].split()[:2]] for r in range(ns)]
+
+            if 'fit_model' in d[i]:
+                self.fit = fitPars(self)
+                num = int(d[i].split()[1])
+                for k in range(num):
+                    i += 1
+                    self.fit.readPars(d[i])
+
+            if 'fit_tieds' in d[i]:
+                self.fit.tieds = {}
+                num = int(d[i].split()[1])
+                for k in range(num):
+                    i += 1
+                    self.fit.addTieds(d[i].strip().split()[0], d[i].strip().split()[1])
+
+            if 'fit_exclude' in d[i]:
+                for sys in self.fit.sys:
+                    sys.exclude = []
+                num = int(d[i].split()[1])
+                for k in range(num):
+                    i += 1
+                    self.fit.sys[int(d[i].split()[0])].exclude.append(' '.join(d[i].split()[1:]))
+
+    def normalized(self):
+        """
+        Return the normalized spectra (as in Spectrum.normalize) in the form, which is accepted by calc_fit.set_data,
+        i.e. list of tuples (x, y, err, fit mask, resolution).
+        """
+        data = []
+        for s in self.s:
+            x, mask = s['x'], np.zeros_like(s['x'], dtype=bool)
+            for name, m in [('points', True), ('bad', False)]:
+                p = np.asarray(s[name])
+                if len(p) > 0:
+                    p = np.sort(p)
+                    ind = np.clip(np.searchsorted(p, x), 1, len(p)) - 1
+                    close = np.minimum(np.abs(x - p[ind]), np.abs(x - p[np.minimum(ind + 1, len(p) - 1)])) < np.abs(x) * 1e-6
+                    mask = np.logical_or(mask, close) if m else np.logical_and(mask, np.logical_not(close))
+            if len(s['spline']) > 1:
+                sx, sy = np.transpose(s['spline'])
+                cont_mask = (x > sx[0]) & (x < sx[-1])
+                cont = splev(x[cont_mask], splrep(sx, sy, k=min(3, len(sx) - 1))) if np.sum(cont_mask) > 0 else np.zeros(0)
+                data.append((x[cont_mask], s['y'][cont_mask] / cont, s['err'][cont_mask] / cont, mask[cont_mask], s['resolution']))
+            else:
+                data.append((np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool), s['resolution']))
+        return data
+
+    def likelihood(self, atomic=None):
+        """
+        Return the headless likelihood (calc_fit object) for the session.
+        """
+        lnL = calc_fit(num_between=self.num_between, tau_limit=self.tau_limit, voigt_calc=self.voigt_calc, fit_type=self.fit_type)
+        lnL.set_data(self.normalized())
+        lnL.set_model(self.fit.list_fit(), fit=self.fit)
+        lnL.fit.update(redraw=False)
+        if atomic is None:
+            atomic = atomicData()
+            atomic.readdatabase()
+        lnL.find_lines(atomic, tlim=self.tau_limit)
+        return lnL
+
+    def setResults(self, lnL, unc):
+        """
+        Copy the values of the parameters (including tied and derived ones) from the likelihood model and set the uncertainties.
+          - unc         : dictionary {name: (plus, minus)}
+        """
+        for k, p in lnL.fit.pars().items():
+            self.fit.setValue(k, p.val, check=False)
+        for k, (plus, minus) in unc.items():
+            self.fit.setValue(k, a(self.fit.getValue(k), plus, minus, self.fit.getPar(k).form), 'unc')
+
+    def fitLM(self, lnL, method='leastsq'):
+        """
+        Least squares fit (as in sviewer.fitAbs), the results are written to self.fit.
+        """
+        def fcn2min(params):
+            for p in params:
+                name = params[p].name.replace('l4', '****').replace('l3', '***').replace('l2', '**').replace('l1', '*')
+                lnL.fit.setValue(name, lnL.fit.pars()[name].ref(params[p].value))
+            lnL.fit.update(redraw=False)
+            return lnL.chi()
+
+        params = Parameters()
+        for par in lnL.fit.list_fit():
+            p = str(par).replace('****', 'l4').replace('***', 'l3').replace('**', 'l2').replace('*', 'l1')
+            value, pmin, pmax = par.ref()
+            if 'cf' in p:
+                pmin, pmax = 0, 1
+            params.add(p, value=value, min=pmin, max=pmax)
+
+        result = Minimizer(fcn2min, params, nan_policy='propagate', calc_covar=True).minimize(method=method)
+        fcn2min(result.params)
+        unc = {}
+        for p in result.params.keys():
+            name = str(result.params[p].name).replace('l4', '****').replace('l3', '***').replace('l2', '**').replace('l1', '*')
+            stderr = lnL.fit.pars()[name].ref(result.params[p].stderr, attr='unc') if result.params[p].stderr is not None else 0
+            unc[name] = (stderr, stderr)
+        self.setResults(lnL, unc)
+        return result.message
+
+    def fitMCMC(self, lnL, nwalkers=100, nsteps=1000, burnin=0.5, backend=None):
+        """
+        MCMC fit using emcee, the chain is stored in HDF5 backend (if specified, in the same format as from the GUI).
+        Results (maximum likelihood and 68% interval from the last (1 - burnin) part of the chain) are written to self.fit.
+        """
+        pars = lnL.pars
+        init = np.array([np.clip(p.val + np.random.randn(nwalkers) * p.step, p.min, p.max) for p in lnL.fit.list_fit()]).transpose()
+        if backend is not None:
+            backend = emcee.backends.HDFBackend(backend)
+            backend.reset(nwalkers, len(pars))
+
+        sampler = emcee.EnsembleSampler(nwalkers, len(pars), lnL, backend=backend)
+        sampler.run_mcmc(init, nsteps)
+        if backend is not None:
+            with backend.open("a") as f:
+                f[backend.name].attrs["pars"] = [p.encode() for p in pars]
+
+        samples, lnprobs = sampler.get_chain(discard=int(nsteps * burnin), flat=True), sampler.get_log_prob(discard=int(nsteps * burnin), flat=True)
+        best = samples[np.argmax(lnprobs)]
+        lnL(best)
+        low, high = np.percentile(samples, [15.865, 84.135], axis=0)
+        self.setResults(lnL, {p: (max(high[k] - best[k], 0), max(best[k] - low[k], 0)) for k, p in enumerate(pars)})
+        return 'acceptance fraction: {0:.3f}'.format(np.mean(sampler.acceptance_fraction))
+
+    def save(self, filename=None):
+        """
+        Write the fit results back to .spv file: fit_model block is replaced and fit_results block is added (or replaced).
+        The rest of the file is kept untouched.
+        """
+        d, out, i = self.text, [], 0
+        while i < len(d):
+            if any([b in d[i] for b in ['fit_model', 'fit_results']]):
+                i += int(d[i].split()[1]) + 1
+                continue
+            out.append(d[i])
+            i += 1
+        pars = self.fit.list()
+        block = ['fit_model: {0:}\n'.format(len(pars))] + [p.str() + '\n' for p in pars]
+        ind = [k for k, line in enumerate(out) if any([b in line for b in ['fit_tieds', 'fit_exclude']])]
+        ind = ind[0] if len(ind) > 0 else len(out)
+        out = out[:ind] + block + out[ind:]
+
+        pars = self.fit.list_fit()
+        if any([p.unc is not None and p.unc.minus > 0 and p.unc.plus > 0 for p in pars]):
+            out += ['fit_results: {0:}\n'.format(len(pars))] + [str(p) + ' = ' + p.fitres(latex=True, showname=True) + '\n' for p in pars]
+
+        with open(self.filename if filename is None else filename, 'w') as f:
+            f.writelines(out)
+
+def fit_file(filename, method='lm', fit_method='leastsq', nwalkers=100, nsteps=1000, num_between=3, tau_limit=0.01, voigt_calc='spec', fit_type=None, pyratio_emulate=None, suffix=''):
+    """
+    Fit single .spv file and write the results back (to the file with given suffix, if specified).
+    Returns the dictionary with the timing report.
+    """
+    report = {'file': filename, 'status': 'ok', 'npix': 0, 'npars': 0, 'chi2': np.nan}
+    t, start = Timer(verbose=False), time.time()
+    try:
+        session = spvSession(filename, num_between=num_between, tau_limit=tau_limit, voigt_calc=voigt_calc, fit_type=fit_type, pyratio_emulate=pyratio_emulate)
+        report['load'] = t.time()
+        lnL = session.likelihood()
+        report['prepare'] = t.time()
+        out = filename.replace('.spv', suffix + '.spv')
+        if method == 'lm':
+            report['message'] = session.fitLM(lnL, method=fit_method)
+        elif method == 'mcmc':
+            report['message'] = session.fitMCMC(lnL, nwalkers=nwalkers, nsteps=nsteps, backend=out.replace('.spv', '.hdf5'))
+        report['fit'] = t.time()
+        chi = lnL.chi([session.fit.getValue(p) for p in lnL.pars])
+        report['npix'], report['npars'], report['chi2'] = len(chi), len(lnL.pars), np.sum(chi ** 2)
+        session.save(out)
+    except Exception as e:
+        report['status'] = 'failed: {}'.format(e)
+    report['total'] = time.time() - start
+    return report
+
+def boot_file(filename, num, snr=None, seed=None, threads=1, num_between=3, tau_limit=0.01, voigt_calc='spec', fit_type=None, pyratio_emulate=None, suffix='_boot'):
+    """
+    Monte Carlo bootstrap of the fit model of single .spv file (see fit.bootstrap), the fitted values of each realization
+    are written to hdf5 file with given suffix. Returns the dictionary with the report (including throughput).
+    """
+    report = {'file': filename, 'status': 'ok', 'num': num}
+    start = time.time()
+    try:
+        session = spvSession(filename, num_between=num_between, tau_limit=tau_limit, voigt_calc=voigt_calc, fit_type=fit_type, pyratio_emulate=pyratio_emulate)
+        lnL = session.likelihood()
+        report['prepare'] = time.time() - start
+        res = bootstrap(lnL, num, snr=snr, seed=seed, threads=threads, filename=filename.replace('.spv', suffix + '.hdf5'),
+                        callback=lambda done, rate: print('{0}: {1:d} / {2:d}, {3:.2f} per s'.format(os.path.basename(filename), done, num, rate)))
+        report['pars'] = {p: (np.nanmean(res[:, k]) - lnL.fit.getValue(p), np.nanstd(res[:, k])) for k, p in enumerate(lnL.pars)}
+    except Exception as e:
+        report['status'] = 'failed: {}'.format(e)
+    report['total'] = time.time() - start
+    report['rate'] = num / report['total']
+    return report
+
+def _fit_file(kwargs):
+    return fit_file(**kwargs)
+
+def main(argv=None):
+    """
+    Batch fitting of .spv files without GUI:
+        python -m spectro.sviewer fit file1.spv file2.spv ... [-m lm|mcmc] [-j threads]
+    or Monte Carlo bootstrap of their fit models:
+        python -m spectro.sviewer fit file1.spv ... --boot 1000 [--snr 20] [-j threads]
+    """
+    parser = argparse.ArgumentParser(prog='python -m spectro.sviewer fit', description='Headless fit of absorption lines in .spv session files')
+    parser.add_argument('files', nargs='+', help='.spv files to fit')
+    parser.add_argument('-m', '--method', choices=['lm', 'mcmc'], default='lm', help='least squares (lm) or MCMC (emcee) fit')
+    parser.add_argument('--fit-method', default='leastsq', help='lmfit minimization method for lm fit')
+    parser.add_argument('--walkers', type=int, default=100, help='number of walkers for MCMC')
+    parser.add_argument('--iters', type=int, default=1000, help='number of iterations for MCMC')
+    parser.add_argument('--num-between', type=int, default=3, help='number of points to add between spectral pixels')
+    parser.add_argument('--tau-limit', type=float, default=0.01, help='limit of optical depth to cutoff the lines')
+    parser.add_argument('--voigt', choices=['spec', 'table'], default='spec', help='direct (wofz) or table driven calculation of Voigt function')
+    parser.add_argument('--fit-type', choices=['regular', 'fast', 'vector'], default=None, help='fit type, as set in GUI (fitType in config/options.ini) if not specified')
+    parser.add_argument('--pyratio-emulate', action=argparse.BooleanOptionalAction, default=None, help='interpolate the populations of the levels tied by pyratio by the emulator, as set in GUI (pyratio_emulate in config/options.ini) if not specified')
+    parser.add_argument('--suffix', default='', help='write results to files with this suffix instead of overwriting .spv files')
+    parser.add_argument('-j', '--threads', type=int, default=1, help='number of processes to fit files in parallel')
+    parser.add_argument('--boot', type=int, default=0, help='number of Monte Carlo bootstrap realizations of the fit model (instead of fit), the processes are used for realizations')
+    parser.add_argument('--snr', type=float, default=None, help='signal to noise ratio of the bootstrap spectra, if not specified the uncertainties of the spectra are used')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator for bootstrap')
+    args = parser.parse_args(argv)
+
+    if args.boot > 0:
+        t = Timer(verbose=False)
+        reports = [boot_file(f, args.boot, snr=args.snr, seed=args.seed, threads=args.threads, num_between=args.num_between,
+                             tau_limit=args.tau_limit, voigt_calc=args.voigt, fit_type=args.fit_type, pyratio_emulate=args.pyratio_emulate, suffix=args.suffix if args.suffix != '' else '_boot') for f in args.files]
+        for r in reports:
+            print('{0:40s} {1:6d} realizations {2:8.2f} s {3:8.2f} per s  {4}'.format(os.path.basename(r['file']), r['num'], r['total'], r['rate'], r['status']))
+            for p, (bias, std) in r.get('pars', {}).items():
+                print('    {0:20s} bias {1:10.4f}  std {2:10.4f}'.format(p, bias, std))
+        print('total time: {0:.2f} s for {1:d} files'.format(t.time(), len(reports)))
+        return int(any([r['status'] != 'ok' for r in reports]))
+
+    tasks = [dict(filename=f, method=args.method, fit_method=args.fit_method, nwalkers=args.walkers, nsteps=args.iters,
+                  num_between=args.num_between, tau_limit=args.tau_limit, voigt_calc=args.voigt, fit_type=args.fit_type, pyratio_emulate=args.pyratio_emulate, suffix=args.suffix) for f in args.files]
+
+    t = Timer(verbose=False)
+    if args.threads > 1:
+        with Pool(args.threads) as pool:
+            reports = list(pool.imap_unordered(_fit_file, tasks))
+    else:
+        reports = [_fit_file(task) for task in tasks]
+
+    print('{0:40s} {1:>8s} {2:>8s} {3:>8s} {4:>8s} {5:>7s} {6:>5s} {7:>12s}  {8}'.format('file', 'load', 'prepare', 'fit', 'total', 'npix', 'npars', 'chi2', 'status'))
+    for r in sorted(reports, key=lambda r: r['file']):
+        print('{0:40s} {1:8.2f} {2:8.2f} {3:8.2f} {4:8.2f} {5:7d} {6:5d} {7:12.2f}  {8}'.format(os.path.basename(r['file']), r.get('load', np.nan), r.get('prepare', np.nan), r.get('fit', np.nan), r['total'], r['npix'], r['npars'], r['chi2'], r['status']))
+    print('total time: {0:.2f} s for {1:d} files'.format(t.time(), len(reports)))
+
+    return int(any([r['status'] != 'ok' for r in reports]))
@@ -1,10 +1,14 @@
 from copy import copy, deepcopy
 from collections import OrderedDict
 import gc
+from multiprocessing import Pool
 import numpy as np
+import time
+from scipy.optimize import least_squares
 from .utils import Timer
 from ..a_unc import a
 from ..atomic import abundance, doppler
+from ..profiles import calctau_lines, convolveflux, lines_range, makegrid
 from ..pyratio import pyratio
 
 class par:
@@ -278,55 +282,100 @@ class fitSystem:
     def pyratio(self, init=False):
         #t = Timer('pyratio '+ str(self.parent.sys.index(self)))
         if init or self.pr is None:
-            if self == self.parent.sys[0]:
-
-                self.pr = pyratio(z=self.z.val, pumping='simple', radiation='simple', sed_type=self.rad.addinfo)
-
-                #print('init', self.pr.pumping, self.pr.radiation,  self.pr.sed_type)
-                d = {'CO': [-1, 10], 'CI': [-1, 3], 'FeII': [-1, 13], 'H2': [-1, 3]}
-                for s in self.sp.keys():
-                    print(s)
-                    if s.startswith('CO'):
-                        d['CO'][0] = 0 if s[3:4].strip() == '' else max(d['CO'][0], int(s[3:4]))
-                        pars = ['T', 'n', 'f', 'CMB']
-                        self.pr = pyratio(z=self.z.val, radiation='full', sed_type='CMB')
-                    if s.startswith('CI'):
-                        d['CI'][0] = 0 if s[3:4].strip() == '' else max(d['CI'][0], int(s[3:4]))
-                        pars = ['T', 'n', 'f', 'rad', 'CMB']
-                    if 'FeII' in s:
-                        d['FeII'][0] = 0 if s[5:6].strip() == '' else max(d['FeII'][0], int(s[5:6]))
-                        pars = ['T', 'e', 'rad']
-                    if 'H2' in s:
-                        d['H2'][0] = 0 if s[3:4].strip() == '' else max(d['H2'][0], int(s[3:4]))
-                        pars = ['T', 'n', 'f', 'rad']
-                self.pr.set_pars(pars)
-                print(d)
-                for k, v in d.items():
-                    if v[0] > -1:
-                        self.pr.add_spec(k, num=v[1])
-            else:
-                self.pr = deepcopy(self.parent.sys[0].pr)
+            self.pyratio_init()
 
         #t.time('init')
         if self.pr is not None:
-            self.pr.pars['T'].value = self.logT.val
-            if 'n' in self.pr.pars.keys():
-                self.pr.pars['n'].value = self.logn.val
-            if 'e' in self.pr.pars.keys():
-                self.pr.pars['e'].value = self.logn.val
-            if 'f' in self.pr.pars.keys():
-                self.pr.pars['f'].value = self.logf.val
-            if 'rad' in self.pr.pars.keys():
-                self.pr.pars['rad'].value = self.rad.val
-            if 'CMB' in self.pr.pars.keys():
-                self.pr.pars['CMB'].value = self.CMB.val
+            values = {k: np.array([p.val]) for k, p in self.pyratio_pars().items()}
             for k in self.pr.species.keys():
-                col = self.pr.predict(name=k, level=-1, logN=self.Ntot.val)
+                x = self.populations(k, values)[0]
+                col = self.Ntot.val + np.log10(x / np.sum(x))
                 for s in self.sp.keys():
                     if k in s and 'Ntot' in self.sp[s].N.addinfo:
                         self.sp[s].N.val = col[self.pr.species[k].names.index(s)]
         #t.time('predict')
 
+    def pyratio_init(self):
+        """
+        Create pyratio object for the species of the system, it is set up by the first system and shared by the others
+        """
+        if self == self.parent.sys[0]:
+
+            self.pr = pyratio(z=self.z.val, pumping='simple', radiation='simple', sed_type=self.rad.addinfo)
+
+            #print('init', self.pr.pumping, self.pr.radiation,  self.pr.sed_type)
+            d = {'CO': [-1, 10], 'CI': [-1, 3], 'FeII': [-1, 13], 'H2': [-1, 3]}
+            for s in self.sp.keys():
+                print(s)
+                if s.startswith('CO'):
+                    d['CO'][0] = 0 if s[3:4].strip() == '' else max(d['CO'][0], int(s[3:4]))
+                    pars = ['T', 'n', 'f', 'CMB']
+                    self.pr = pyratio(z=self.z.val, radiation='full', sed_type='CMB')
+                if s.startswith('CI'):
+                    d['CI'][0] = 0 if s[3:4].strip() == '' else max(d['CI'][0], int(s[3:4]))
+                    pars = ['T', 'n', 'f', 'rad', 'CMB']
+                if 'FeII' in s:
+                    d['FeII'][0] = 0 if s[5:6].strip() == '' else max(d['FeII'][0], int(s[5:6]))
+                    pars = ['T', 'e', 'rad']
+                if 'H2' in s:
+                    d['H2'][0] = 0 if s[3:4].strip() == '' else max(d['H2'][0], int(s[3:4]))
+                    pars = ['T', 'n', 'f', 'rad']
+            self.pr.set_pars(pars)
+            print(d)
+            for k, v in d.items():
+                if v[0] > -1:
+                    self.pr.add_spec(k, num=v[1])
+        else:
+            self.pr = self.parent.sys[0].pr
+
+    def pyratio_pars(self):
+        """
+        return: dict of the fit parameters of the system that correspond to the pyratio parameters
+        """
+        d = {'T': 'logT', 'n': 'logn', 'e': 'logn', 'f': 'logf', 'rad': 'rad', 'CMB': 'CMB'}
+        return {k: getattr(self, d[k]) for k in self.pr.pars.keys() if k in d}
+
+    def populations(self, name, values):
+        """
+        Populations of the levels of the species by pyratio, calculated exactly by default.
+        If parent.pyratio_emulate is set, the populations are interpolated by the emulator tabulated over the ranges
+        of the varied (and tied) parameters, and the other parameters are fixed at their current values (see pyratio.emulate).
+        The emulators are cached by pyratio object, that is shared by all the systems.
+        parameters:
+            - name       :  name of the species
+            - values     :  dict of the columns of the pyratio parameter values
+        return: populations with shape (number of points, number of levels)
+        """
+        pars = self.pyratio_pars()
+        ranges = {k: [p.min, p.max] for k, p in pars.items() if p.vary or str(p) in self.parent.tieds.keys()}
+        fixed = {k: p.val for k, p in pars.items() if k not in ranges}
+        if self.parent.pyratio_emulate and len(ranges) > 0:
+            return self.pr.emulate(name, ranges, fixed=fixed)(values)
+        else:
+            return self.pr.balance_grid(name, values)
+
+    def pyratio_grid(self, V):
+        """
+        Column densities of the levels predicted by pyratio (for species with Ntot in N.addinfo) for the columns of the parameter values,
+        the same as pyratio() but calculated for all the points at once (see populations)
+        parameters:
+            - V          :  dict of the parameter columns (see fitPars.propagate)
+        return: dict of the columns of the predicted N
+        """
+        if self.pr is None:
+            self.pyratio_init()
+        if self.pr is None:
+            return {}
+        values = {k: V[str(p)] for k, p in self.pyratio_pars().items()}
+        out = {}
+        for k in self.pr.species.keys():
+            x = self.populations(k, values)
+            col = V[str(self.Ntot)][:, np.newaxis] + np.log10(x / np.sum(x, axis=1)[:, np.newaxis])
+            for s in self.sp.keys():
+                if k in s and 'Ntot' in self.sp[s].N.addinfo:
+                    out[str(self.sp[s].N)] = col[:, self.pr.species[k].names.index(s)]
+        return out
+
 
     def __str__(self):
         return '{:.6f} '.format(self.z.val) + str(self.sp)
@@ -435,6 +484,9 @@ class fitPars:
         self.disp_num = 0
         self.stack_num = 0
         self.tieds = {}
+        # interpolate the level populations of pyratio by the tabulated emulator instead of the exact calculation (see fitSystem.populations),
+        # it is copied from the option pyratio_emulate of the parent (GUI or batch session)
+        self.pyratio_emulate = bool(getattr(parent, 'pyratio_emulate', False))
 
     def add(self, name, addinfo=''):
         if name in 'mu':
@@ -745,6 +797,130 @@ class fitPars:
         return pars
 
 
+    def values(self):
+        """
+        Return the dictionary with current values of all parameters (used to find changed parameters)
+        """
+        return {k: p.val for k, p in self.pars().items()}
+
+    def changed(self, saved):
+        """
+        Return the set of the names of parameters, which values differ from saved ones (obtained by self.values()).
+        Since it is called after self.update(), the tied and derived parameters (b, N) are included.
+        """
+        return set(k for k, v in self.values().items() if saved.get(k) != v)
+
+    def dependency(self, names):
+        """
+        Return the parts of the model affected by the parameters with given names:
+            - 'lines'      : set of (system index, species), which line profiles should be recalculated
+            - 'cf'         : set of indices of covering factors
+            - 'cont'       : set of exposure indices, where continuum correction is changed
+            - 'disp'       : set of exposure indices, where dispersion correction is changed
+            - 'exp'        : set of exposure indices, which should be fully recalculated (e.g. resolution is changed)
+        """
+        deps = {'lines': set(), 'cf': set(), 'cont': set(), 'disp': set(), 'exp': set()}
+        for name in names:
+            s = name.split('_')
+            if s[0] == 'z' and int(s[1]) < len(self.sys):
+                deps['lines'].update((int(s[1]), sp) for sp in self.sys[int(s[1])].sp.keys())
+            elif s[0] in ['b', 'N']:
+                deps['lines'].add((int(s[1]), s[2]))
+            elif s[0] == 'cf':
+                deps['cf'].add(int(s[1]))
+            elif s[0] == 'cont':
+                deps['cont'].add(self.cont[int(s[1])].exp)
+            elif s[0] in ['displ', 'disps', 'dispz']:
+                deps['disp'].add(int(self.getValue(name, 'addinfo')[4:]))
+            elif s[0] == 'res':
+                deps['exp'].add(int(self.getValue(name, 'addinfo')[4:]))
+        return deps
+
+    def derivatives(self, names, eps=1e-6):
+        """
+        Return the derivatives of the line profile parameters (z, b and N of each system and species) with respect to the given parameters.
+        They are calculated by finite differences through self.update(), i.e. taking into account the tied and derived parameters
+        (e.g. b from turb and kin, N from metallicity or from pyratio).
+        Returns dictionary {name: {profile parameter name: derivative}}, where only non-zero derivatives are included.
+        """
+        prim = lambda: {k: p.val for k, p in self.pars().items() if k.split('_')[0] in ['z', 'b', 'N']}
+        self.update(redraw=False)
+        v0 = prim()
+        d = {}
+        for name in names:
+            p = self.getPar(name)
+            val, h = p.val, eps * max(1, abs(p.val))
+            p.val = val + h
+            self.update(redraw=False)
+            d[name] = {k: (v - v0[k]) / h for k, v in prim().items() if v != v0[k]}
+            p.val = val
+        self.update(redraw=False)
+        return d
+
+    def derivation(self):
+        """
+        Compile the derivation graph of the tied and derived parameters, i.e. the same sequence of operations as done by self.update():
+        b from other species or from turb and kin ('consist'), N from pyratio (Ntot), N from metallicity and isotopic ratios and tieds.
+        Each operation works on the columns of the parameter values, so it can be applied to the whole MCMC chain at once (see propagate).
+        return: ops
+            - ops         :  list of functions f(V), that take dict of the parameter columns and return dict of the derived columns
+        """
+        ops = []
+        for sys in self.sys:
+            for k, s in sys.sp.items():
+                name = str(s.b)
+                if s.b.addinfo != '' and s.b.addinfo != 'consist':
+                    ops.append(lambda V, name=name, src=str(sys.sp[s.b.addinfo].b): {name: V[src]})
+                elif s.b.addinfo == 'consist':
+                    ops.append(lambda V, name=name, k=k, turb=str(sys.turb), kin=str(sys.kin): {name: doppler(k, V[turb], V[kin])})
+
+            if hasattr(sys, 'Ntot'):
+                # pyratio object is created when the operation is applied (see pyratio_grid), not at the compilation
+                ops.append(lambda V, sys=sys: sys.pyratio_grid(V))
+
+            for k, s in sys.sp.items():
+                name = str(s.N)
+                if 'me' in s.N.addinfo and 'HI' in sys.sp.keys():
+                    if any([sp not in k for sp in ['DI', '13C']]) and self.me_num > 0:
+                        ops.append(lambda V, name=name, HI=str(sys.sp['HI'].N), me=s.N.addinfo, d=abundance(k, 0.0, 0.0): {name: V[HI] + V[me] + d})
+                if s.N.addinfo == 'iso':
+                    if self.iso.addinfo == 'D/H' and 'HI' in sys.sp.keys():
+                        if 'DI' in k:
+                            ops.append(lambda V, name=name, src=str(sys.sp['HI'].N): {name: V[src] + V['iso']})
+                    if self.iso.addinfo == '13C/12C':
+                        if '13CI' in k and k.replace('13', '') in sys.sp.keys():
+                            ops.append(lambda V, name=name, src=str(sys.sp[k.replace('13', '')].N): {name: V[src] + V['iso']})
+
+        for k, v in self.tieds.items():
+            p = self.getPar(k)
+            ops.append(lambda V, k=k, v=v, p=p: {k: np.clip(V[v], p.min, p.max)})
+
+        return ops
+
+    def propagate(self, names, samples, ops=None):
+        """
+        Calculate the values of all parameters for the set of samples of the fitted parameters,
+        the same as setValue() of each sample followed by update(), but vectorized over the samples.
+        The current values of the parameters are not changed.
+        parameters:
+            - names       :  names of the parameters in columns of samples
+            - samples     :  array of shape (n_samples, len(names))
+            - ops         :  derivation graph from self.derivation(), if None it is compiled
+        return: values
+            - values      :  array of shape (n_samples, len(self.list())), columns in the order of self.list()
+        """
+        samples = np.atleast_2d(samples)
+        pars = self.pars()
+        V = OrderedDict((k, np.full(samples.shape[0], float(p.val))) for k, p in pars.items())
+        for i, name in enumerate(names):
+            p = self.getPar(name)
+            V[str(p)] = np.clip(samples[:, i].astype(float), p.min, p.max)
+
+        for op in (self.derivation() if ops is None else ops):
+            V.update(op(V))
+
+        return np.column_stack(list(V.values()))
+
     def list_total(self):
         pars = OrderedDict()
         for sys in self.sys:
@@ -782,7 +958,8 @@ class fitPars:
         if 'cf' in s[0]:
             self.cf_fit = True
             attrs = ['val', 'left', 'right', 'step', 'vary', 'addinfo']
-            self.parent.plot.add_pcRegion()
+            if hasattr(self.parent, 'plot'):
+                self.parent.plot.add_pcRegion()
 
         if 'disp' in s[0]:
             self.disp_num = max(self.disp_num, int(s[0][6:]) + 1)
@@ -797,7 +974,7 @@ class fitPars:
             if attr == 'addinfo' and 'cont_' in s[0]:
                 self.cont[int(s[0].split('_')[1])].fromInfo(val)
 
-        if 'cf' in s[0]:
+        if 'cf' in s[0] and hasattr(self.parent, 'plot'):
             self.parent.plot.pcRegions[-1].updateFromFit()
 
     def showLines(self, sp=None):
@@ -864,77 +1041,490 @@ class spectra(list):
     def __init__(self):
         super(spectra).__init__()
 
-    def set_lines(self):
-        for s in self:
-            s.set_lines()
+    def set_lines(self, lines):
+        for s, l in zip(self, lines):
+            s.set_lines(l)
 
 class spec:
-    def __init__(self, parent, x, y, err):
+    """
+    GUI-free (and picklable) copy of the exposure, which is used to calculate the fit model, e.g. in the worker processes.
+    The model is calculated in the normalized view, using batched calculation of optical depths, on the grid
+    of 'regular' or 'fast'/'vector' fit types (see fit_type in calc()).
+    """
+    def __init__(self, parent, x, y, err, mask=None, resolution=None, ind=0):
+        self.parent = parent
         self.x = x
         self.y = y
         self.err = err
+        self.mask = mask if mask is not None else np.ones_like(x, dtype=bool)
+        self.resolution = resolution
+        self.ind = ind
         self.fit = None
+        self.set_lines([])
 
-    def set_lines(self, tlim=0.01, all=True, debug=False):
-        """
-        Function to prepare lines to fit.
-          - ind         : specify component to fit
-          - all         : if all then look for all the lines located in the  normalized spectrum
-
-        Prepared lines where fit will be calculated are stored in self.fit_lines list.
-        """
-        self.fit_lines = []
-
-        if self.x.shape[0] > 0:
-            for sys in self.fit.sys:
-                for sp in sys.sp.keys():
-                    lin = self.parent.atomic.list(sp)
-                    for l in lin:
-                        l.b = sys.sp[sp].b.val
-                        l.logN = sys.sp[sp].N.val
-                        l.z = sys.z.val
-                        l.recalc = True
-                        l.sys = sys.ind
-                        l.range = tau(l, resolution=self.resolution).getrange(tlim=tlim)
-                        l.cf = -1
-                        if self.parent.fit.cf_fit:
-                            for i in range(self.parent.fit.cf_num):
-                                cf = getattr(self.parent.fit, 'cf_' + str(i))
-                                cf_sys = cf.addinfo.split('_')[0]
-                                cf_exp = cf.addinfo.split('_')[1] if len(cf.addinfo.split('_')) > 1 else 'all'
-                                if (cf_sys == 'all' or sys.ind == int(cf_sys[3:])) and (
-                                                cf_exp == 'all' or self.ind() == int(cf_exp[3:])) and l.l() * (
-                                            1 + l.z) > cf.min and l.l() * (1 + l.z) < cf.max:
-                                    l.cf = i
-                        if all:
-                            if any([x[0] < p < x[-1] for p in l.range]):
-                                self.fit_lines += [l]
-                        else:
-                            if np.sum(np.where(np.logical_and(x >= l.range[0], x <= l.range[1]))) > 0:
-                                self.fit_lines += [l]
-        if debug:
-            print('findFitLines', self.fit_lines, [l.cf for l in self.fit_lines])
-
-    def chi(self):
-        pass
+    def set_lines(self, lines):
+        """
+        Set the lines to calculate the fit model.
+          - lines       : list of the lines (from atomic), with sys and cf attributes, as in Spectrum.fit_lines
+        """
+        self.lines = [(line.sys, line.name.split()[0]) for line in lines]
+        self.l, self.f, self.g = np.array([[line.l(), line.f(), line.g()] for line in lines], dtype=float).reshape(-1, 3).T
+        self.cf = np.array([line.cf for line in lines], dtype=int)
+
+    def correctContinuum(self, x, fit):
+        corr = np.ones_like(x)
+        for k, c in enumerate(fit.cont):
+            if c.exp == self.ind:
+                mask = (x > c.left) * (x < c.right)
+                if len(x[mask]) > 0:
+                    cheb = np.array([getattr(fit, 'cont_' + str(k) + '_' + str(i)).val for i in range(c.num)])
+                    corr[mask] = np.polynomial.chebyshev.chebval((x[mask] - c.left) * 2 / (c.right - c.left) - 1, cheb)
+        return corr
+
+    def regular_grid(self, l, f, g, logN, b, z, tau_limit=0.01):
+        """
+        Number of points added between the pixels as in 'regular' fit type (see Spectrum.calcFit and tau.grid_spec):
+        3 points within the line range extended by instrument function, and 1/5 of the line width
+        (but not coarser than instrument function) in the line core.
+        """
+        n = self.mask.astype(int)
+        xmin, xmax = lines_range(l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit, instr=3)
+        cmin, cmax = lines_range(l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit, instr=0)
+        delta = l * (1 + z) * b / 299792.458 / 5 * np.minimum(1.0 / self.resolution / 2.355 / b * 299792.458, 1)
+        for i in range(len(l)):
+            m = np.zeros_like(n)
+            m[max(np.searchsorted(self.x, xmin[i]) - 1, 0):min(np.searchsorted(self.x, xmax[i]) + 1, self.x.shape[0])] = 3
+            i_s, i_e = max(np.searchsorted(self.x, cmin[i]) - 1, 0), min(np.searchsorted(self.x, cmax[i]) + 1, self.x.shape[0])
+            m[i_s:i_e - 1] = np.round(np.diff(self.x[i_s:i_e]) / delta[i]) + 1
+            n = np.maximum(n, m)
+        return n
+
+    def calc(self, fit, num_between=3, tau_limit=0.01, voigt_calc='spec', sys=None, fit_type='vector'):
+        """
+        Calculate the fit model for the given parameters.
+          - fit         : fitPars object
+          - num_between : number of points to add between spectral pixels
+          - tau_limit   : limit of optical depth to cutoff the line (set the range of calculations)
+          - voigt_calc  : calculation of Voigt function: 'spec' - direct (wofz), 'table' - table driven
+          - sys         : index of the system to calculate the model of the single component, if None all lines are used
+          - fit_type    : 'regular' - grid of the line profiles is set by their widths (see regular_grid),
+                          'fast' or 'vector' - num_between points between pixels within the line ranges
+        return: x, flux
+          - x           : wavelength grid of the model
+          - flux        : normalized flux
+        """
+        m = np.array([sys is None or s == sys for s, sp in self.lines], dtype=bool)
+        logN, b, z = np.array([[fit.sys[s].sp[sp].N.val, fit.sys[s].sp[sp].b.val, fit.sys[s].z.val] for s, sp in self.lines], dtype=float).reshape(-1, 3)[m].T
+        l, f, g = self.l[m], self.f[m], self.g[m]
+        cfs = self.cf[m] if fit.cf_fit else -np.ones_like(self.cf[m])
+        ngroups = fit.cf_num + 1 if fit.cf_fit else 1
+
+        if self.resolution not in [None, 0] and fit_type == 'regular':
+            x = makegrid(self.x, self.regular_grid(l, f, g, logN, b, z, tau_limit=tau_limit))
+        elif self.resolution not in [None, 0]:
+            xmin, xmax = lines_range(l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit)
+            mask = np.zeros(self.x.shape[0] + 1, dtype=int)
+            np.add.at(mask, np.searchsorted(self.x, xmin, side='right'), 1)
+            np.add.at(mask, np.searchsorted(self.x, xmax, side='left'), -1)
+            x = makegrid(self.x, (np.cumsum(mask[:-1]) > 0).astype(int) * num_between)
+        else:
+            x = self.x
+
+        profiles = calctau_lines(x, l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit, groups=cfs + 1, ngroups=ngroups, calc=voigt_calc)
+        flux = profiles[0]
+        for i in np.unique(cfs[cfs > -1]):
+            cf = fit.getValue('cf_' + str(i))
+            flux += - np.log(np.exp(-profiles[i + 1]) * cf + (1 - cf))
+        flux = np.exp(-flux)
+
+        if self.resolution not in [None, 0]:
+            flux = convolveflux(x, flux, self.resolution, kind='direct')
+
+        if fit.cont_fit and fit.cont_num > 0:
+            flux = flux * self.correctContinuum(x, fit)
+
+        for i in range(fit.disp_num):
+            if getattr(fit, 'displ_' + str(i)).addinfo == 'exp_' + str(self.ind):
+                flux = np.interp(x, x + (x - getattr(fit, 'displ_' + str(i)).val) * getattr(fit, 'disps_' + str(i)).val + getattr(fit, 'dispz_' + str(i)).val, flux, left=1, right=1)
+
+        return x, flux
+
+    def chi(self, fit, num_between=3, tau_limit=0.01, voigt_calc='spec', fit_type='vector'):
+        if self.x.shape[0] > 0 and np.sum(self.mask) > 0:
+            x, flux = self.calc(fit, num_between=num_between, tau_limit=tau_limit, voigt_calc=voigt_calc, fit_type=fit_type)
+            return (self.y[self.mask] - np.interp(self.x[self.mask], x, flux, left=1, right=1)) / self.err[self.mask]
+        else:
+            return np.asarray([])
 
 class calc_fit:
-    def __init__(self, parent):
+    """
+    GUI-free (and picklable) likelihood of the absorption line fit, constructed from fitPars and the data of the exposures.
+    It can be sent to the worker processes (see init_worker and lnprob_worker) to calculate likelihood in parallel, e.g. for emcee.
+    The fit type ('regular', 'fast' or 'vector', as set in GUI) defines the grid of the model (see spec.calc),
+    the others ('fft', 'julia') are not available without GUI and are replaced by 'vector'.
+    """
+    def __init__(self, parent=None, num_between=3, tau_limit=0.01, voigt_calc='spec', fit_type='vector'):
         self.parent = parent
+        self.num_between = num_between
+        self.tau_limit = tau_limit
+        self.voigt_calc = voigt_calc
+        if fit_type not in ['regular', 'fast', 'vector']:
+            print("fit type '{0}' is not available in the headless fit model, 'vector' is used".format(fit_type))
+            fit_type = 'vector'
+        self.fit_type = fit_type
+        self.s = spectra()
+        self.fit = None
+        self.pars = []
+        self.priors = {}
 
     def set_data(self, data):
-        self.s = spectra(self)
-        for d in data:
-            self.s.append(spec(self, d[0], d[1], d[2]))
+        """
+        Set the data of the exposures.
+          - data        : list of tuples (x, y, err) or (x, y, err, mask, resolution, lines),
+                          or Speclist, which lines are already prepared (see Speclist.prepareFit)
+        """
+        self.s = spectra()
+        for i, d in enumerate(data):
+            if isinstance(d, (tuple, list)):
+                self.s.append(spec(self, *d[:3], mask=d[3] if len(d) > 3 else None, resolution=d[4] if len(d) > 4 else None, ind=i))
+                if len(d) > 5:
+                    self.s[-1].set_lines(d[5])
+            else:
+                mask = d.fit_mask.norm.x if d.fit_mask is not None and d.fit_mask.norm.n == d.spec.norm.n else np.zeros(d.spec.norm.n, dtype=bool)
+                self.s.append(spec(self, np.copy(d.spec.norm.x), np.copy(d.spec.norm.y), np.copy(d.spec.norm.err), mask=np.copy(mask), resolution=d.resolution, ind=i))
+                self.s[-1].set_lines(d.fit_lines if hasattr(d, 'fit_lines') else [])
 
     def set_model(self, pars, fit=None):
+        """
+        Set the fit model.
+          - pars        : list of the names of the sampled parameters
+          - fit         : fitPars object, which is copied without the reference to the parent (GUI)
+        """
         if fit is None:
-            self.fit = fitPars(self.parent)
+            self.fit = fitPars(self)
             self.fit.readPars(pars)
         else:
-            self.fit = fit
-
-    def set_lines(self, lines):
-        self.lines = lines
-
-
+            parent, fit.parent = fit.parent, None
+            try:
+                self.fit = deepcopy(fit)
+            finally:
+                fit.parent = parent
+            self.fit.parent = self
+        self.pars = [str(p) for p in pars]
+
+    def find_lines(self, atomic, tlim=0.01):
+        """
+        Find the lines to fit in each exposure (headless counterpart of Spectrum.findFitLines with all=True).
+          - atomic      : atomicData object
+          - tlim        : limit of optical depth to cutoff the line
+        """
+        for s in self.s:
+            lines = []
+            if s.x.shape[0] > 0:
+                for sys in self.fit.sys:
+                    for sp in sys.sp.keys():
+                        t = atomic.select(sp, s.x[0] / (1 + sys.z.val), s.x[-1] / (1 + sys.z.val))
+                        ranges = np.transpose(lines_range(t['l'], t['f'], t['g'], sys.sp[sp].N.val, sys.sp[sp].b.val, sys.z.val, resolution=s.resolution, tlim=tlim)).reshape(-1, 2)
+                        m = (s.x[0] < np.sum(ranges, axis=1) / 2) * (np.sum(ranges, axis=1) / 2 < s.x[-1])
+                        for l, r in zip(atomic.make_lines(sp, t[m]), ranges[m]):
+                            if str(l) not in sys.exclude:
+                                l.sys, l.cf = sys.ind, -1
+                                if self.fit.cf_fit:
+                                    for i in range(self.fit.cf_num):
+                                        cf = getattr(self.fit, 'cf_' + str(i))
+                                        cf_sys = np.arange(len(self.fit.sys)) if cf.addinfo.split('_')[0] == 'all' else [int(k) for k in cf.addinfo.split('_')[0].split('sys')[1:]]
+                                        cf_exp = cf.addinfo.split('_')[1] if len(cf.addinfo.split('_')) > 1 else 'all'
+                                        if (sys.ind in cf_sys) and (cf_exp == 'all' or s.ind == int(cf_exp[3:])) and cf.left < l.l() * (1 + sys.z.val) < cf.right:
+                                            l.cf = i
+                                lines.append(l)
+            s.set_lines(lines)
+
+    def set_priors(self, priors):
+        self.priors = {k: v for k, v in priors.items() if k in self.pars}
+
+    def chi(self, x=None):
+        if x is not None:
+            for v, p in zip(x, self.pars):
+                self.fit.setValue(p, v)
+            self.fit.update(redraw=False)
+        return np.concatenate([s.chi(self.fit, num_between=self.num_between, tau_limit=self.tau_limit, voigt_calc=self.voigt_calc, fit_type=self.fit_type) for s in self.s] + [np.asarray([])])
+
+    def lnprior(self, x):
+        return np.sum([v.lnL(x[self.pars.index(k)]) for k, v in self.priors.items()])
+
+    def predict(self, x, grids):
+        """
+        Calculate the models of the exposures on the given grids for the values of the sampled parameters
+          - x           : values of the parameters (in order of self.pars)
+          - grids       : list of the wavelength grids for each exposure (can be empty)
+        return: list of arrays for each exposure with shape (2 + number of systems, len(grid)), the rows are:
+                total model, continuum correction, and the models of the individual components (systems)
+        """
+        for v, p in zip(x, self.pars):
+            self.fit.setValue(p, v)
+        self.fit.update(redraw=False)
+        out = []
+        for s, grid in zip(self.s, grids):
+            m = np.ones((2 + len(self.fit.sys), len(grid)))
+            if len(grid) > 0 and len(s.lines) > 0:
+                for k in [None] + list(range(len(self.fit.sys))):
+                    if k is None or any([line[0] == k for line in s.lines]):
+                        xm, flux = s.calc(self.fit, num_between=self.num_between, tau_limit=self.tau_limit, voigt_calc=self.voigt_calc, sys=k, fit_type=self.fit_type)
+                        m[0 if k is None else k + 2] = np.interp(grid, xm, flux, left=1, right=1)
+                if self.fit.cont_fit and self.fit.cont_num > 0:
+                    m[1] = s.correctContinuum(grid, self.fit)
+            out.append(m)
+        return out
+
+    def profile(self, x, nuisance=None):
+        """
+        Profile likelihood at the given values of the parameters: the nuisance parameters are optimized (by least squares),
+        starting from their current values, i.e. from the optimum at the previous point.
+          - x           : values of the parameters (in order of self.pars)
+          - nuisance    : list of the names of the nuisance parameters, if None they are fixed.
+                          The parameters with min == max or zero step are fixed at their current values
+        return: lnL, values
+          - lnL         : log likelihood, -chi2 / 2
+          - values      : optimized values of the nuisance parameters
+        """
+        for v, p in zip(x, self.pars):
+            self.fit.setValue(p, v, check=False)
+        self.fit.update(redraw=False)
+        nuisance = nuisance if nuisance is not None else []
+        # the parameters with zero range or step can not be optimized (least_squares requires min < max), they are kept fixed
+        free = [p for p in nuisance if self.fit.getValue(p, 'min') < self.fit.getValue(p, 'max') and self.fit.getValue(p, 'step') > 0]
+        if len(free) > 0:
+            lo, hi, step = np.array([[self.fit.getValue(p, attr) for attr in ['min', 'max', 'step']] for p in free], dtype=float).T
+
+            def residuals(y):
+                for v, p in zip(y, free):
+                    self.fit.setValue(p, v, check=False)
+                self.fit.update(redraw=False)
+                return np.nan_to_num(self.chi(), nan=0.0)
+
+            y0 = np.clip([self.fit.getValue(p) for p in free], lo, hi)
+            res = least_squares(residuals, y0, bounds=(lo, hi), x_scale=step)
+            residuals(res.x)
+        return -0.5 * np.sum(self.chi() ** 2), np.array([self.fit.getValue(p) for p in nuisance], dtype=float)
+
+    def lnlike(self, x):
+        for v, p in zip(x, self.pars):
+            if not self.fit.setValue(p, v):
+                return -np.inf
+        self.fit.update(redraw=False)
+        chi2 = np.sum(self.chi() ** 2)
+        return -0.5 * chi2 if not np.isnan(chi2) else -np.inf
+
+    def __call__(self, x):
+        lp = self.lnlike(x)
+        return lp + self.lnprior(x) if np.isfinite(lp) else -np.inf
+
+# likelihood, which is set once in each worker process, so it is not pickled on every call
+_calc_fit = None
+
+def init_worker(lnL):
+    global _calc_fit
+    _calc_fit = lnL
+
+def lnprob_worker(x):
+    return _calc_fit(x)
+
+def predict_worker(args):
+    xs, grids = args
+    return [np.asarray(m) for m in zip(*[_calc_fit.predict(x, grids) for x in xs])]
+
+def profile_worker(args):
+    xs, nuisance = args
+    res = [_calc_fit.profile(x, nuisance=nuisance) for x in xs]
+    return np.array([r[0] for r in res]), np.array([r[1] for r in res]).reshape(len(xs), -1)
+
+def profile_likelihood(lnL, grid, nuisance=None, threads=1, batch=10, callback=None):
+    """
+    Profile likelihood on the grid of the parameter values, calculated by the headless model.
+    The grid points are independent, so they are sent to the processes in batches. Within the batch (and process)
+    the nuisance parameters are optimized starting from the optimum at the previous point, so neighbouring points are better in the same batch.
+    parameters:
+        - lnL         : calc_fit object with data and model set, lnL.pars are the scanned parameters
+        - grid        : array of the parameter values with shape (number of points, len(lnL.pars))
+        - nuisance    : list of the names of the nuisance parameters, which are optimized in each point, if None they are fixed.
+                        The parameters with min == max or zero step are fixed (see calc_fit.profile)
+        - threads     : number of processes
+        - batch       : number of points in the batch sent to the process
+        - callback    : function callback(done, L), called after each batch, with the number of calculated points
+                        and the array of lnL, which is filled progressively (nan for the points yet to calculate)
+    return: L, values
+        - L           : array of log likelihood, -chi2 / 2, in the grid points
+        - values      : array of the optimized nuisance parameters with shape (number of points, len(nuisance))
+    """
+    nuisance = list(nuisance) if nuisance is not None else []
+    grid = np.asarray(grid, dtype=float).reshape(len(grid), -1)
+    num = grid.shape[0]
+    L, values = np.full(num, np.nan), np.full((num, len(nuisance)), np.nan)
+    chunks = [(grid[i:i + batch], nuisance) for i in range(0, num, batch)]
+    if threads > 1:
+        pool = Pool(threads, initializer=init_worker, initargs=(lnL,))
+        try:
+            res = pool.imap(profile_worker, chunks)
+            for i, r in zip(range(0, num, batch), res):
+                L[i:i + batch], values[i:i + batch] = r
+                if callback is not None:
+                    callback(min(i + batch, num), L)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        # the scan is made in this process on lnL itself, so the values of the parameters are restored after it
+        saved = [(p, lnL.fit.getValue(p)) for p in list(lnL.pars) + nuisance]
+        init_worker(lnL)
+        try:
+            for i, c in zip(range(0, num, batch), chunks):
+                L[i:i + batch], values[i:i + batch] = profile_worker(c)
+                if callback is not None:
+                    callback(min(i + batch, num), L)
+        finally:
+            for p, v in saved:
+                lnL.fit.setValue(p, v, check=False)
+            lnL.fit.update(redraw=False)
+    return L, values
+
+def boot_worker(args):
+    seeds, snr, truth, noise = args
+    lnL = _calc_fit
+    for v, p in zip(truth, lnL.pars):
+        lnL.fit.setValue(p, v, check=False)
+    lnL.fit.update(redraw=False)
+    models = []
+    for s in lnL.s:
+        if s.x.shape[0] > 0 and len(s.lines) > 0:
+            x, flux = s.calc(lnL.fit, num_between=lnL.num_between, tau_limit=lnL.tau_limit, voigt_calc=lnL.voigt_calc, fit_type=lnL.fit_type)
+            models.append(np.interp(s.x, x, flux, left=1, right=1))
+        else:
+            models.append(np.ones_like(s.x))
+    step = np.array([lnL.fit.getValue(p, 'step') for p in lnL.pars], dtype=float)
+    lo, hi = np.array([[lnL.fit.getValue(p, attr) for attr in ['min', 'max']] for p in lnL.pars], dtype=float).T
+    saved = [(s.y, s.err) for s in lnL.s]
+    res = []
+    try:
+        for seed in seeds:
+            rng = np.random.default_rng(seed)
+            for s, m, (y, err) in zip(lnL.s, models, saved):
+                s.err = np.full_like(m, 1.0 / snr) if snr is not None else err
+                s.y = m + rng.normal(size=m.shape) * s.err if noise else np.copy(m)
+            for v, p in zip(np.clip(np.asarray(truth) + rng.normal(size=len(truth)) * step, lo, hi), lnL.pars):
+                lnL.fit.setValue(p, v, check=False)
+            L, values = lnL.profile([], nuisance=lnL.pars)
+            res.append(np.append(values, -2 * L))
+    finally:
+        for s, (y, err) in zip(lnL.s, saved):
+            s.y, s.err = y, err
+    return np.array(res).reshape(len(seeds), len(lnL.pars) + 1)
+
+def bootstrap(lnL, num, snr=None, noise=True, seed=None, threads=1, batch=10, filename=None, callback=None):
+    """
+    Monte Carlo bootstrap of the fit by the headless model: synthetic spectra are generated from the model at the current
+    values of the parameters (on the grids, with the resolutions and fitting masks of the exposures of lnL) with gaussian noise,
+    and fitted (by least squares from the shaken initial values, see fitPars.shake) in the batches in parallel.
+    Each realization has its own random generator (spawned from seed), so the results do not depend on the number of processes.
+    parameters:
+        - lnL         : calc_fit object with data and model set, lnL.pars are the fitted parameters
+        - num         : number of realizations
+        - snr         : signal to noise ratio of the synthetic spectra, if None the uncertainties of the exposures are used
+        - noise       : if False, the synthetic spectra are noise-free (the realizations differ only by the initial values),
+                        the uncertainties are used only as the weights of the fit
+        - seed        : seed of the random generator
+        - threads     : number of processes
+        - batch       : number of realizations in the batch sent to the process
+        - filename    : name of the hdf5 file to write the results (one dataset per parameter and chi2, with true values in attrs),
+                        it is written after each batch, so the results are kept if the run is interrupted
+        - callback    : function callback(done, rate), called after each batch, with the number of done realizations and throughput (per second)
+    return: res
+        - res         : array with shape (num, len(lnL.pars) + 1) of the fitted values and chi2
+    """
+    truth = [lnL.fit.getValue(p) for p in lnL.pars]
+    seeds = np.random.SeedSequence(seed).spawn(num)
+    res = np.full((num, len(lnL.pars) + 1), np.nan)
+    chunks = [(seeds[i:i + batch], snr, truth, noise) for i in range(0, num, batch)]
+    names = list(lnL.pars) + ['chi2']
+
+    f = None
+    if filename is not None:
+        import h5py
+        f = h5py.File(filename, 'w')
+        f.attrs['snr'] = snr if snr is not None else np.nan
+        f.attrs['noise'] = noise
+        f.attrs['pars'] = [p.encode() for p in lnL.pars]
+        for name, v in zip(names, truth + [np.nan]):
+            f.create_dataset(name, shape=(num,), dtype=float, fillvalue=np.nan)
+            f[name].attrs['truth'] = v
+
+    start = time.time()
+
+    def collect(i, r):
+        res[i:i + batch] = r
+        if f is not None:
+            for k, name in enumerate(names):
+                f[name][i:i + len(r)] = r[:, k]
+            f.flush()
+        if callback is not None:
+            done = min(i + batch, num)
+            callback(done, done / max(time.time() - start, 1e-9))
+
+    try:
+        if threads > 1:
+            pool = Pool(threads, initializer=init_worker, initargs=(lnL,))
+            try:
+                for i, r in zip(range(0, num, batch), pool.imap(boot_worker, chunks)):
+                    collect(i, r)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_worker(lnL)
+            for i, c in zip(range(0, num, batch), chunks):
+                collect(i, boot_worker(c))
+    finally:
+        if f is not None:
+            f.close()
+        for v, p in zip(truth, lnL.pars):
+            lnL.fit.setValue(p, v, check=False)
+        lnL.fit.update(redraw=False)
+    return res
+
+def predictive_bands(lnL, samples, grids, conf=0.683, threads=1, batch=10):
+    """
+    Posterior predictive bands of the fit model (and its components and continuum correction), calculated by the headless model.
+    The samples are evaluated in batches (in parallel, if threads > 1), the models are collected to preallocated arrays
+    and the bands are obtained by partial sort (np.partition) at the two ranks.
+    parameters:
+        - lnL         : calc_fit object with data and model set
+        - samples     : array of the parameter values with shape (number of samples, len(lnL.pars))
+        - grids       : list of the wavelength grids for each exposure
+        - conf        : confidence level of the band
+        - threads     : number of processes
+        - batch       : number of samples in the batch sent to the process
+    return: bands
+        - bands       : list for each exposure of arrays with shape (2, 2 + number of systems, len(grid)): the lower and upper bounds
+                        of total model, continuum correction, and the models of the components (see calc_fit.predict)
+    """
+    num = samples.shape[0]
+    models = [np.empty((num, 2 + len(lnL.fit.sys), len(g)), dtype=np.float32) for g in grids]
+    chunks = [(samples[i:i + batch], grids) for i in range(0, num, batch)]
+    if threads > 1:
+        pool = Pool(threads, initializer=init_worker, initargs=(lnL,))
+        try:
+            res = pool.imap(predict_worker, chunks)
+            for i, r in zip(range(0, num, batch), res):
+                for m, ri in zip(models, r):
+                    m[i:i + batch] = ri
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_worker(lnL)
+        for i, c in zip(range(0, num, batch), chunks):
+            for m, ri in zip(models, predict_worker(c)):
+                m[i:i + batch] = ri
+
+    q = int((1 - conf) / 2 * num)
+    ranks = [q, min(num - q, num - 1)]
+    return [np.partition(m, ranks, axis=0)[ranks] for m in models]
@@ -10,9 +10,9 @@ from astropy.io import fits
 from astropy.modeling.models import Moffat1D
 from astropy.table import Table
 from ccdproc import cosmicray_lacosmic
-import itertools
 from matplotlib import cm
 import matplotlib.pyplot as plt
+from multiprocessing import Pool
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 import os
@@ -24,12 +24,13 @@ from PyQt6.QtWidgets import QApplication
 import re
 from skimage.filters.rank import median
 from scipy.interpolate import interp1d, interp2d, splrep, splev
+from scipy.ndimage import binary_dilation, correlate
 from scipy.integrate import cumtrapz
 from scipy.optimize import curve_fit, least_squares
 from scipy.signal import savgol_filter, lombscargle, medfilt
 from scipy.stats import gaussian_kde
 
-from ..profiles import tau, convolveflux, makegrid, add_ext
+from ..profiles import tau, Voigt, convolveflux, convolve_res2_update, makegrid, add_ext, calctau_lines, lines_a_tau0, lines_range, tau_lines_sparse
 from .external import sg_smooth as sg
 from .utils import Timer, MaskableList, moffat_func, smooth, fetch_COS_files
 
@@ -171,6 +172,9 @@ class Speclist(list):
                     elif self.parent.fitType == 'fast':
                         s.calcFit_fast(ind=ind, recalc=recalc, redraw=redraw, num_between=self.parent.num_between, tau_limit=self.parent.tau_limit, timer=timer)
 
+                    elif self.parent.fitType == 'vector':
+                        s.calcFit_vector(ind=ind, recalc=recalc, redraw=redraw, num_between=self.parent.num_between, tau_limit=self.parent.tau_limit, timer=timer)
+
                     elif self.parent.fitType == 'julia':
                         s.calcFit_julia(comp=ind, recalc=recalc, redraw=redraw, tau_limit=self.parent.tau_limit, timer=timer)
 
@@ -195,6 +199,9 @@ class Speclist(list):
                     elif self.parent.fitType == 'fast':
                         s.calcFit_fast(ind=sys.ind, recalc=recalc, num_between=self.parent.num_between, tau_limit=self.parent.tau_limit)
 
+                    elif self.parent.fitType == 'vector':
+                        s.calcFit_vector(ind=sys.ind, recalc=recalc, num_between=self.parent.num_between, tau_limit=self.parent.tau_limit)
+
                     elif self.parent.fitType == 'julia':
                         s.calcFit_julia(comp=sys.ind, recalc=recalc, tau_limit=self.parent.tau_limit, timer=False)
 
@@ -230,6 +237,13 @@ class Speclist(list):
                 chi = np.append(chi, s.chi())
         return chi
 
+    def chiDeriv(self, names, exp_ind=-1):
+        deriv = np.zeros((0, len(names)))
+        for i, s in enumerate(self):
+            if exp_ind in [-1, i]:
+                deriv = np.append(deriv, s.calcFitDeriv(names, tau_limit=self.parent.tau_limit), axis=0)
+        return deriv
+
     def selectCosmics(self):
         for i, s in enumerate(self):
             if i != self.ind:
@@ -809,6 +823,70 @@ class image():
             y1, y2 = (np.abs(self.y - rect[1][0])).argmin(), (np.abs(self.y - rect[1][1])).argmin()
             self.mask[y1:y2+1, x1:x2+1] = int(add)
 
+moffat = moffat_func()
+
+def moffat_profiles(y, x_0, gamma, kind='pdf', bins=10):
+    """
+    Moffat profiles of the trace integrated over the pixels of the slit, calculated for the set of columns at once
+    parameters:
+        - y         : centers of the pixels along the slit, shape(n)
+        - x_0       : positions of the trace, shape(m)
+        - gamma     : scales of Moffat function, shape(m)
+        - kind      : 'pdf' - integration of the pdf over <bins> subpixels, or 'cdf' - difference of cdf at the pixels
+    return:
+        - profiles  : shape(n, m) (shape(n-1, m) for 'cdf', the same as in spec2d.moffat_fit_integ)
+    """
+    x_0, gamma = np.atleast_1d(x_0)[np.newaxis, :], np.atleast_1d(gamma)[np.newaxis, :]
+    if kind == 'cdf':
+        return np.diff(moffat.cdf(y[:, np.newaxis], loc=x_0, scale=gamma), axis=0)
+    elif kind == 'pdf':
+        ybin = np.concatenate([[y[0] - (y[1] - y[0]) / 2], (y[:-1] + y[1:]) / 2, [y[-1] + (y[-1] - y[-2]) / 2]])
+        yt = np.concatenate([np.linspace(ybin[i], ybin[i + 1], bins if bins % 2 else bins + 1)[:-1] + 0.0001 for i in range(len(ybin) - 1)] + [[ybin[-1]]])
+        ind = np.concatenate([[0], np.where(np.diff(np.digitize(yt, ybin, right=True)))[0] + 1, [len(yt) - 1]])
+        f = moffat.pdf(yt[:, np.newaxis], loc=x_0, scale=gamma)
+        return np.diff(cumtrapz(f, x=yt, axis=0, initial=0)[ind], axis=0) / np.diff(ybin)[:, np.newaxis]
+
+def column_profiles(y, x_0, scale, profile_type='moffat'):
+    """
+    Profiles of the trace for the set of columns of 2d spectrum
+    parameters:
+        - y             : centers of the pixels along the slit, shape(n)
+        - x_0           : positions of the trace, shape(m)
+        - scale         : scale of Moffat function, or width of the slit for 'rectangular' and 'gaussian' profiles, shape(m)
+        - profile_type  : type of the profile, can be 'moffat', 'rectangular' or 'gaussian'
+    return:
+        - profiles      : shape(n, m)
+    """
+    d = y[:, np.newaxis] - np.atleast_1d(x_0)[np.newaxis, :]
+    if profile_type == 'moffat':
+        p = moffat_profiles(y, x_0, scale, kind='pdf')
+        return p / np.sum(p, axis=0)
+    elif profile_type == 'rectangular':
+        return 1 / (np.exp(-40 * (np.abs(d) - scale)) + 1)
+    elif profile_type == 'gaussian':
+        return np.exp(-0.5 * (np.abs(d) / (scale / 2.35482)) ** 2)
+
+def extract_columns(y, z, err, mask, x_0, scale, profile_type='moffat'):
+    """
+    Extraction of the fluxes from the columns of 2d spectrum by the least squares with the given profile of the trace.
+    All columns are treated by single vectorized pass, so it can be run over the chunks of the frame in the process pool.
+    parameters:
+        - y             : centers of the pixels along the slit, shape(n)
+        - z             : sky subtracted fluxes, shape(n, m)
+        - err           : uncertainties, shape(n, m), or None
+        - mask          : mask of the bad pixels (e.g. cosmic rays), shape(n, m)
+        - x_0, scale    : positions and scales of the profiles (see column_profiles), shape(m)
+        - profile_type  : type of the profile
+    return:
+        - f, e          : fluxes and uncertainties (zeros if err is None), shape(m)
+    """
+    profile = column_profiles(y, x_0, scale, profile_type=profile_type)
+    w = profile * (1 - mask)
+    v = np.sum(profile * w, axis=0)
+    f = np.sum(z * w, axis=0) / v
+    e = np.sqrt(np.sum(profile * w * err ** 2, axis=0)) / v if err is not None else np.zeros_like(f)
+    return f, e
+
 class spec2d():
     def __init__(self, parent):
         self.parent = parent
@@ -871,41 +949,34 @@ class spec2d():
             self.cr.mask = np.logical_or(self.cr.mask, mask[4:-4])
         print(update, np.sum(self.cr.mask.flatten()))
 
+    def window(self, mask, pad=(0, 0)):
+        """
+        Bounding box of the pixels selected by the mask, padded by <pad> pixels
+        parameters:
+            - mask      : boolean mask of the frame
+            - pad       : padding along y and x axis
+        return:
+            - sl        : tuple of slices of the frame
+        """
+        rows, cols = np.where(np.any(mask, axis=1))[0], np.where(np.any(mask, axis=0))[0]
+        if len(rows) == 0:
+            return slice(0, 0), slice(0, 0)
+        return (slice(max(rows[0] - pad[0], 0), min(rows[-1] + pad[0] + 1, mask.shape[0])),
+                slice(max(cols[0] - pad[1], 0), min(cols[-1] + pad[1] + 1, mask.shape[1])))
+
     def expand_mask(self, exp_pixel=1, mask=None):
         if mask is None:
             mask = np.ones_like(self.raw.z, dtype=bool)
-        m = np.copy(self.cr.mask)
-        for p in itertools.product(np.linspace(-exp_pixel, exp_pixel, 2*exp_pixel+1).astype(int), repeat=2):
-            m1 = np.copy(self.cr.mask)
-            if p[0] < 0:
-                m1 = np.insert(m1[:p[0],:], [0]*np.abs(p[0]), 0, axis=0)
-            if p[0] > 0:
-                m1 = np.insert(m1[p[0]:, :], [m1.shape[0]-p[0]]*p[0], 0, axis=0)
-            if p[1] < 0:
-                m1 = np.insert(m1[:,:p[1]], [0]*np.abs(p[1]), 0, axis=1)
-            if p[1] > 0:
-                m1 = np.insert(m1[:, p[1]:], [m1.shape[1]-p[1]]*p[1], 0, axis=1)
-            m = np.logical_or(m, m1)
-        self.cr.mask[mask] = m[mask]
+        sl = self.window(mask, pad=(exp_pixel, exp_pixel))
+        m = binary_dilation(self.cr.mask[sl] != 0, structure=np.ones([2 * exp_pixel + 1, 2 * exp_pixel + 1], dtype=bool))
+        self.cr.mask[sl][mask[sl]] = m[mask[sl]]
 
     def neighbour_count(self, mask=None):
         if mask is None:
             mask = np.ones_like(self.raw.z, dtype=bool)
-        #m = np.copy(self.cr.mask)
-        c = np.zeros_like(self.cr.mask[mask], dtype=int)
-        for p in itertools.product(np.linspace(-1, 1, 3).astype(int), repeat=2):
-            m1 = np.copy(self.cr.mask)
-            if p[0] < 0:
-                m1 = np.insert(m1[:p[0], :], [0] * np.abs(p[0]), 0, axis=0)
-            if p[0] > 0:
-                m1 = np.insert(m1[p[0]:, :], [m1.shape[0] - p[0]] * p[0], 0, axis=0)
-            if p[1] < 0:
-                m1 = np.insert(m1[:, :p[1]], [0] * np.abs(p[1]), 0, axis=1)
-            if p[1] > 0:
-                m1 = np.insert(m1[:, p[1]:], [m1.shape[1] - p[1]] * p[1], 0, axis=1)
-            c = np.add(c, m1[mask])
-            print('c', c.shape)
-        return c
+        sl = self.window(mask, pad=(1, 1))
+        c = correlate((self.cr.mask[sl] != 0).astype(int), np.ones([3, 3], dtype=int), mode='constant', cval=0)
+        return c[mask[sl]]
 
     def intelExpand(self, exp_factor=3, exp_pixel=1, pixel=None):
         if pixel is None:
@@ -914,41 +985,33 @@ class spec2d():
             mask = np.zeros_like(self.raw.z, dtype=bool)
             x, y = (np.abs(self.raw.x - pixel[0])).argmin(), (np.abs(self.raw.y - pixel[1])).argmin()
             mask[max(0, y-5):min(mask.shape[0], y+5), max(0, x-5):min(mask.shape[1], x+5)] = True
-        z_saved, mask_saved = np.copy(self.raw.z), np.copy(self.cr.mask)
+        z_saved, mask_saved = self.raw.z[mask], self.cr.mask[mask]
         self.expand_mask(exp_pixel=exp_pixel, mask=mask)
-        self.extrapolate(inplace=True, mask=mask)
-        self.cr.mask[mask] = np.logical_or(mask_saved[mask], np.logical_and(np.abs((self.raw.z[mask] - z_saved[mask]) / self.raw.err[mask]) > exp_factor, self.cr.mask[mask]))
+        self.extrapolate(kind='inplace', mask=mask)
+        delta = (self.raw.z[mask] - z_saved) / self.raw.err[mask]
+        self.cr.mask[mask] = np.logical_or(mask_saved, np.logical_and(np.abs(delta) > exp_factor, self.cr.mask[mask]))
         neighbour = self.neighbour_count(mask=mask)
         self.cr.mask[mask] = np.logical_or(np.logical_and(self.cr.mask[mask], neighbour>2), neighbour>6)
         if pixel is None:
             self.parent.parent.s.append(Spectrum(self.parent.parent, name='delta'))
-            self.parent.parent.s[-1].spec2d.set(x=self.raw.x, y=self.raw.y, z=(self.raw.z - z_saved) / self.raw.err)
+            self.parent.parent.s[-1].spec2d.set(x=self.raw.x, y=self.raw.y, z=np.reshape(delta, self.cr.mask.shape))
             self.parent.parent.s[-1].spec2d.raw.setLevels(-exp_factor, exp_factor)
-            #print((self.raw.z - z_saved) / self.raw.err)
             self.parent.parent.s.append(Spectrum(self.parent.parent, name='neighbours'))
             self.parent.parent.s[-1].spec2d.set(x=self.raw.x, y=self.raw.y, z=np.reshape(neighbour, self.cr.mask.shape))
             self.parent.parent.s[-1].spec2d.raw.setLevels(0, np.max(neighbour.flatten()))
-            #print(np.max(neighbour.flatten()))
-        #print(z_saved)
-        self.raw.z = z_saved[:]
+        self.raw.z[mask] = z_saved
 
-    def clean(self):
+    def clean(self, chunk=200):
         mask_saved = np.copy(self.cr.mask)
         self.expand_mask(exp_pixel=2)
         z = (self.raw.z - self.sky.z)
         self.moffat_kind = 'pdf'
         inds = np.searchsorted(self.raw.x, self.trace[0][(self.trace[0] >= self.raw.x[0]) * (self.trace[0] <= self.raw.x[-1])])
-        y, err = np.zeros(len(inds)), np.zeros(len(inds))
-        for k, i in enumerate(inds):
-            print(k, self.raw.x[i])
-            ind = np.searchsorted(self.trace[0], self.raw.x[i])
-            x_0 = self.trace[1][ind]
-            gamma = self.trace[2][ind] / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
-            profile = self.moffat_fit_integ(self.raw.y, a=1, x_0=x_0, gamma=gamma, c=0)
-
-            #v = np.sum((1 - self.cr.mask[:, i]) * profile ** 2)  # / self.raw.err[:, i]**2)
-            flux = np.sum(z[:, i] * profile * (1 - self.cr.mask[:, i])) / np.sum((1 - self.cr.mask[:, i]) * profile ** 2)  # / self.raw.err[:, i]**2)
-            z[:, i] = z[:, i] - profile * flux
+        x_0, gamma = self.trace_profile(inds)
+        for c in self.chunks(len(inds), chunk=chunk):
+            profile = moffat_profiles(self.raw.y, x_0[c], gamma[c], kind='pdf')
+            w = profile * (1 - self.cr.mask[:, inds[c]])
+            z[:, inds[c]] -= profile * np.sum(z[:, inds[c]] * w, axis=0) / np.sum(profile * w, axis=0)
 
         self.cr.mask = mask_saved
         self.parent.parent.s.append(Spectrum(self.parent.parent, name='clean'))
@@ -957,17 +1020,21 @@ class spec2d():
     def extrapolate(self, kind='return', extr_width=1, extr_height=1, sky=1, mask=None):
         if mask is None:
             mask = np.ones_like(self.raw.z, dtype=bool)
-        z = np.copy(self.raw.z)
-        if sky and self.sky is not None:
-            z -= self.sky.z
         self.cr.mask = self.cr.mask.astype(bool)
-        z[self.cr.mask] = np.nan
         kernel = Gaussian2DKernel(x_stddev=extr_width, y_stddev=extr_height)
-        z = convolve(z, kernel, nan_treatment='interpolate')
+        # >>> interpolate only within the bounding box of the affected pixels, padded by the kernel half size
+        sl = self.window(np.logical_and(self.cr.mask, mask) if kind == 'inplace' else self.cr.mask, pad=(kernel.shape[0] // 2, kernel.shape[1] // 2))
+        m = self.cr.mask[sl]
         z1 = np.copy(self.raw.z)
-        z1[self.cr.mask] = z[self.cr.mask]
-        if sky and self.sky is not None:
-            z1[self.cr.mask] += self.sky.z[self.cr.mask]
+        if np.sum(m) > 0:
+            z = np.copy(self.raw.z[sl])
+            if sky and self.sky is not None:
+                z -= self.sky.z[sl]
+            z[m] = np.nan
+            z = convolve(z, kernel, nan_treatment='interpolate')
+            z1[sl][m] = z[m]
+            if sky and self.sky is not None:
+                z1[sl][m] += self.sky.z[sl][m]
 
         if kind == 'return':
             return z1
@@ -1006,13 +1073,7 @@ class spec2d():
             y = self.moffat.cdf(x, loc=x_0, scale=gamma)
             return a * np.diff(y) + c
         elif self.moffat_kind == 'pdf':
-            bins = 10
-            xbin = np.concatenate([[x[0] - (x[1] - x[0]) / 2], (x[:-1] + x[1:]) / 2, [x[-1] + (x[-1] - x[-2]) / 2]])
-            xt = np.concatenate([np.linspace(xbin[i], xbin[i + 1], bins if bins % 2 else bins + 1)[:-1]+0.0001 for i in range(len(xbin) - 1)] + [[xbin[-1]]])
-
-            f = a * self.moffat.pdf(xt, loc=x_0, scale=gamma) + c
-            s = np.diff(cumtrapz(f, x=xt, initial=0)[np.concatenate([[0], np.where(np.diff(np.digitize(xt, xbin, right=True)))[0] + 1, [len(xt) - 1]])]) / np.diff(xbin)
-            return s
+            return a * moffat_profiles(x, x_0, gamma, kind='pdf')[:, 0] + c
 
         elif self.moffat_kind == 'inter' and self.moffat_inter is not None:
             if gamma > self.moffat_inter.y[0] and gamma < self.moffat_inter.y[-1]:
@@ -1084,6 +1145,24 @@ class spec2d():
         else:
             self.trace = [self.parent.cont2d.x[:], trace_pos, trace_width]
         print('trace', self.trace)
+    def trace_profile(self, inds, width=1):
+        """
+        Positions and Moffat scales of the trace at the columns of the frame
+        parameters:
+            - inds      : indices of the columns
+            - width     : factor of the trace width
+        return:
+            - x_0, gamma : arrays of positions and scales
+        """
+        ind = np.searchsorted(self.trace[0], self.raw.x[inds])
+        return np.asarray(self.trace[1])[ind], np.asarray(self.trace[2])[ind] * width / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
+
+    def chunks(self, n, chunk=200):
+        """
+        Split <n> columns in the chunks of about <chunk> columns
+        """
+        return np.array_split(np.arange(n), max(1, int(np.ceil(n / chunk))))
+
     def set_trace(self):
         for attr in ['trace_pos', 'trace_width']:
             try:
@@ -1121,97 +1200,83 @@ class spec2d():
         def fun_wavy(p, x, y):
             return np.polyval(p[:-3], x) + (p[-1] * np.sin(p[-3] * x + p[-2])) - y
 
-        for k, i in enumerate(inds):
-            print(i, self.raw.x[i])
+        def plot_sky(k, y, curves):
+            self.parent.parent.fig, self.parent.parent.ax = plt.subplots()
+            self.parent.parent.ax.plot(self.raw.y[mask[:, k]], y, 'ok')
+            for c, fmt in zip(curves, ['--r', '-r']):
+                self.parent.parent.ax.plot(self.raw.y, c, fmt)
+            plt.show()
+            plotfile = os.path.dirname(os.path.realpath(__file__)) + '/output/sky.png'
+            self.parent.parent.fig.savefig(plotfile, dpi=self.parent.parent.fig.dpi)
+            os.startfile(plotfile)
+
+        inds = np.asarray(inds, dtype=int)
+        if len(inds) > 0:
+            # >>> sky regions of all the columns at once, shape(len(y), len(inds))
             if mask_type == 'moffat':
                 if self.trace is None and slit is not None:
-                    x_0, gamma = self.parent.cont2d.y[k], self.extr_slit / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
+                    x_0, gamma = np.asarray(self.parent.cont2d.y[:len(inds)]), np.full(len(inds), self.extr_slit / 2 / np.sqrt(2 ** (1 / 4.765) - 1))
                 else:
-                    ind = np.searchsorted(self.trace[0], self.raw.x[i])
-                    x_0 = self.trace[1][ind]
-                    gamma = self.trace[2][ind] * 2 / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
-                m = self.moffat.ppf([conf, 1-conf], loc=x_0, scale=gamma)
-                #print(m)
-                mask_sky = np.logical_or(self.raw.y < m[0], self.raw.y > m[1])
+                    x_0, gamma = self.trace_profile(inds, width=2)
+                m = self.moffat.ppf([conf, 1 - conf])
+                mask_sky = np.logical_or(self.raw.y[:, np.newaxis] < x_0 + gamma * m[0], self.raw.y[:, np.newaxis] > x_0 + gamma * m[1])
             elif slit is not None:
-                mask_sky = 1 / (np.exp(-40 * (np.abs(self.raw.y - self.parent.cont2d.y[k]) - slit * 2)) + 1)
-            mask_sky[:border] = 0
-            mask_sky[-border:] = 0
-            mask_reg = np.zeros_like(self.raw.mask, dtype=bool)
-            imin, imax = max(i - window, inds[0]), min(i + window + 1, inds[-1])
-            if imin == imax:
-                imax = imin + 1
-            #print(imin, imax)
-            mask_reg[:, imin:imax] = True
-            #print(np.sum(mask_reg))
-            #print(self.cr.mask,  mask_reg * mask_sky[:, np.newaxis])
-            mask = np.logical_and(np.logical_not(self.cr.mask), mask_reg * mask_sky[:, np.newaxis])
-            #print((mask_reg * mask_sky[:, np.newaxis]).shape)
-            #print(np.sum(mask_reg * mask_sky[:, np.newaxis]))
-            self.sky.mask[:, i] = mask[:, i]
+                mask_sky = 1 / (np.exp(-40 * (np.abs(self.raw.y[:, np.newaxis] - np.asarray(self.parent.cont2d.y[:len(inds)])) - slit * 2)) + 1) != 0
+            mask_sky[:border] = False
+            mask_sky[mask_sky.shape[0] - border:] = False
+            mask = np.logical_and(self.cr.mask[:, inds] == 0, mask_sky)
+            self.sky.mask[:, inds] = mask
+
             if window > 0:
-                y = np.ma.MaskedArray(self.raw.z, np.logical_not(mask))
-                y = y.mean(axis=1).flatten()[mask[:, i]] #, np.mean(np.where(mask, self.raw.z, 0), axis=1)
+                # >>> means over the neighbouring columns by the cumulative sums along the dispersion axis
+                good = (self.cr.mask == 0)
+                s = np.insert(np.cumsum(np.where(good, self.raw.z, 0), axis=1), 0, 0, axis=1)
+                n = np.insert(np.cumsum(good, axis=1), 0, 0, axis=1)
+                imin, imax = np.maximum(inds - window, inds[0]), np.minimum(inds + window + 1, inds[-1] + 1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    y = (s[:, imax] - s[:, imin]) / (n[:, imax] - n[:, imin])
             else:
-                y = self.raw.z[mask]
-            if len(y) > poly + 2:
-                if model == 'median':
-                    sky = np.median(y) * np.ones_like(self.raw.y)
-                elif model == 'mean':
-                    sky = np.mean(y) * np.ones_like(self.raw.y)
-                elif model == 'polynomial':
-                    p = np.polyfit(self.raw.y[mask[:, i]], y, poly)
-                    sky = np.polyval(p, self.raw.y)
-                    if plot:
-                        self.parent.parent.fig, self.parent.parent.ax = plt.subplots()
-                        #print('plotting', self.parent.parent.ax)
-                        self.parent.parent.ax.plot(self.raw.y[mask[:, i]], y, 'ok')
-                        self.parent.parent.ax.plot(self.raw.y, np.polyval(p, self.raw.y), '--r')
-                        plt.show()
-                        plotfile = os.path.dirname(os.path.realpath(__file__)) + '/output/sky.png'
-                        self.parent.parent.fig.savefig(plotfile, dpi=self.parent.parent.fig.dpi)
-                        os.startfile(plotfile)
-                elif model == 'robust':
-                    p = np.polyfit(self.raw.y[mask[:, i]], y, poly)
-                    res_robust = least_squares(fun, p, loss='soft_l1', f_scale=0.02, args=(self.raw.y[mask[:,i]], y))
-                    sky = np.polyval(res_robust.x, self.raw.y)
-                    if plot:
-                        self.parent.parent.fig, self.parent.parent.ax = plt.subplots()
-                        self.parent.parent.ax.plot(self.raw.y[mask[:, i]], y, 'ok')
-                        self.parent.parent.ax.plot(self.raw.y, np.polyval(p, self.raw.y), '--r')
-                        self.parent.parent.ax.plot(self.raw.y, sky, '-r')
-                        plt.show()
-                        plotfile = os.path.dirname(os.path.realpath(__file__)) + '/output/sky.png'
-                        self.parent.parent.fig.savefig(plotfile, dpi=self.parent.parent.fig.dpi)
-                        os.startfile(plotfile)
-
-                elif model == 'wavy':
-                    p = np.polyfit(self.raw.y[mask[:, i]], y, poly)
-                    periods = np.linspace(0.5, 8, 100)
-                    angular_freqs = 2 * np.pi / periods
-                    pgram = lombscargle(self.raw.y[mask[:, i]], y - np.polyval(p, self.raw.y[mask[:, i]]), angular_freqs)
-                    guess_period = periods[np.argmax(pgram)]
-                    guess_amp = np.std(y - np.polyval(p, self.raw.y[mask[:, i]])) * 2. ** 0.5
-                    #print('guess:', guess_period, guess_amp)
-                    p = np.append(p, [2 * np.pi / guess_period, 0, guess_amp])
-                    res_robust = least_squares(fun_wavy, p, loss='linear', f_scale=0.003, args=(self.raw.y[mask[:, i]], y))
-                    #print('fit:', 2 * np.pi / res_robust.x[-3], res_robust.x[-1])
-                    sky = np.polyval(res_robust.x[:-3], self.raw.y) + (res_robust.x[-1] * np.sin(res_robust.x[-3] * self.raw.y + res_robust.x[-2]))
+                y = self.raw.z[:, inds]
+            y = np.where(mask, y, np.nan)
+            fit = np.sum(mask, axis=0) > poly + 2
+            sky = np.zeros_like(y, dtype=float)
+
+            if model == 'median':
+                sky[:, fit] = np.nanmedian(y[:, fit], axis=0)
+            elif model == 'mean':
+                sky[:, fit] = np.nanmean(y[:, fit], axis=0)
+            elif model == 'polynomial':
+                # >>> least squares for all the columns at once by normal equations in the scaled coordinate
+                t = (self.raw.y - np.mean(self.raw.y)) / (np.ptp(self.raw.y) / 2)
+                v = np.vander(t, poly + 1)
+                w = mask[:, fit].astype(float)
+                p = np.linalg.solve(np.einsum('nm,ni,nj->mij', w, v, v), np.einsum('nm,ni->mi', np.nan_to_num(y[:, fit]) * w, v))
+                sky[:, fit] = np.dot(v, p.T)
+                if plot:
+                    for k in np.where(fit)[0]:
+                        plot_sky(k, y[mask[:, k], k], [sky[:, k]])
+            elif model in ['robust', 'wavy']:
+                for k in np.where(fit)[0]:
+                    x, yk = self.raw.y[mask[:, k]], y[mask[:, k], k]
+                    p = np.polyfit(x, yk, poly)
+                    if model == 'robust':
+                        res_robust = least_squares(fun, p, loss='soft_l1', f_scale=0.02, args=(x, yk))
+                        sky[:, k] = np.polyval(res_robust.x, self.raw.y)
+                        curves = [np.polyval(p, self.raw.y), sky[:, k]]
+                    elif model == 'wavy':
+                        periods = np.linspace(0.5, 8, 100)
+                        angular_freqs = 2 * np.pi / periods
+                        pgram = lombscargle(x, yk - np.polyval(p, x), angular_freqs)
+                        guess_period = periods[np.argmax(pgram)]
+                        guess_amp = np.std(yk - np.polyval(p, x)) * 2. ** 0.5
+                        p = np.append(p, [2 * np.pi / guess_period, 0, guess_amp])
+                        res_robust = least_squares(fun_wavy, p, loss='linear', f_scale=0.003, args=(x, yk))
+                        sky[:, k] = np.polyval(res_robust.x[:-3], self.raw.y) + (res_robust.x[-1] * np.sin(res_robust.x[-3] * self.raw.y + res_robust.x[-2]))
+                        curves = [np.polyval(res_robust.x[:-3], self.raw.y), sky[:, k]]
                     if plot:
-                        self.parent.parent.fig, self.parent.parent.ax = plt.subplots()
-                        #print('plotting', self.parent.parent.ax)
-                        self.parent.parent.ax.plot(self.raw.y[mask[:, i]], y, 'ok')
-                        self.parent.parent.ax.plot(self.raw.y, np.polyval(res_robust.x[:-3], self.raw.y), '--r')
-                        self.parent.parent.ax.plot(self.raw.y, sky, '-r')
-                        plt.show()
-                        plotfile = os.path.dirname(os.path.realpath(__file__)) + '/output/sky.png'
-                        self.parent.parent.fig.savefig(plotfile, dpi=self.parent.parent.fig.dpi)
-                        os.startfile(plotfile)
+                        plot_sky(k, yk, curves)
 
-            else:
-                sky = 0
-
-            self.sky.z[:, i] = sky
+            self.sky.z[:, inds] = sky
 
         if smooth > 0 and len(inds) > 30:
             smooth = smooth + 1 if smooth % 2 == 0 else smooth
@@ -1267,7 +1332,7 @@ class spec2d():
 
         self.sky.z[:, :] = np.ma.median(np.ma.array(self.raw.z, mask=np.logical_and(mask, self.cr.mask)), axis=0)[np.newaxis, :]
 
-    def extract(self, xmin, xmax, slit=0, profile_type='moffat', bary=None, airvac=True, removecr=False, inplace=False, kind='pdf', resolution=None, extr_width=3, extr_height=5):
+    def extract(self, xmin, xmax, slit=0, profile_type='moffat', bary=None, airvac=True, removecr=False, inplace=False, kind='pdf', resolution=None, extr_width=3, extr_height=5, chunk=200, threads=1):
         print('slit:', slit)
         self.moffat_kind = 'pdf'
         if self.cr is None:
@@ -1311,51 +1376,48 @@ class spec2d():
                 err = (tr.mask(cr).sum(axis=0) / (tr * tr / e.pow(2.0)).mask(cr).sum(axis=0)).pow(0.5)
                 cr = cr.mask((d - s - f * tr) / e > 5, True)
         else:
-            for k, i in enumerate(inds):
-                print(k, self.raw.x[i])
-                if profile_type == 'moffat':
-                    if slit > 0:
-                        x_0, gamma = self.parent.cont2d.y[k], slit / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
-                    else:
-                        ind = np.searchsorted(self.trace[0], self.raw.x[i])
-                        x_0 = self.trace[1][ind]
-                        gamma = self.trace[2][ind] / 2 / np.sqrt(2 ** (1 / 4.765) - 1)
-                    profile = self.moffat_fit_integ(self.raw.y, a=1, x_0=x_0, gamma=gamma, c=0)
-                    profile /= np.sum(profile)
-                elif profile_type == 'rectangular':
-                    profile = 1 / (np.exp(-40 * (np.abs(self.raw.y - self.parent.cont2d.y[k]) - slit)) + 1)
-                elif profile_type == 'gaussian':
-                    profile = np.exp(-0.5 * (np.abs(self.raw.y - self.parent.cont2d.y[k]) / (slit / 2.35482)) ** 2)
-
-                #self.raw.err[:, i] = 1
-                if resolution is None:
-                    #print(profile, np.sum(profile * profile))
-                    v = np.sum(profile * profile * (1 - self.cr.mask[:, i])) #/ self.raw.err[:, i]**2)
-                    flux = np.sum((self.raw.z[:, i] - sky[:, i]) * profile * (1 - self.cr.mask[:, i])) # / self.raw.err[:, i]**2)
-                    errs = np.sum(profile * profile * self.raw.err[:, i] ** 2 * (1 - self.cr.mask[:, i]))
+            inds = np.asarray(inds, dtype=int)
+            if profile_type == 'moffat' and slit == 0:
+                x_0, scale = self.trace_profile(inds)
+            else:
+                x_0 = np.asarray(self.parent.cont2d.y[:len(inds)], dtype=float)
+                scale = np.full(len(inds), slit / 2 / np.sqrt(2 ** (1 / 4.765) - 1) if profile_type == 'moffat' else slit, dtype=float)
+            mask = np.asarray(self.cr.mask, dtype=float)
+
+            if resolution is None:
+                # >>> all the columns are extracted by the chunks (optionally in the process pool)
+                args = [(self.raw.y, data[:, inds[c]], self.raw.err[:, inds[c]] if self.raw.err is not None else None, mask[:, inds[c]], x_0[c], scale[c], profile_type)
+                        for c in self.chunks(len(inds), chunk=chunk)]
+                if threads > 1:
+                    with Pool(threads) as pool:
+                        res = pool.starmap(extract_columns, args)
                 else:
+                    res = [extract_columns(*a) for a in args]
+                f, err = np.concatenate([r[0] for r in res]), np.concatenate([r[1] for r in res])
+            else:
+                for k, i in enumerate(inds):
+                    profile = column_profiles(self.raw.y, x_0[k:k+1], scale[k:k+1], profile_type=profile_type)[:, 0]
                     imin, imax = np.searchsorted(self.raw.x, self.raw.x[i] * (1 - 3.0 / resolution)), np.searchsorted(self.raw.x, self.raw.x[i] * (1 + 3.0 / resolution))
-                    #print(imin, imax)
                     v, flux, errs = 0, 0, 0
                     for ind in range(imin, imax):
-                        v += np.sum((1 - self.cr.mask[:, ind]) * profile) * g
-                        flux += np.sum((self.raw.z[:, ind] - sky[:, ind]) * profile * (1 - self.cr.mask[:, ind])) * g
+                        v += np.sum((1 - mask[:, ind]) * profile) * g
+                        flux += np.sum((self.raw.z[:, ind] - sky[:, ind]) * profile * (1 - mask[:, ind])) * g
                         if self.raw.err is not None:
-                            errs += np.sum((1 - self.cr.mask[:, ind]) * profile * self.raw.err[:, ind] ** 2) * g
+                            errs += np.sum((1 - mask[:, ind]) * profile * self.raw.err[:, ind] ** 2) * g
 
-                f[k] = flux / v
-                if self.raw.err is not None:
-                    err[k] = np.sqrt(errs) / v
+                    f[k] = flux / v
+                    if self.raw.err is not None:
+                        err[k] = np.sqrt(errs) / v
 
         if inplace:
             pass
         else:
             if self.raw.err is not None:
-                data = self.raw.x[inds], np.asarray(f), np.asarray(err)
+                spec = self.raw.x[inds], np.asarray(f), np.asarray(err)
             else:
-                data = self.raw.x[inds], np.asarray(f)
-            print('append:', data)
-            self.parent.parent.s.append(Spectrum(self.parent.parent, f'extracted_{profile_type}', data=data))
+                spec = self.raw.x[inds], np.asarray(f)
+            print('append:', spec)
+            self.parent.parent.s.append(Spectrum(self.parent.parent, f'extracted_{profile_type}', data=spec))
             if bary is not None:
                 self.parent.parent.s[-1].bary_vel = bary
                 self.parent.parent.s[-1].apply_shift(bary)
@@ -1368,6 +1430,8 @@ class spec2d():
                 print('removecr')
                 data = self.extrapolate(extr_width=extr_width, extr_height=extr_height, sky=1)
                 print(data.shape)
+            else:
+                data = self.raw.z
 
             data = data[:, inds] - sky[:, inds]
             print(self.parent.parent.s[-1].spec.raw.x)
@@ -1375,6 +1439,36 @@ class spec2d():
             print(data.shape)
             self.parent.parent.s[-1].spec2d.set(x=self.parent.parent.s[-1].spec.raw.x, y=self.raw.y, z=data)
 
+def cr_benchmark(shape=(4000, 4000), frac=1e-4, num=3, seed=1, verbose=True):
+    """
+    Benchmark of the cosmic ray mask treatment (as used by click in 2d spectrum) on the synthetic frame
+
+    parameters:
+        - shape     : shape of the frame
+        - frac      : fraction of pixels affected by cosmic rays
+        - num       : number of the clicked pixels
+        - seed      : seed for random generator
+
+    return:
+        - t_click, t_frame  : time of intelExpand for single pixel and of extrapolate of the whole frame (in seconds)
+    """
+    rng = np.random.default_rng(seed)
+    s = spec2d(None)
+    z = rng.normal(0, 1, shape)
+    mask = rng.random(shape) < frac
+    z[mask] += rng.uniform(10, 100, np.sum(mask))
+    s.set(x=np.arange(shape[1]), y=np.arange(shape[0]), z=z, err=np.ones(shape))
+    s.cr = image(x=s.raw.x, y=s.raw.y, mask=np.copy(mask))
+    t = Timer()
+    for x, y in zip(rng.integers(0, shape[1], num), rng.integers(0, shape[0], num)):
+        s.intelExpand(exp_factor=2, exp_pixel=1, pixel=(x, y))
+    t_click = t.time() / num
+    s.extrapolate(kind='return')
+    t_frame = t.time()
+    if verbose:
+        print('click: {0:.4f} s, whole frame: {1:.4f} s'.format(t_click, t_frame))
+    return t_click, t_frame
+
 class Spectrum():
     """
     class for plotting Spectrum with interactive functions
@@ -1407,6 +1501,7 @@ class Spectrum():
         self.fit = fitline(self)
         self.fit_bin = fitline(self)
         self.fit_comp = []
+        self.fit_cache = None
         self.cheb = fitline(self)
         self.res = gline()
         self.kde = gline()
@@ -2132,15 +2227,23 @@ class Spectrum():
             for sys in self.parent.fit.sys:
                 if ind == -1 or sys.ind == ind:
                     for sp in sys.sp.keys():
-                        lin = self.parent.atomic.list(sp)
-                        for l in lin:
+                        if all:
+                            t = self.parent.atomic.select(sp, x[0] / (1 + sys.z.val), x[-1] / (1 + sys.z.val))
+                        else:
+                            t = self.parent.atomic.table(sp)
+                        ranges = np.transpose(lines_range(t['l'], t['f'], t['g'], sys.sp[sp].N.val, sys.sp[sp].b.val, sys.z.val, resolution=self.resolution, tlim=tlim)).reshape(-1, 2)
+                        if all:
+                            m = (np.sum(ranges, axis=1) / 2 < x[-1]) * (np.sum(ranges, axis=1) / 2 > x[0])
+                        else:
+                            m = np.searchsorted(x, ranges[:, 0], side='left') < np.searchsorted(x, ranges[:, 1], side='right')
+                        for l, r in zip(self.parent.atomic.make_lines(sp, t[m]), ranges[m]):
                             if str(l) not in sys.exclude:
                                 l.b = sys.sp[sp].b.val
                                 l.logN = sys.sp[sp].N.val
                                 l.z = sys.z.val
                                 l.recalc = True
                                 l.sys = sys.ind
-                                l.range = tau(l, resolution=self.resolution).getrange(tlim=tlim)
+                                l.range = list(r)
                                 l.cf = -1
                                 if self.parent.fit.cf_fit:
                                     for i in range(self.parent.fit.cf_num):
@@ -2160,13 +2263,7 @@ class Spectrum():
                                         if st.strip() == 'N_{0:d}_{1:s}'.format(l.sys, sp.strip()):
                                             l.stack = i
 
-                                if all:
-                                    #if l.range[0] < x[-1] and l.range[1] > x[0]:
-                                    if np.sum(l.range) / 2 < x[-1] and np.sum(l.range) / 2 > x[0]:
-                                        self.fit_lines += [l]
-                                else:
-                                    if np.sum(np.logical_and(x >= l.range[0], x <= l.range[1])) > 0:
-                                        self.fit_lines += [l]
+                                self.fit_lines += [l]
         if debug:
             print('findFitLines', self.fit_lines, [l.cf for l in self.fit_lines])
 
@@ -2190,7 +2287,7 @@ class Spectrum():
                         line.b = sys.sp[line.name.split()[0]].b.val
                         line.logN = sys.sp[line.name.split()[0]].N.val
                         line.z = sys.z.val
-                        line.tau = tau(line, resolution=self.resolution)
+                        line.tau = tau(line, resolution=self.resolution, calc=self.parent.voigt_calc)
             if timer:
                 t.time('update')
 
@@ -2214,9 +2311,14 @@ class Spectrum():
                         line.recalc = False
                     if not self.parent.fit.cf_fit:
                         flux += line.profile
-                    else:
-                        cf = np.min([1, np.sum([getattr(self.parent.fit, 'cf_' + str(i)).val for i in line.cf])])
-                        flux += - np.log(np.exp(-line.profile) * (1 - cf) + cf)
+
+            # >>> include partial covering (lines are grouped by the covering factor, as in calcFit_fast):
+            if self.parent.fit.cf_fit:
+                cfs = np.array([line.cf if ind == -1 or ind == line.sys else -2 for line in self.fit_lines])
+                for l in np.unique(cfs[cfs > -2]):
+                    cf = self.parent.fit.getValue('cf_' + str(l)) if l > -1 else 1
+                    profile = np.sum([line.profile for line, c in zip(self.fit_lines, cfs) if c == l], axis=0)
+                    flux += - np.log(np.exp(-profile) * cf + (1 - cf))
 
             flux = np.exp(-flux)
 
@@ -2309,7 +2411,7 @@ class Spectrum():
                         line.b = sys.sp[line.name.split()[0]].b.val
                         line.logN = sys.sp[line.name.split()[0]].N.val
                         line.z = sys.z.val
-                        line.tau = tau(line, resolution=self.resolution)
+                        line.tau = tau(line, resolution=self.resolution, calc=self.parent.voigt_calc)
 
             # >>> create lambda grid:
             for line in self.fit_lines:
@@ -2405,7 +2507,7 @@ class Spectrum():
                         line.b = sys.sp[line.name.split()[0]].b.val
                         line.logN = sys.sp[line.name.split()[0]].N.val
                         line.z = sys.z.val
-                        line.tau = tau(line, resolution=self.resolution)
+                        line.tau = tau(line, resolution=self.resolution, calc=self.parent.voigt_calc)
             if timer:
                 t.time('update')
 
@@ -2495,6 +2597,145 @@ class Spectrum():
             if timer:
                 t.time('set_fit')
 
+    def calcFit_vector(self, ind=-1, recalc=False, redraw=True, timer=False, num_between=3, tau_limit=0.01):
+        """
+            calculate the absorption profile using batched calculation of optical depth of all lines at once
+            (single vectorized call of Faddeeva function on sparse windows of the lines).
+            For the total fit (ind == -1) the optical depths of the lines and convolved flux are cached in self.fit_cache,
+            and only the lines and convolution windows affected by the changed parameters are recalculated (see fitPars.dependency)
+           - ind             : specify the component for which fit is calculated
+           - recalc          : if True recalculate profiles of all lines (i.e. reset the cache)
+           - redraw          : if True redraw the fit
+           - num_between     : number of points to add between spectral pixels
+           - tau_limit       : limit of optical depth to cutoff the line (set the range of calculations)
+        :return:
+        """
+        if timer:
+            t = Timer(str(ind))
+        if self.spec.norm.n > 0 and self.cont.n > 0:
+            fit = self.parent.fit
+
+            # >>> collect line parameters to arrays:
+            lines = [line for line in self.fit_lines if ind == -1 or ind == line.sys]
+            for line in lines:
+                sys = fit.sys[line.sys]
+                line.b = sys.sp[line.name.split()[0]].b.val
+                line.logN = sys.sp[line.name.split()[0]].N.val
+                line.z = sys.z.val
+                line.recalc = False
+            l, f, g = np.array([[line.l(), line.f(), line.g()] for line in lines], dtype=float).reshape(-1, 3).T
+            logN, b, z = np.array([[line.logN, line.b, line.z] for line in lines], dtype=float).reshape(-1, 3).T
+            cfs = np.array([line.cf if fit.cf_fit else -1 for line in lines], dtype=int)
+            ngroups = fit.cf_num + 1 if fit.cf_fit else 1
+            if timer:
+                t.time('update')
+
+            # >>> create lambda grid:
+            if ind == -1:
+                x_spec = self.spec.norm.x
+                if self.resolution not in [None, 0]:
+                    xmin, xmax = lines_range(l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit)
+                    mask_glob = np.zeros(x_spec.shape[0] + 1, dtype=int)
+                    np.add.at(mask_glob, np.searchsorted(x_spec, xmin, side='right'), 1)
+                    np.add.at(mask_glob, np.searchsorted(x_spec, xmax, side='left'), -1)
+                    mask_glob = np.cumsum(mask_glob[:-1]) > 0
+                else:
+                    mask_glob = np.zeros(0, dtype=bool)
+
+                # >>> check the cache and find the changed parts of the model:
+                cache, deps = None if recalc else self.fit_cache, None
+                if cache is not None:
+                    if cache['opts'] == (self.resolution, num_between, tau_limit, ngroups, self.parent.voigt_calc) and np.array_equal(cache['x_spec'], x_spec) and np.array_equal(cache['mask'], mask_glob):
+                        deps = fit.dependency(fit.changed(cache['values']))
+                    if deps is None or self.ind() in deps['exp']:
+                        cache = None
+                if cache is None:
+                    x = makegrid(x_spec, mask_glob.astype(int) * num_between) if self.resolution not in [None, 0] else x_spec
+                    cache = {'opts': (self.resolution, num_between, tau_limit, ngroups, self.parent.voigt_calc), 'x_spec': np.copy(x_spec), 'mask': mask_glob,
+                             'x': x, 'lines': {}, 'conv': None}
+                x = cache['x']
+            else:
+                x = self.fit.line.norm.x if self.resolution not in [None, 0] else self.spec.norm.x
+            if timer:
+                t.time('create x')
+
+            # >>> calculate the intrinsic absorption line spectrum (including partial covering):
+            if ind == -1:
+                # lines are keyed by the system, label and line parameters, and the number of the same lines before (e.g. repeated transitions)
+                keys, seen = [], {}
+                for line in lines:
+                    k = (line.sys, str(line), line.l(), line.f(), line.g())
+                    seen[k] = seen.get(k, -1) + 1
+                    keys.append(k + (seen[k],))
+                window = lambda i: (i[0], i[-1] + 1) if i.shape[0] > 0 else (0, 0)
+                ranges = [window(cache['lines'].pop(k)[0]) for k in set(cache['lines'].keys()) - set(keys)]
+                dirty = [i for i, (k, line) in enumerate(zip(keys, lines)) if deps is None or k not in cache['lines'] or (line.sys, line.name.split()[0]) in deps['lines'] or cache['lines'][k][2] != cfs[i]]
+                if len(dirty) > 0:
+                    kk, ii, tt = tau_lines_sparse(x, l[dirty], f[dirty], g[dirty], logN[dirty], b[dirty], z[dirty], resolution=self.resolution, tlim=tau_limit, calc=self.parent.voigt_calc)
+                    split = np.searchsorted(kk, np.arange(len(dirty) + 1))
+                    for j, i in enumerate(dirty):
+                        if keys[i] in cache['lines']:
+                            ranges.append(window(cache['lines'][keys[i]][0]))
+                        cache['lines'][keys[i]] = (ii[split[j]:split[j+1]], tt[split[j]:split[j+1]], cfs[i])
+                        ranges.append(window(cache['lines'][keys[i]][0]))
+                if deps is not None and len(deps['cf']) > 0:
+                    ranges += [window(cache['lines'][keys[i]][0]) for i in np.flatnonzero(np.isin(cfs, list(deps['cf'])))]
+                ranges = [r for r in ranges if r[1] > r[0]]
+                ii = np.concatenate([cache['lines'][k][0] for k in keys] + [np.zeros(0, dtype=int)])
+                tt = np.concatenate([cache['lines'][k][1] for k in keys] + [np.zeros(0)])
+                gg = np.repeat(cfs + 1, [cache['lines'][k][0].shape[0] for k in keys])
+                profiles = np.bincount(gg * x.shape[0] + ii, weights=tt, minlength=ngroups * x.shape[0]).reshape(ngroups, x.shape[0])
+                if timer:
+                    t.time('recalculated {0:d} of {1:d} lines'.format(len(dirty), len(lines)))
+            else:
+                profiles = calctau_lines(x, l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit, groups=cfs + 1, ngroups=ngroups, calc=self.parent.voigt_calc)
+
+            flux = profiles[0]
+            for i in np.unique(cfs[cfs > -1]):
+                cf = fit.getValue('cf_' + str(i))
+                flux += - np.log(np.exp(-profiles[i + 1]) * cf + (1 - cf))
+
+            flux = np.exp(-flux)
+
+            if timer:
+                t.time('calc profiles')
+
+            # >>> convolve the spectrum with instrument function (only in touched windows, if cached)
+            if self.resolution not in [None, 0]:
+                if ind == -1 and cache['conv'] is not None:
+                    flux = convolve_res2_update(x, flux, self.resolution, cache['conv'], ranges)
+                else:
+                    flux = convolveflux(x, flux, self.resolution, kind='direct')
+            if ind == -1:
+                cache['conv'], flux = flux, np.copy(flux)
+            if timer:
+                t.time('convolve')
+
+            # >>> correct for artificial continuum:
+            if fit.cont_fit and fit.cont_num > 0:
+                flux = flux * self.correctContinuum(x)
+
+            # >>> correct for dispersion:
+            if fit.disp_num > 0:
+                for i in range(fit.disp_num):
+                    if getattr(fit, 'displ_' + str(i)).addinfo == 'exp_' + str(self.ind()):
+                        f = interp1d(x + (x - getattr(fit, 'displ_' + str(i)).val) * getattr(fit, 'disps_' + str(i)).val + getattr(fit, 'dispz_' + str(i)).val, flux, bounds_error=False, fill_value=1)
+                        flux = f(x)
+
+            # >>> set fit graphics
+            if ind == -1:
+                cache['values'] = fit.values()
+                self.fit_cache = cache
+                self.set_fit(x=x, y=flux)
+                if redraw:
+                    self.set_gfit()
+                    self.set_res()
+            else:
+                self.set_fit_comp(x=x, y=flux, ind=ind)
+
+            if timer:
+                t.time('set_fit')
+
     def correctContinuum(self, x):
         """
         Calculate the correction to the continuum given chebyshev polinomial coefficients in self.fit
@@ -2512,6 +2753,94 @@ class Spectrum():
 
         return corr
 
+    def calcFitDeriv(self, names, tau_limit=0.01):
+        """
+        Calculate analytic derivatives of the residuals (the ones returned by self.chi()) with respect to the parameters:
+        z, b, N of the species in the systems, covering factors and continuum Chebyshev coefficients.
+        The derivatives of the optical depths are obtained from the derivatives of Faddeeva function (see profiles.Voigt),
+        and then propagated through partial covering, convolution with instrument function and continuum correction.
+        The model (self.fit) and lines (self.fit_lines) have to be calculated before for the current parameters.
+           - names           : list of the names of parameters, e.g. ['z_0', 'b_0_HI', 'N_0_HI', 'cf_0', 'cont_0_1'],
+                               the derivatives of the other parameters are set to zero
+           - tau_limit       : limit of optical depth to cutoff the line (set the range of calculations)
+        :return: float array, shape (len(self.chi()), len(names))
+        """
+        mask = self.fit_mask.x()
+        if not (len(self.spec.x()) > 0 and np.sum(mask) > 0 and self.fit.line.n() > 0):
+            return np.zeros((0, len(names)))
+
+        deriv = np.zeros((np.sum(mask), len(names)))
+        fit = self.parent.fit
+        x = self.fit.line.norm.x
+        n = x.shape[0]
+        lines = self.fit_lines if hasattr(self, 'fit_lines') else []
+
+        # >>> optical depths of the lines and their derivatives in sparse form:
+        l, f, g = np.array([[line.l(), line.f(), line.g()] for line in lines], dtype=float).reshape(-1, 3).T
+        logN, b, z = np.array([[fit.sys[line.sys].sp[line.name.split()[0]].N.val, fit.sys[line.sys].sp[line.name.split()[0]].b.val, fit.sys[line.sys].z.val] for line in lines], dtype=float).reshape(-1, 3).T
+        cfs = np.array([line.cf if fit.cf_fit else -1 for line in lines], dtype=int)
+        ngroups = fit.cf_num + 1 if fit.cf_fit else 1
+        k, ind, t = tau_lines_sparse(x, l, f, g, logN, b, z, resolution=self.resolution, tlim=tau_limit, calc=self.parent.voigt_calc)
+        a, tau0 = lines_a_tau0(l, f, g, logN, b)
+        c = ac.c.to('km/s').value
+        u = (x[ind] / (1 + z[k]) / l[k] - 1) * c / b[k]
+        V = Voigt(1)
+        V.set(a[k], u, 1)
+        dtau = {'N': t * np.log(10),
+                'b': -(t + tau0[k] * (V.H1a * a[k] + V.H1x * u)) / b[k],
+                'z': -tau0[k] * V.H1x * (u * b[k] / c + 1) * c / b[k] / (1 + z[k])}
+
+        # >>> intrinsic flux and derivatives of flux over optical depth in each partial covering group:
+        profiles = np.bincount((cfs[k] + 1) * n + ind, weights=t, minlength=ngroups * n).reshape(ngroups, n)
+        flux, cover = np.exp(-profiles[0]), np.ones_like(profiles)
+        for i in np.unique(cfs[cfs > -1]):
+            cf = fit.getValue('cf_' + str(i))
+            cover[i + 1] = np.exp(-profiles[i + 1]) * cf + (1 - cf)
+            flux *= cover[i + 1]
+        w = -flux * np.ones_like(profiles)
+        for i in np.unique(cfs[cfs > -1]):
+            w[i + 1] *= fit.getValue('cf_' + str(i)) * np.exp(-profiles[i + 1]) / cover[i + 1]
+
+        # >>> convolution (linear operator) of the derivatives within the windows of the lines:
+        split = np.searchsorted(k, np.arange(len(lines) + 1))
+        windows = [(ind[split[i]], ind[split[i + 1] - 1] + 1) if split[i + 1] > split[i] else (0, 0) for i in range(len(lines))]
+        if self.resolution not in [None, 0]:
+            f0 = convolveflux(x, np.zeros_like(x), self.resolution, kind='direct')
+            conv = lambda y, ranges: convolve_res2_update(x, y, self.resolution, np.copy(f0), [r for r in ranges if r[1] > r[0]]) - f0
+            flux_conv = convolveflux(x, flux, self.resolution, kind='direct')
+        else:
+            conv = lambda y, ranges: y
+            flux_conv = flux
+
+        corr = self.correctContinuum(x) if fit.cont_fit and fit.cont_num > 0 else np.ones_like(x)
+        if not self.parent.normview:
+            self.cont.interpolate()
+            corr = corr * self.cont.inter(x)
+
+        for j, name in enumerate(names):
+            s = name.split('_')
+            dflux = None
+            if s[0] in ['z', 'b', 'N'] and len(lines) > 0:
+                sel = np.array([line.sys == int(s[1]) and (s[0] == 'z' or line.name.split()[0] == s[2]) for line in lines])
+                if np.any(sel):
+                    m = sel[k]
+                    dflux = conv(np.bincount(ind[m], weights=w[cfs[k[m]] + 1, ind[m]] * dtau[s[0]][m], minlength=n), [windows[i] for i in np.flatnonzero(sel)])
+                    dflux *= corr
+            elif s[0] == 'cf' and fit.cf_fit and int(s[1]) in cfs:
+                sel = cfs == int(s[1])
+                dflux = conv(flux * (np.exp(-profiles[int(s[1]) + 1]) - 1) / cover[int(s[1]) + 1], [windows[i] for i in np.flatnonzero(sel)]) * corr
+            elif s[0] == 'cont' and fit.cont_fit and fit.cont[int(s[1])].exp == self.ind():
+                cont = fit.cont[int(s[1])]
+                m = (x > cont.left) * (x < cont.right)
+                dflux = np.zeros_like(x)
+                dflux[m] = flux_conv[m] * np.polynomial.chebyshev.chebval((x[m] - cont.left) * 2 / (cont.right - cont.left) - 1, np.eye(cont.num)[int(s[2])])
+                if not self.parent.normview:
+                    dflux *= self.cont.inter(x)
+            if dflux is not None:
+                deriv[:, j] = - np.interp(self.spec.x()[mask], x, dflux, left=0, right=0) / self.spec.err()[mask]
+
+        return deriv
+
     def chi(self):
         mask = self.fit_mask.x()
         if len(self.spec.x()) > 0 and np.sum(mask) > 0 and self.fit.line.n() > 0:
@@ -1,47 +1,87 @@
+import argparse
+from astropy.table import Table
 from lmfit import Parameters
 import matplotlib.pyplot as plt
+from multiprocessing import Pool
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 import os
 import pickle
 from PyQt6.QtCore import Qt
 import pyqtgraph as pg
+from scipy.fft import irfft, next_fast_len, rfft
 from scipy.interpolate import interp1d
 from scipy.optimize import curve_fit, minimize
+import time
 
 from ..profiles import tau, convolveflux, fisherbN
 from ..atomic import line
-from .external import spectres
 from .fit import fitPars
 from .graphics import Spectrum
+from .resample import resample
 from .utils import Timer
 
+def matched_filter(y, templates, masks, err=None, chunk=4096, w_ratio=1e4):
+    """
+    Chi-square of the templates shifted along the spectrum, calculated for the set of templates at once.
+    The chi-square is expanded into the cross-correlations of y^2/err^2, y/err^2 and 1/err^2 with the weighted templates,
+    that are calculated by FFT in the chunks of the shifts, so the memory is bounded by the chunk size.
+    The templates of different length are padded by the zero weights.
+    The expansion loses the precision for the pixels with the weights much larger than typical (roundoff from the large terms
+    spreads over all the shifts), so the pixels with the weights above w_ratio times the median weight are excluded from FFT
+    and their terms are added directly. Roundoff of the remaining terms is at the level of 1e-10 of the typical chi-square.
+    parameters:
+        - y          : fluxes of the spectrum, shape(n)
+        - templates  : list of the template fluxes, each of shape(m_i) or shape(m_i, k_i)
+        - masks      : list of the weights of the template pixels, the same shapes as templates
+        - err        : uncertainties of the spectrum, shape(n), if None the sums of squares are calculated
+        - chunk      : number of the shifts calculated at once
+        - w_ratio    : ratio of the weight to the median weight, above which the pixel terms are calculated directly
+    return:
+        - chi2       : list of the arrays of shape(n - m_i + 1) or shape(n - m_i + 1, k_i), the same as correl3 for each template.
+                       The shifts that cover the pixels with zero or non finite uncertainties (or fluxes) with non zero weights are inf
+    """
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore'):
+        w = np.ones_like(y) if err is None else np.power(np.asarray(err, dtype=float), -2)
+    bad = np.logical_not(np.isfinite(y) * np.isfinite(w))
+    y, w = np.where(bad, 0, y), np.where(bad, 0, w)
+    high = np.where(w > w_ratio * np.median(w[w > 0]))[0] if np.any(w > 0) else np.array([], dtype=int)
+
+    shapes = [np.shape(t) for t in templates]
+    m = max(s[0] for s in shapes)
+    k = np.cumsum([0] + [int(np.prod(s[1:])) for s in shapes])
+    fit, mask = np.zeros([m, k[-1]]), np.zeros([m, k[-1]])
+    for i, (t, ma) in enumerate(zip(templates, masks)):
+        fit[:shapes[i][0], k[i]:k[i+1]] = np.reshape(t, (shapes[i][0], -1))
+        mask[:shapes[i][0], k[i]:k[i+1]] = np.reshape(ma, (shapes[i][0], -1))
+
+    n, L = len(y), next_fast_len(chunk + m - 1)
+    w_fft = np.copy(w)
+    w_fft[high] = 0
+    series = np.concatenate([np.array([y ** 2 * w_fft, y * w_fft, w_fft, bad]), np.zeros([4, m - 1])], axis=1)
+    kernels = rfft(np.array([mask, mask * fit, mask * fit ** 2, mask != 0])[:, ::-1, :], n=L, axis=1)
+
+    chi2, nbad = np.empty([n, k[-1]]), np.empty([n, k[-1]])
+    for i in range(0, n, chunk):
+        num = min(chunk, n - i)
+        s = rfft(series[:, i:i + num + m - 1], n=L, axis=1)[:, :, np.newaxis]
+        chi2[i:i + num] = irfft(s[0] * kernels[0] - 2 * s[1] * kernels[1] + s[2] * kernels[2], n=L, axis=0)[m - 1:m - 1 + num]
+        nbad[i:i + num] = irfft(s[3] * kernels[3], n=L, axis=0)[m - 1:m - 1 + num]
+    # >>> terms of the high weight pixels: pixel j is at the position p = j - shift of the template
+    for j in high:
+        p = np.arange(min(j + 1, m))
+        chi2[j - p] += mask[p] * w[j] * (y[j] - fit[p]) ** 2
+    chi2 = np.maximum(chi2, 0)
+    chi2[nbad > 0.5] = np.inf
+
+    return [chi2[:n - s[0] + 1, k[i]:k[i+1]].reshape((n - s[0] + 1,) + s[1:]) for i, s in enumerate(shapes)]
+
 def correl(y, fit, err=None):
-    stride = y.strides[0]
-    y_strides = as_strided(y, shape=[len(y) - len(fit) + 1, len(fit)], strides=[stride, stride]) - fit
-    if err is not None:
-        err_strides = as_strided(err, shape=[len(err) - len(fit) + 1, len(fit)], strides=[stride, stride])
-        return np.sum(np.power(np.divide(y_strides, err_strides), 2), axis=1)
-    else:
-        return np.sum(np.power(y_strides, 2), axis=1)
+    return matched_filter(y, [fit], [np.ones_like(fit)], err=err)[0]
 
 def correl3(y, fit, mask, err=None):
-    #t = Timer()
-    stride = y.strides[0]
-    #t.time('1')
-    y_s = as_strided(y, shape=[len(y) - fit.shape[0] + 1, fit.shape[0], 4], strides=[stride, stride, 0])
-    #print(y_s.shape)
-    #t.time('2')
-    y_s = y_s - fit
-    #t.time('3')
-    if err is not None:
-        err_strides = as_strided(err, shape=[len(err) - fit.shape[0] + 1, fit.shape[0], 4], strides=[stride, stride, 0])
-        #t.time('4')
-        #s = np.sum(np.divide(y_s, err_strides) ** 2 * mask, axis=1)
-        #t.time('5')
-        return np.sum(np.divide(y_s, err_strides) ** 2 * mask, axis=1)
-    else:
-        return np.sum(y_s**2 * mask, axis=1)
+    return matched_filter(y, [fit], [mask], err=err)[0]
 
 def correlnew(y, fit, mask, err=None):
     #t = Timer()
@@ -53,6 +93,88 @@ def correlnew(y, fit, mask, err=None):
     #t.time('3')
     return np.sum(y_s * mask, axis=1)
 
+def lya_candidates(x, y, err, N_grid, b_grid, xf, f, flux_limit=0.97, koef_red=4):
+    """
+    Find the candidate Lya lines by the matched filter with the templates from the N-b grid (see makeLyagrid_fisher)
+    parameters:
+        - x, y, err     : normalized spectrum
+        - N_grid        : grid of column densities
+        - b_grid        : grid of doppler parameters
+        - xf, f         : wavelengths and fluxes of the templates, shape(len(xf)) and shape(len(N_grid), len(b_grid), len(xf))
+        - flux_limit    : flux limit, which specifies the extent of the templates
+        - koef_red      : normalization of the chi-square
+    return:
+        - lines         : list of (z, i, k, corr, typ) candidates, where i, k are the indices of the template in the grid,
+                          corr is the reduced chi-square and typ is the type of the mask: 'c', 'r', 'l', 'b'
+    """
+    typ = {0: 'c', 1: 'r', 2: 'l', 3: 'b'}
+    xl = xf * x[int(len(x)/2)] / 1215.6701
+    lines = []
+    for i, N in enumerate(N_grid):
+        templates = []
+        for k, b in enumerate(b_grid):
+            # >>> prepare fit
+            inter = interp1d(xl, f[i,k])
+            mask = f[i,k] < flux_limit
+            imin, imax = np.argmin(np.abs(x - xl[mask][0])), np.argmin(np.abs(x - xl[mask][-1]))
+            yf = inter(x[imin:imax])
+            mask = np.ones([len(yf), 4])
+            mask[:, 1] = (yf < 1 - (1 - np.min(yf)) / 2) | (x[imin:imax] > x[(imin + imax) // 2])
+            mask[:, 2] = (yf < 1 - (1 - np.min(yf)) / 2) | (x[imin:imax] < x[(imin + imax) // 2])
+            mask[:, 3] = (yf < 1 - (1 - np.min(yf)) / 3)
+            yf = np.repeat(yf[:,np.newaxis], 4, axis=1)
+
+            ind = np.argmin(np.abs(x-xl[np.argmin(f[i,k])]))
+            templates.append((yf, mask, x[ind-imin:ind-imax+1]))
+
+        # >>> correlate all the b templates of the given N at once
+        corrs = matched_filter(y, [tmp[0] for tmp in templates], [tmp[1] for tmp in templates], err=err)
+        for k, ((yf, mask, x_corr), corr) in enumerate(zip(templates, corrs)):
+            corr = corr / np.sum(mask, axis=0) / koef_red
+
+            # >>> find local minima
+            mask = np.where(corr < 1)
+            if len(mask[0]) > 0:
+                inds = np.hsplit(np.array(mask), np.where(np.diff(mask[0]) > 1)[0] + 1)
+                for ind in inds:
+                    if 0 in ind[1]:
+                        ii = np.where(ind[1] == 0)
+                        imin = ii[0][np.argmin(corr[tuple(ind)][ii])]
+                    else:
+                        imin = np.argmin(corr[tuple(ind)])
+                    lines.append((x_corr[ind[0][imin]] / 1215.6701 - 1, i, k, corr[ind[0][imin], ind[1][imin]], typ[ind[1, imin]]))
+    return lines
+
+def select_candidates(lines):
+    """
+    Sort the candidates by redshift and select the best one in each group of the close candidates
+    parameters:
+        - lines         : list of candidates (see lya_candidates)
+    return:
+        - lines         : candidates sorted by redshift
+        - ind           : indices of the selected candidates
+        - types         : types of the masks of the selected candidates
+    """
+    zi = [l[0] for l in lines]
+    corr = [l[3] for l in lines]
+    c = [l[4] for l in lines]
+    sortind = np.argsort(zi)
+    zi = np.array(zi)[sortind]
+    corr = np.array(corr)[sortind]
+    c = np.array(c)[sortind]
+    ind = np.where(np.diff(zi) > 0.0003)[0] + 1
+    ind = np.insert(ind, 0, 0)
+    ind = np.append(ind, len(zi)-1)
+    types, ix = [], []
+    for i in range(1, len(ind)):
+        if len(corr[ind[i-1]:ind[i]]) > 0:
+            ix.append(ind[i-1]+np.argmin(corr[ind[i-1]:ind[i]]))
+            if 'c' in c[ind[i - 1]:ind[i]]:
+                types.append('c')
+            else:
+                types.append(c[np.floor_divide(ind[i - 1] + ind[i], 2)])
+    return [lines[i] for i in sortind], ix, types
+
 def Lyaforest_scan(parent, data, do='all'):
     """
     Scan for individual Lya forest lines and fit them
@@ -75,7 +197,7 @@ def Lyaforest_scan(parent, data, do='all'):
         x = np.linspace(data[0][1], data[0][-2], int((data[0][-2]-data[0][1])/0.017))
     else:
         x = np.logspace(np.log10(data[0][1]), np.log10(data[0][-2]), int((data[0][-2]-data[0][1])/0.017))
-    y, err = spectres.spectres(data[0], data[1], x, spec_errs=data[2])
+    y, err = resample(data[0], data[1], x, err=data[2])
     print('1')
     s = Spectrum(parent, name='rebinned')
     parent.normview = False
@@ -106,8 +228,6 @@ def Lyaforest_scan(parent, data, do='all'):
 
     t.time('prepare')
 
-    typ = {0: 'c', 1: 'r', 2: 'l', 3: 'b'}
-
     if do in ['all', 'corr']:
         # >>> make Lya line grid
         if 0:
@@ -118,62 +238,10 @@ def Lyaforest_scan(parent, data, do='all'):
             print('res:',s.resolution)
             N_grid, b_grid, xf, f = makeLyagrid_fisher(N_range=[12.5, 14.6], b_range=[8, 50], z=(zmin+zmax)/2, ston=max_ston, resolution=s.resolution, plot=1)
         #N_grid, b_grid, xf, f = makeLyagrid(N_range=[14.39, 14.39], b_range=[28, 28], N_num=1, b_num=1, resolution=s.resolution)
-        xl = xf * x[int(len(x)/2)] / 1215.6701
         t.time('make Lya grid')
 
         # >>> calc fit line
-        show_corr = 0
-        lines = []
-        for i, N in enumerate(N_grid):
-            print(i)
-            for k, b in enumerate(b_grid):
-                # >>> prepare fit
-                inter = interp1d(xl, f[i,k])
-                mask = f[i,k] < flux_limit
-                imin, imax = np.argmin(np.abs(x - xl[mask][0])), np.argmin(np.abs(x - xl[mask][-1]))
-                yf = inter(x[imin:imax])
-                mask = np.ones([len(yf), 4])
-                mask[:, 1] = (yf < 1 - (1 - np.min(yf)) / 2) | (x[imin:imax] > x[(imin + imax) // 2])
-                mask[:, 2] = (yf < 1 - (1 - np.min(yf)) / 2) | (x[imin:imax] < x[(imin + imax) // 2])
-                mask[:, 3] = (yf < 1 - (1 - np.min(yf)) / 3)
-                yf = np.repeat(yf[:,np.newaxis], 4, axis=1)
-
-                ind = np.argmin(np.abs(x-xl[np.argmin(f[i,k])]))
-                x_corr = x[ind-imin:ind-imax+1]
-
-                #t.time('prepare fit')
-
-                corr = correl3(y, yf, mask, err) / np.sum(mask, axis=0) / koef_red
-                #print(corr.shape, corr)
-                if show_corr:
-                    for l in range(4):
-                        s = Spectrum(parent, name='correlation_'+typ[l])
-                        if 1:
-                            s.set_data([x_corr, corr[:, l]])
-                            s.spec.norm.set_data(x_corr, corr[:, l])
-                        else:
-                            pos = np.argmin(np.abs(x - 3954.761))
-                            s.set_data([x[imin - ind + pos:imax - ind + pos], yf[:, l] * mask[:, l]])
-                            s.spec.norm.set_data(x[imin - ind + pos:imax - ind + pos], yf[:, l]* mask[:, l])
-                        parent.s.append(s)
-                        parent.s.ind = 1
-                        parent.s.redraw()
-
-                #t.time('correlate')
-                mask = np.where(corr < 1)
-                if len(mask[0]) > 0:
-                    inds = np.hsplit(np.array(mask), np.where(np.diff(mask[0]) > 1)[0] + 1)
-                    #print('inds:', inds)
-                    for ind in inds:
-                        #print('ind:', tuple(ind))
-                        if 0 in ind[1]:
-                            ii = np.where(ind[1] == 0)
-                            imin = ii[0][np.argmin(corr[tuple(ind)][ii])]
-                        else:
-                            imin = np.argmin(corr[tuple(ind)])
-                        lines.append((x_corr[ind[0][imin]] / 1215.6701 - 1, i, k, corr[ind[0][imin], ind[1][imin]], typ[ind[1, imin]]))
-                #t.time('find local minima')
-            t.time('loop')
+        lines = lya_candidates(x, y, err, N_grid, b_grid, xf, f, flux_limit=flux_limit, koef_red=koef_red)
         with open('C:/Users/ksush/work/Lyasample/pickle/' + qsoname, 'wb') as fil:
             pickle.dump((N_grid, b_grid, xf, f, lines), fil)
         t.time('fit lines')
@@ -181,26 +249,7 @@ def Lyaforest_scan(parent, data, do='all'):
         with open('C:/Users/ksush/work/Lyasample/pickle/' + qsoname, 'rb') as fil:
             N_grid, b_grid, xf, f, lines = pickle.load(fil)
 
-    zi = [l[0] for l in lines]
-    corr = [l[3] for l in lines]
-    c = [l[4] for l in lines]
-    sortind = np.argsort(zi)
-    zi = np.array(zi)[sortind]
-    corr = np.array(corr)[sortind]
-    c = np.array(c)[sortind]
-    ind = np.where(np.diff(zi) > 0.0003)[0] + 1
-    ind = np.insert(ind, 0, 0)
-    ind = np.append(ind, len(zi)-1)
-    types, ix = [], []
-    for i in range(1, len(ind)):
-        if len(corr[ind[i-1]:ind[i]]) > 0:
-            #print(corr[ind[i-1]:ind[i]], np.argmin(corr[ind[i-1]:ind[i]]), ind[i-1]+np.argmin(corr[ind[i-1]:ind[i]]))
-            ix.append(ind[i-1]+np.argmin(corr[ind[i-1]:ind[i]]))
-            if 'c' in c[ind[i - 1]:ind[i]]:
-                types.append('c')
-            else:
-                types.append(c[np.floor_divide(ind[i - 1] + ind[i], 2)])
-    ind = ix
+    lines, ind, types = select_candidates(lines)
 
     # >>> fit lines
     #print(ind)
@@ -356,7 +405,7 @@ def Lyaforest_scan(parent, data, do='all'):
         #to update old mask for drawing actual profiles for dynamic_mask regime
 
         def update_mask(z,N,b,typ):
-            line_ = tau(line=line('lya', l=1215.6701, f=0.4164, g=6.265e8, z=z, logN=N, b=b), resolution=parent.s[0].resolution)
+            line_ = tau(line=line('lya', l=1215.6701, f=0.4164, g=6.265e8, z=z, logN=N, b=b), resolution=parent.s[0].resolution, calc=parent.voigt_calc)
             line_.calctau()
             flux = convolveflux(line_.x, np.exp(-line_.tau), res=parent.s[0].resolution)
             x, y, err = parent.s[0].spec.x(), parent.s[0].spec.y(), parent.s[0].spec.err()
@@ -394,7 +443,6 @@ def Lyaforest_scan(parent, data, do='all'):
         #---------------------------------------------------------------------------------------------------------------
 
         m = np.zeros_like(parent.s[0].spec.x(), dtype=bool)
-        lines = [lines[i] for i in sortind]
         if len(lines) > 0:
             i = 0
             while i < len(ind):
@@ -415,7 +463,7 @@ def Lyaforest_scan(parent, data, do='all'):
                     x_stat, y_stat, err_stat = x[mask], y[mask], err[mask]
                     global line_
 
-                    line_ = tau(z=l[0], logN=N_grid[l[1]], b=b_grid[l[2]], resolution=parent.s[0].resolution)
+                    line_ = tau(z=l[0], logN=N_grid[l[1]], b=b_grid[l[2]], resolution=parent.s[0].resolution, calc=parent.voigt_calc)
                     if 1 or (1 - np.min(f[l[1], l[2]])) / np.mean(err) > 3:
                         save_N, save_b = line_.logN, line_.b
 
@@ -468,7 +516,7 @@ def Lyaforest_scan(parent, data, do='all'):
                             if lyb:
                                 lyb = False
                                 for lylines in [line('lyb', l=1025.7223, f=0.07912, g=1.897e8, z=z, logN=N, b=b), line('lyg', l=972.5368, f=0.02900, g=8.127e7, z=z, logN=N, b=b)]:
-                                    line_ = tau(line=lylines, resolution=parent.s[0].resolution)
+                                    line_ = tau(line=lylines, resolution=parent.s[0].resolution, calc=parent.voigt_calc)
                                     line_.calctau()
                                     flux = convolveflux(line_.x, np.exp(-line_.tau), res=parent.s[0].resolution)
                                     #x, y, err = parent.s[0].spec.x(), parent.s[0].spec.y(), parent.s[0].spec.err()
@@ -490,7 +538,7 @@ def Lyaforest_scan(parent, data, do='all'):
                                     if 1:#z>3.787 and z<3.789:temporary block
                                         line_ = tau(
                                             line=line('lya', l=1215.6701, f=0.4164, g=6.265e8, z=z, logN=N, b=b),
-                                            resolution=parent.s[0].resolution)
+                                            resolution=parent.s[0].resolution, calc=parent.voigt_calc)
                                         line_.calctau()
                                         flux = convolveflux(line_.x, np.exp(-line_.tau), res=parent.s[0].resolution)
                                         #x, y, err = parent.s[0].spec.x(), parent.s[0].spec.y(), parent.s[0].spec.err()
@@ -549,9 +597,9 @@ def Lyaforest_scan(parent, data, do='all'):
         parent.s.calcFit()
         parent.s.redraw()
 
-def makeLyagrid_uniform(N_range=[13., 14], b_range=[20, 30], N_num=30, b_num=30, resolution=50000):
+def makeLyagrid_uniform(N_range=[13., 14], b_range=[20, 30], N_num=30, b_num=30, resolution=50000, calc='table'):
 
-    line = tau(resolution=0)
+    line = tau(resolution=0, calc=calc)
     x = np.linspace(line.l * (1 - 3 * b_range[-1]/300000), line.l * (1 + 3 * b_range[-1]/300000), 501)
 
     N_grid = np.linspace(N_range[0], N_range[-1], N_num)
@@ -567,10 +615,11 @@ def makeLyagrid_uniform(N_range=[13., 14], b_range=[20, 30], N_num=30, b_num=30,
 
     return N_grid, b_grid, x, flux
 
-def makeLyagrid_fisher(N_range=[13., 14], b_range=[20, 30], ston=10, z=0, resolution=50000, plot=0):
+def makeLyagrid_fisher(N_range=[13., 14], b_range=[20, 30], ston=10, z=0, resolution=50000, plot=0, calc='table', verbose=True):
 
     koef = 8
-    print(N_range, b_range,ston)
+    if verbose:
+        print(N_range, b_range,ston)
 
     lines = [line('lya', l=1215.6701, f=0.4164, g=6.265e8, z=z)]
     N_grid, b_grid = [N_range[0]], [b_range[0]]
@@ -586,7 +635,8 @@ def makeLyagrid_fisher(N_range=[13., 14], b_range=[20, 30], ston=10, z=0, resolu
             dN, db, F, Fmin = fisherbN(N, b_grid[-1], lines, ston=ston, resolution=resolution)
             bmin = min(bmin, db)
         b_grid.append(b_grid[-1] + koef * bmin)
-    print(len(N_grid), len(b_grid))
+    if verbose:
+        print(len(N_grid), len(b_grid))
 
     if 0 or plot:
         fig, ax = plt.subplots()
@@ -596,7 +646,7 @@ def makeLyagrid_fisher(N_range=[13., 14], b_range=[20, 30], ston=10, z=0, resolu
               ax.errorbar(N, b, xerr=dN, yerr=db, fmt='o', color='k')
         plt.show()
 
-    l = tau(resolution=0)
+    l = tau(resolution=0, calc=calc)
     x = np.linspace(l.l * (1 - 3 * b_range[-1] / 300000), l.l * (1 + 3 * b_range[-1] / 300000), 501)
 
     flux = np.empty([len(N_grid), len(b_grid), len(x)])
@@ -610,6 +660,279 @@ def makeLyagrid_fisher(N_range=[13., 14], b_range=[20, 30], ston=10, z=0, resolu
 
     return N_grid, b_grid, x, flux
 
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+# >>>
+# >>>   GUI-free scan of the Lya forest over the catalog of spectra
+# >>>
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+lya_lines_dtype = [('z', float), ('z_err', float), ('logN', float), ('logN_err', float), ('b', float), ('b_err', float), ('snr', float), ('chi2', float), ('npix', int), ('type', 'U1')]
+
+def prepare_spectrum(data, step=0.017):
+    """
+    Rebin the normalized spectrum to the logarithmic grid and estimate the signal to noise ratio, as in Lyaforest_scan
+    parameters:
+        - data       : normalized spectrum, shape(3, n)
+        - step       : pixel size in Angstrom
+    return:
+        - x, y, err  : rebinned spectrum
+        - snr        : interpolation function of the signal to noise ratio
+    """
+    x = np.logspace(np.log10(data[0][1]), np.log10(data[0][-2]), int((data[0][-2] - data[0][1]) / step))
+    y, err = resample(data[0], data[1], x, err=data[2])
+    mask = (np.abs((y - 1) / err) < 5) * (err > 0)
+    window = 300
+    box = np.ones(window) / window
+    snr = interp1d(x[mask], np.convolve(y[mask] / err[mask], box, mode='same'), fill_value='extrapolate')
+    return x, y, err, snr
+
+def lya_flux(z, logN, b, resolution, calc='spec'):
+    """
+    Interpolation function of the Lya line profile convolved with instrument function
+    """
+    l = tau(z=z, logN=logN, b=b, resolution=resolution, calc=calc)
+    l.calctau()
+    return interp1d(l.x, convolveflux(l.x, np.exp(-l.tau), res=resolution), bounds_error=False, fill_value=1), l.x
+
+def lya_line_mask(x, err, intx, typ, flux_limit=0.97):
+    """
+    Mask of the pixels used in the fit of the line with the given type of the mask (the same as in Lyaforest_scan)
+    parameters:
+        - x, err     : wavelengths and uncertainties of the spectrum
+        - intx       : line profile at x
+        - typ        : type of the mask: 'c' - whole line, 'l', 'r' - left and right wings are partly masked, 'b' - both wings are partly masked
+    return:
+        - mask       : mask, or None if the mask can not be constructed
+    """
+    mask0 = intx <= flux_limit
+    if np.sum(mask0) <= 3:
+        return None
+    xmin, xmax = x[mask0][0], x[mask0][-1]
+    if typ in ['l', 'r', 'b']:
+        mask2 = intx <= 1 - (1 - np.min(intx)) / (3 if typ == 'b' else 2)
+        if np.sum(mask2) >= np.sum(mask0):
+            return None
+        d = np.where(np.diff(mask2) > 0)[0]
+        if typ in ['r', 'b']:
+            xmin = x[np.min(d) + 1]
+        if typ in ['l', 'b']:
+            xmax = x[np.max(d)]
+    mask = (x >= xmin) * (x <= xmax) * (err > 0)
+    return mask if np.sum(mask) > 3 else None
+
+def template_mask(x, err, l, typ, xf, f, flux_limit=0.97):
+    """
+    Mask of the pixels covered by the template of the candidate line (the same as in Lyaforest_scan)
+    parameters:
+        - x, err     : wavelengths and uncertainties of the spectrum
+        - l          : candidate (see lya_candidates)
+        - typ        : type of the mask, or 'over' for the extended region around the line
+        - xf, f      : wavelengths and fluxes of the templates
+    """
+    fl = f[l[1], l[2]]
+    mask = fl < flux_limit
+    xmin, xmax = xf[mask][0], xf[mask][-1]
+    if typ in ['l', 'r', 'b']:
+        d = np.where(np.diff(fl < 1 - (1 - np.min(fl)) / (3 if typ == 'b' else 2)) > 0)[0]
+        if typ in ['r', 'b']:
+            xmin = xf[np.min(d)]
+        if typ in ['l', 'b']:
+            xmax = xf[np.max(d)]
+    elif typ == 'over':
+        imin, imax = np.argmin(np.abs(xf - (3 * xmin - xmax) / 2)), np.argmin(np.abs(xf - (3 * xmax - xmin) / 2))
+        xmin, xmax = xf[imin], xf[imax]
+    return (x > xmin * (1 + l[0])) * (x < xmax * (1 + l[0])) * (err > 0)
+
+def fit_candidates(x, y, err, snr, lines, ind, types, N_grid, b_grid, xf, f, resolution, calc='spec', flux_limit=0.97):
+    """
+    Fit the selected candidates by the Lya lines with the dynamic masks, as in Lyaforest_scan, but without GUI.
+    The lines are accepted, if the reduced chi-square < 3, the parameters are constrained at 5 sigma level (by Fisher matrix)
+    and the line is consistent with Lyb and Lyg
+    parameters:
+        - x, y, err     : normalized spectrum (see prepare_spectrum)
+        - snr           : interpolation function of the signal to noise ratio
+        - lines, ind, types : candidates (see select_candidates)
+        - N_grid, b_grid, xf, f : grid of templates
+        - resolution    : spectral resolution
+        - calc          : calculation of the Voigt function
+    return:
+        - res           : structured array with lya_lines_dtype.
+                          The uncertainty of z is from the covariance of the linearized fit, the ones of N and b are from Fisher matrix
+        - m             : mask of the pixels covered by the accepted lines
+    """
+    m = np.zeros_like(x, dtype=bool)
+    res = []
+
+    def z_error(p, mask):
+        # covariance of the fit parameters is the inverse of J^T J, where J is the jacobian of the residuals at the pixels of the mask
+        dp = np.array([(1 + p[0]) * p[2] / 299792.458 * 1e-2, 1e-2, p[2] * 1e-2])
+        J = np.empty([3, np.sum(mask)])
+        for k in range(3):
+            p1, p2 = np.array(p), np.array(p)
+            p1[k], p2[k] = p[k] + dp[k], p[k] - dp[k]
+            J[k] = (lya_flux(*p1, resolution=resolution, calc=calc)[0](x[mask]) - lya_flux(*p2, resolution=resolution, calc=calc)[0](x[mask])) / 2 / dp[k] / err[mask]
+        try:
+            return np.sqrt(np.linalg.inv(np.dot(J, J.T))[0, 0])
+        except np.linalg.LinAlgError:
+            return np.nan
+
+    def chi2(p, typ, mask_over):
+        inter, lx = lya_flux(*p, resolution=resolution, calc=calc)
+        sl = slice(np.searchsorted(x, lx[0]), np.searchsorted(x, lx[-1], side='right'))
+        intx = inter(x[sl])
+        mask0 = intx <= flux_limit
+        if np.sum(mask0) <= 3 or np.sum(mask0 * mask_over[sl]) < np.sum(mask0):
+            return 1e10
+        mask = lya_line_mask(x[sl], err[sl], intx, typ, flux_limit=flux_limit)
+        if mask is None:
+            return 1e10
+        return np.sum(((y[sl][mask] - intx[mask]) / err[sl][mask]) ** 2) / (np.sum(mask) - 3)
+
+    i = 0
+    while i < len(ind):
+        l, typ = lines[ind[i]], types[i]
+        mask = template_mask(x, err, l, typ, xf, f, flux_limit=flux_limit)
+        mask_next = template_mask(x, err, lines[ind[i+1]], types[i+1], xf, f, flux_limit=flux_limit) if ind[i] < ind[-1] else np.zeros_like(mask)
+        if np.sum(mask * mask_next) > 4:
+            i += 1
+        else:
+            mask_over = template_mask(x, err, l, 'over', xf, f, flux_limit=flux_limit)
+            bounds = ((l[0] * (1 - 5 / resolution), l[0] * (1 + 5 / resolution)), (11, 20), (5, 200))
+            result = minimize(chi2, x0=(l[0], N_grid[l[1]], b_grid[l[2]]), method='Nelder-Mead', args=(typ, mask_over), bounds=bounds)
+            z, N, b = tuple(result.x)
+            s = float(snr(1215.67 * (1 + z)))
+            Nerr, berr, F, Fmin = fisherbN(N, b, [line('lya', l=1215.6701, f=0.4164, g=6.265e8, z=z)], ston=s, resolution=resolution)
+            if result.fun < 3 and N / Nerr > 5 and b / berr > 5:
+                # >>> check consistency with Lyb and Lyg lines
+                lyb = False
+                for lylines in [line('lyb', l=1025.7223, f=0.07912, g=1.897e8, z=z, logN=N, b=b), line('lyg', l=972.5368, f=0.02900, g=8.127e7, z=z, logN=N, b=b)]:
+                    line_ = tau(line=lylines, resolution=resolution, calc=calc)
+                    line_.calctau()
+                    inter = interp1d(line_.x, convolveflux(line_.x, np.exp(-line_.tau), res=resolution), bounds_error=False, fill_value=1)
+                    m_lyb = (x > line_.x[0]) * (x < line_.x[-1])
+                    m1 = (y[m_lyb] > inter(x[m_lyb])) * (err[m_lyb] > 0)
+                    if np.sum(m1) > 10 and np.sum(((y[m_lyb][m1] - inter(x[m_lyb])[m1]) / err[m_lyb][m1]) ** 2) / np.sum(m1) > 4:
+                        lyb = True
+                        break
+                if not lyb:
+                    mask_upd = lya_line_mask(x, err, lya_flux(z, N, b, resolution=resolution, calc=calc)[0](x), typ, flux_limit=flux_limit)
+                    if mask_upd is not None:
+                        m = np.logical_or(m, mask_upd)
+                        res.append((z, z_error((z, N, b), mask_upd), N, Nerr, b, berr, s, result.fun, np.sum(mask_upd), typ))
+        i += 1
+
+    return np.array(res, dtype=lya_lines_dtype), m
+
+def scan_spectrum(data, resolution, calc='spec', N_range=[12.5, 14.6], b_range=[8, 50], candidates=None, checkpoint=None):
+    """
+    Scan the normalized spectrum for Lya forest lines without GUI: the correlation and the fit stages of Lyaforest_scan
+    parameters:
+        - data          : normalized spectrum, shape(3, n)
+        - resolution    : spectral resolution
+        - calc          : calculation of the Voigt function
+        - N_range       : range of column densities of the templates
+        - b_range       : range of doppler parameters of the templates
+        - candidates    : name of .npz file with the results of the correlation stage. If it exists and can be read, the correlation is skipped,
+                          otherwise the results are saved to it
+    return:
+        - res           : structured array of the accepted lines, see fit_candidates
+    """
+    x, y, err, snr = prepare_spectrum(data)
+    lines = None
+    if candidates is not None and os.path.exists(candidates):
+        try:
+            with np.load(candidates) as d:
+                N_grid, b_grid, xf, f = d['N_grid'], d['b_grid'], d['xf'], d['f']
+                lines = [(l['z'], l['i'], l['k'], l['corr'], l['typ']) for l in d['lines']]
+        except Exception:
+            # the checkpoint can not be read (e.g. it is damaged), so the correlation is recalculated
+            lines = None
+    if lines is None:
+        zmin, zmax = x[0] / 1215.6701 - 1, x[-1] / 1215.6701 - 1
+        max_ston = np.max(snr(np.linspace(x[0], x[-1], 50)))
+        N_grid, b_grid, xf, f = makeLyagrid_fisher(N_range=N_range, b_range=b_range, z=(zmin + zmax) / 2, ston=max_ston, resolution=resolution, calc=calc, verbose=False)
+        lines = lya_candidates(x, y, err, N_grid, b_grid, xf, f)
+        if candidates is not None:
+            # write to the temporary file and rename, so the interrupted run does not leave the partial checkpoint
+            with open(candidates + '.tmp', 'wb') as fh:
+                np.savez(fh, N_grid=N_grid, b_grid=b_grid, xf=xf, f=f,
+                         lines=np.array(lines, dtype=[('z', float), ('i', int), ('k', int), ('corr', float), ('typ', 'U1')]))
+            os.replace(candidates + '.tmp', candidates)
+
+    if len(lines) == 0:
+        return np.zeros(0, dtype=lya_lines_dtype)
+    lines, ind, types = select_candidates(lines)
+    return fit_candidates(x, y, err, snr, lines, ind, types, N_grid, b_grid, xf, f, resolution, calc=calc)[0]
+
+def scan_file(filename, name=None, resolution=50000, output='.', calc='spec', overwrite=False):
+    """
+    Scan single spectrum and write the line list to <output>/<name>.ecsv.
+    The results of the correlation stage are kept in <output>/<name>.corr.npz, so the interrupted run is resumed from them,
+    and the sightlines with existing line lists are skipped (unless overwrite).
+    Returns the dictionary with the report.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0] if name is None else name
+    out = os.path.join(output, name + '.ecsv')
+    report = {'name': name, 'status': 'ok', 'nlines': 0}
+    start = time.time()
+    if os.path.exists(out) and not overwrite:
+        report['status'] = 'done'
+    else:
+        try:
+            from .batch import spvSession
+            data = spvSession().readSpectrum(filename)
+            res = scan_spectrum(data, resolution, calc=calc, candidates=os.path.join(output, name + '.corr.npz'))
+            t = Table(res)
+            t.meta['name'], t.meta['filename'], t.meta['resolution'] = name, filename, resolution
+            t.write(out + '.tmp', format='ascii.ecsv', overwrite=True)
+            os.replace(out + '.tmp', out)
+            report['nlines'] = len(res)
+        except Exception as e:
+            report['status'] = 'failed: {}'.format(e)
+    report['total'] = time.time() - start
+    return report
+
+def _scan_file(kwargs):
+    return scan_file(**kwargs)
+
+def main(argv=None):
+    """
+    Scan of the Lya forest over the catalog of normalized spectra without GUI:
+        python -m spectro.sviewer lyaforest catalog.dat [-o output] [-j threads]
+    The catalog is ascii table with the columns: filename, and optionally name and resolution.
+    """
+    parser = argparse.ArgumentParser(prog='python -m spectro.sviewer lyaforest', description='Headless scan of the Lya forest lines over the catalog of spectra')
+    parser.add_argument('catalog', help='ascii table with columns: filename [name] [resolution]')
+    parser.add_argument('-o', '--output', default='.', help='folder for the line lists and checkpoints')
+    parser.add_argument('-r', '--resolution', type=float, default=50000, help='resolution of the spectra, if not given in the catalog')
+    parser.add_argument('--voigt', choices=['spec', 'table'], default='spec', help='direct (wofz) or table driven calculation of Voigt function')
+    parser.add_argument('--overwrite', action='store_true', help='rescan the sightlines with existing line lists')
+    parser.add_argument('-j', '--threads', type=int, default=1, help='number of processes to scan spectra in parallel')
+    args = parser.parse_args(argv)
+
+    cat = Table.read(args.catalog, format='ascii')
+    folder = os.path.dirname(os.path.abspath(args.catalog))
+    os.makedirs(args.output, exist_ok=True)
+    tasks = [dict(filename=os.path.join(folder, str(c['filename'])), name=str(c['name']) if 'name' in cat.colnames else None,
+                  resolution=float(c['resolution']) if 'resolution' in cat.colnames else args.resolution,
+                  output=args.output, calc=args.voigt, overwrite=args.overwrite) for c in cat]
+
+    t = Timer(verbose=False)
+    if args.threads > 1:
+        with Pool(args.threads) as pool:
+            reports = []
+            for r in pool.imap_unordered(_scan_file, tasks):
+                reports.append(r)
+                print('{0:40s} {1:8.2f} {2:6d}  {3}'.format(r['name'], r['total'], r['nlines'], r['status']))
+    else:
+        reports = []
+        for task in tasks:
+            reports.append(_scan_file(task))
+            print('{0:40s} {1:8.2f} {2:6d}  {3}'.format(reports[-1]['name'], reports[-1]['total'], reports[-1]['nlines'], reports[-1]['status']))
+    print('total time: {0:.2f} s for {1:d} spectra'.format(t.time(), len(reports)))
+
+    return int(any([r['status'].startswith('failed') for r in reports]))
+
 class plotLyalines(pg.PlotWidget):
     def __init__(self, parent):
         self.parent = parent
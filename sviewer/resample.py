@@ -0,0 +1,223 @@
+import collections
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+# >>>
+# >>>   Flux conserving resampling by sparse overlap matrices
+# >>>
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+_matrices = collections.OrderedDict()
+cache_size = 32
+
+def bin_edges(x):
+    """
+    Edges of the spectral bins from their central wavelengths (the same as in spectres)
+    parameters:
+        - x          : central wavelengths of the bins, shape(N)
+    return:
+        - edges      : edges of the bins, shape(N+1)
+    """
+    edges = np.empty(x.shape[0] + 1)
+    edges[0] = x[0] - (x[1] - x[0]) / 2
+    edges[-1] = x[-1] + (x[-1] - x[-2]) / 2
+    edges[1:-1] = (x[1:] + x[:-1]) / 2
+    return edges
+
+def grid_hash(x):
+    return hashlib.md5(np.ascontiguousarray(x, dtype=float).tobytes()).hexdigest()
+
+def edges_slice(x, start, stop):
+    """
+    Edges of the part of the bins, the same as bin_edges(x)[start:stop+1], but without calculation for the whole grid
+    parameters:
+        - x          : central wavelengths of the bins, shape(N)
+        - start, stop : range of the bins
+    return:
+        - edges      : edges of the bins, shape(stop-start+1)
+    """
+    lo, hi = max(start - 1, 0), min(stop + 1, len(x))
+    return bin_edges(x[lo:hi])[start - lo:stop - lo + 1]
+
+def overlap_matrix(x, x_new, rows=None):
+    """
+    Sparse matrix of the normalized overlaps between the bins of the new and initial grids (not cached).
+    Only the edges of the initial grid around the requested rows are calculated,
+    so the cost is set by the size of the rows, not the grids.
+    parameters:
+        - x          : initial grid, shape(N)
+        - x_new      : new grid, shape(M)
+        - rows       : slice of the new grid (with unit step), if None all the bins
+    return:
+        - W          : csr matrix of shape(len(rows), N).
+                       The rows of the new bins that are not fully covered by the initial grid are empty.
+    """
+    x, x_new = np.asarray(x, dtype=float), np.asarray(x_new, dtype=float)
+    start, stop, _ = (rows if rows is not None else slice(None)).indices(len(x_new))
+    stop = max(stop, start)
+    e_new = edges_slice(x_new, start, stop)
+    i0 = max(np.searchsorted(x, e_new[0]) - 1, 0)
+    i1 = min(np.searchsorted(x, e_new[-1]) + 1, len(x))
+    e = edges_slice(x, i0, i1)
+
+    start_b = np.searchsorted(e, e_new[:-1], side='right') - 1
+    stop_b = np.searchsorted(e, e_new[1:], side='left') - 1
+    covered = (e_new[:-1] >= e[0]) * (e_new[1:] <= e[-1])
+    num = np.where(covered, stop_b - start_b + 1, 0)
+
+    r = np.repeat(np.arange(stop - start), num)
+    cols = np.repeat(start_b, num) + np.arange(np.sum(num)) - np.repeat(np.cumsum(num) - num, num)
+    w = np.minimum(e[cols + 1], e_new[r + 1]) - np.maximum(e[cols], e_new[r])
+    w /= np.bincount(r, weights=w, minlength=stop - start)[r]
+
+    return csr_matrix((w, (r, cols + i0)), shape=(stop - start, len(x)))
+
+def rebin_matrix(x, x_new):
+    """
+    Overlap matrices (see overlap_matrix) for the whole grids, cached by the hashes of the grids,
+    so interactive resampling of many spectra on the same grids is done once.
+    parameters:
+        - x          : initial grid, shape(N)
+        - x_new      : new grid, shape(M)
+    return:
+        - W, W2      : csr matrices of shape(M, N) for fluxes and for variances.
+    """
+    key = (grid_hash(x), grid_hash(x_new))
+    if key in _matrices:
+        _matrices.move_to_end(key)
+        return _matrices[key]
+
+    W = overlap_matrix(x, x_new)
+    _matrices[key] = (W, W.multiply(W).tocsr())
+    if len(_matrices) > cache_size:
+        _matrices.popitem(last=False)
+    return _matrices[key]
+
+def resample(x, y, x_new, err=None, fill_value=np.nan, rows=None, cache=True):
+    """
+    Flux conserving resampling of the spectrum (or set of spectra) to the new grid.
+    It gives the same results as spectres, but the matrix of the bin overlaps is calculated once for the pair of grids
+    and applied to the fluxes (and errors) by single sparse matrix product.
+    parameters:
+        - x          : initial grid, shape(N)
+        - y          : fluxes, shape(N) or shape(N, K) for the K spectra on the same grid.
+                       Masks can be resampled as float arrays, then the values give the covered fraction of the new bins.
+        - x_new      : new grid, shape(M)
+        - err        : uncertainties, same shape as y, if None only fluxes are returned
+        - fill_value : value for the new bins that are not covered by the initial grid
+        - rows       : slice of the new grid to calculate, if None calculate all the bins
+        - cache      : if True, use the cached matrices of the whole grids (see rebin_matrix),
+                       otherwise calculate the matrix only for the rows, without storing it (for one-off grids)
+    return:
+        - y_new      : resampled fluxes
+        - err_new    : resampled uncertainties, if err is not None
+    """
+    if cache:
+        W, W2 = rebin_matrix(x, x_new)
+        if rows is not None:
+            W, W2 = W[rows], W2[rows]
+    else:
+        W = overlap_matrix(x, x_new, rows=rows)
+        W2 = W.multiply(W).tocsr() if err is not None else None
+    empty = np.diff(W.indptr) == 0
+
+    y_new = W @ np.asarray(y, dtype=float)
+    y_new[empty] = fill_value
+    if err is None:
+        return y_new
+
+    err_new = np.sqrt(W2 @ np.asarray(err, dtype=float) ** 2)
+    err_new[empty] = fill_value
+    return y_new, err_new
+
+class coadd():
+    """
+    Streaming co-addition of the exposures on the common grid.
+    The sums for the means and inverse variances are accumulated exposure by exposure, so only the arrays of the grid size are kept.
+    The median is calculated exactly in chunks of the grid, by the second pass over the added exposures,
+    that are kept by reference (they can be memory mapped arrays, e.g. from np.load(..., mmap_mode='r')).
+    parameters:
+        - x          : common grid
+        - typ        : type of combine, can be either 'Weighted mean', 'Mean' or 'Median'
+        - chunk      : number of the grid pixels in chunk for median calculation
+    """
+    def __init__(self, x, typ='Weighted mean', chunk=100000):
+        self.x = np.asarray(x, dtype=float)
+        self.typ = typ
+        self.chunk = chunk
+        self.n = np.zeros_like(self.x)
+        self.s_y = np.zeros_like(self.x)
+        self.s_w = np.zeros_like(self.x)
+        self.s_yw = np.zeros_like(self.x)
+        self.exposures = []
+
+    def project(self, x, y, err, bad=None, rows=slice(None)):
+        """
+        project the exposure to the (part of) common grid
+        parameters:
+            - x, y, err  : wavelengths, fluxes and uncertainties of the exposure
+            - bad        : mask of bad pixels of the exposure, their uncertainties are set to nan
+            - rows       : slice of the common grid
+        return:
+            - comb, e_comb : fluxes and uncertainties on the grid (nan outside the exposure)
+        """
+        start, stop, _ = rows.indices(len(self.x))
+        comb, e_comb = np.full(stop - start, np.nan), np.full(stop - start, np.nan)
+        if (len(self.x) == len(x)) and (np.max(np.abs(self.x - x)) < 0.01 * np.max(np.diff(self.x))):
+            comb[:], e_comb[:] = y[rows], err[rows]
+        else:
+            mask_s = (np.asarray(err) != 0)
+            xs = np.asarray(x)[mask_s]
+            # the exposure covers the part [i_lo:i_hi] of the grid, the matrix is calculated only for its rows in the chunk
+            i_lo, i_hi = np.searchsorted(self.x, xs[2], side='right'), np.searchsorted(self.x, xs[-3], side='left')
+            lo = min(max(start, i_lo), i_hi)
+            hi = max(min(stop, i_hi), lo)
+            if hi > lo:
+                comb[lo - start:hi - start], e_comb[lo - start:hi - start] = resample(xs, np.asarray(y)[mask_s], self.x[i_lo:i_hi], err=np.asarray(err)[mask_s],
+                                                                                       rows=slice(lo - i_lo, hi - i_lo), cache=False)
+        if bad is not None:
+            i = np.searchsorted(self.x, np.asarray(x)[np.where(bad)[0]]) - start
+            e_comb[i[(i >= 0) * (i < stop - start)]] = np.nan
+        return comb, e_comb
+
+    def add(self, x, y, err, bad=None):
+        """
+        add the exposure to the co-addition
+        parameters:
+            - x, y, err  : wavelengths, fluxes and uncertainties of the exposure
+            - bad        : mask of bad pixels of the exposure
+        """
+        comb, e_comb = self.project(x, y, err, bad=bad)
+        w = np.power(e_comb, -2)
+        self.n += np.isfinite(comb)
+        self.s_y += np.nan_to_num(comb, nan=0)
+        self.s_w += np.where(np.isnan(w), 0, w)
+        self.s_yw += np.where(np.isnan(comb * w), 0, comb * w)
+        if self.typ == 'Median':
+            self.exposures.append((x, y, err, bad))
+
+    def median(self):
+        y = np.full_like(self.x, np.nan)
+        for start in range(0, len(self.x), self.chunk):
+            rows = slice(start, min(start + self.chunk, len(self.x)))
+            comb = np.array([self.project(*e, rows=rows)[0] for e in self.exposures])
+            with np.errstate(all='ignore'):
+                y[rows] = np.nanmedian(comb, axis=0) if len(self.exposures) > 0 else np.nan
+        return y
+
+    def result(self):
+        """
+        return:
+            - y, err     : co-added fluxes and uncertainties on the grid (nan where no data)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.typ == 'Median':
+                y = self.median()
+            elif self.typ == 'Mean':
+                y = self.s_y / self.n
+            elif self.typ == 'Weighted mean':
+                y = self.s_yw / self.s_w
+            err = np.power(self.s_w, -0.5)
+        return y, err
@@ -22,13 +22,53 @@ from .graphics import Spectrum, Speclist
 from .utils import Timer, labelLine
 
 class Stack():
-    def __init__(self, num=None):
+    def __init__(self, num=None, rows=0, filename=None):
+        """
+        parameters:
+            - num        : number of pixels in the stack grid
+            - rows       : maximal number of spectra to keep on the grid for the SVD (see svd), if 0 spectra are not kept
+            - filename   : if not None, spectra are kept in memory mapped .npy file
+        """
         self.n = num
         self.attrs = ['sig', 'sig_p', 'zero', 'cont', 'poly']
         self.sub = [''] # ['', '_w']  # ['', '_w', '_ston']
         for attr in self.attrs + ['mask']:
             for s in self.sub:
                 setattr(self, attr + s, np.zeros(num))
+        self.nrows = 0
+        if rows > 0:
+            if filename is None:
+                self.Y = np.full((rows, num), np.nan)
+            else:
+                self.Y = np.lib.format.open_memmap(filename, mode='w+', shape=(rows, num))
+                self.Y[:] = np.nan
+
+    def add_row(self, imin, imax, y):
+        """
+        keep the normalized spectrum on the stack grid for the SVD, pixels outside [imin:imax] are missing
+        """
+        self.Y[self.nrows, imin:imax] = y
+        self.nrows += 1
+
+    def svd(self, k=10, method='randomized', **kwargs):
+        """
+        calculate SVD of the kept spectra with missing values (see emsvd)
+        parameters:
+            - k          : number of components
+            - method     : SVD method in emsvd
+            - kwargs     : other parameters of emsvd
+        return:
+            - history    : convergence info of the EM steps
+        """
+        self.history = []
+        Y = self.Y[:self.nrows]
+        cols = np.where(np.any(np.isfinite(Y), axis=0))[0]
+        cols = slice(cols[0], cols[-1] + 1) if len(cols) > 0 else slice(0, 0)
+        Y_hat, mu, U, self.s, Vt = emsvd(Y[:, cols], k=k, method=method, history=self.history, **kwargs)
+        self.U = U
+        self.components, self.mean = np.full((len(self.s), self.n), np.nan), np.full(self.n, np.nan)
+        self.components[:, cols], self.mean[cols] = Vt, mu.flatten()
+        return self.history
 
     def masked(self):
         for attr in self.attrs:
@@ -43,7 +83,7 @@ class Stack():
                 np.savetxt(folder + filename + attr + s + '.dat', np.c_[l, getattr(self, attr + s)],
                            fmt='%18.6f')
 
-def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.5400, lmax=4.0000, snr=2.5):
+def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.5400, lmax=4.0000, snr=2.5, svd=None, svd_file=None):
     """
     Subroutine to calculate SDSS QSO stack spectrum
 
@@ -55,6 +95,8 @@ def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.540
         lmin       -  loglambda minimum boundary
         lmax       -  loglambda maximum boundary
         snr        -  SNR threshold
+        svd        -  number of SVD components of the stacked spectra (calculated by randomized emsvd, see Stack.svd), if None SVD is not calculated
+        svd_file   -  filename of .npy to keep the spectra on the stack grid out of memory, if None they are kept in memory
     """
 
     # >>> prepare stack class to write
@@ -94,6 +136,8 @@ def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.540
         mask *= data['SNR_SPEC'] > snr
     print(np.sum(mask))
     num = np.sum(mask)
+    if svd is not None:
+        stack = Stack(stack.n, rows=num, filename=svd_file)
     if 0:
         fig, ax = plt.subplots(subplot_kw=dict(projection='aitoff'))
         ax.scatter((data['RA_GROUP'][mask]/180-1)*np.pi, data['DEC_GROUP'][mask]/180*np.pi, s=5, marker='+')
@@ -131,6 +175,8 @@ def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.540
                     w = 1. / (sn ** -2 + 0.1 ** 2)
                     stack.mask[imin:imax] += data['mask'] * w
                     stack.sig[imin:imax] += data['flux'] / data['corr'] / norm * data['mask'] * w
+                    if svd is not None:
+                        stack.add_row(imin, imax, np.where(data['mask'] > 0, data['flux'] / data['corr'] / norm, np.nan))
                     #stack.cont[imin:imax] += data['cont'] * data['mask']
                     #stack.poly[imin:imax] += poly * data['mask']
                     #stack.sig[imin:imax] += data['flux'] / data['corr'] / data['cont'] * data['mask']
@@ -157,6 +203,8 @@ def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.540
                         ax.legend(loc='best')
                         plt.show()
     stack.masked()
+    if svd is not None:
+        stack.svd(k=svd, verbose=True)
 
     l = np.power(10, lmin + delta * np.arange(stack.n))
     if show is not None and len(show) > 0:
@@ -169,6 +217,8 @@ def calc_SDSS_stack(self, show=['sig'], save=True, ra=None, dec=None, lmin=3.540
     if save:
         filename = '{:.1f}_{:.1f}_'.format(float(ra[0]), float(ra[1])) if ra is not None else ''
         stack.save(l, attrs=['sig'], folder='C:/science/Kaminker/Lyforest/SDSS_Stripes/', filename=filename)
+        if svd is not None:
+            np.savetxt('C:/science/Kaminker/Lyforest/SDSS_Stripes/' + filename + 'svd.dat', np.c_[l, stack.mean, stack.components.T], fmt='%18.6f')
 
     return stack
 
@@ -685,7 +735,80 @@ def search_H2(self, z_abs=2.4, v_range=2000, HI=21.2, H2=19.8):
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
-def emsvd(Y, k=None, tol=1E-3, maxiter=None):
+def emsvd_blocks(Y, U=None, s=None, Vt=None, mu=None, block=10000):
+    """
+    Generator of the row blocks of the data matrix with the missing values filled by the current low rank model U s Vt + mu.
+    Only one block of Y is read at time, so Y can be memory mapped array (e.g. from np.load(..., mmap_mode='r'))
+    parameters:
+        - Y          : (nobs, ndim) data matrix, missing values denoted by NaN/Inf
+        - U, s, Vt   : current singular vectors and values, if None missing values are filled by mu
+        - mu         : (ndim,) column means
+        - block      : number of rows in block
+    return:
+        - rows, F    : slice of the rows and filled block
+    """
+    for start in range(0, Y.shape[0], block):
+        rows = slice(start, min(start + block, Y.shape[0]))
+        F = np.array(Y[rows], dtype=float)
+        valid = np.isfinite(F)
+        if not np.all(valid):
+            model = mu if U is None else (U[rows] * s).dot(Vt) + mu
+            F = np.where(valid, F, model)
+        yield rows, F
+
+def randomized_svd(Y, k, U=None, s=None, Vt=None, mu=None, oversample=10, power=1, block=10000, rng=None):
+    """
+    Randomized truncated SVD (Halko, Martinsson & Tropp 2011) of the centered filled data matrix.
+    The matrix is never formed: each pass reads Y by row blocks and fills the missing values by the current model (see emsvd_blocks).
+    The range finder is warm started by the current right singular vectors, so after first EM iterations one power iteration is enough.
+    parameters:
+        - Y          : (nobs, ndim) data matrix, missing values denoted by NaN/Inf
+        - k          : number of singular values/vectors to find
+        - U, s, Vt   : singular vectors and values from the previous EM iteration (or None)
+        - mu         : (ndim,) column means to fill missing values
+        - oversample : number of the additional random vectors in range finder
+        - power      : number of power iterations
+        - block      : number of rows in block
+        - rng        : np.random.Generator
+    return:
+        - U, s, Vt   : k singular values and vectors of the filled data matrix centered by the updated mean
+        - mu         : updated column means of the filled data matrix
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    nobs, ndim = Y.shape
+    l = min(k + oversample, ndim, nobs)
+    omega = rng.standard_normal((ndim, l))
+    if Vt is not None:
+        omega[:, :Vt.shape[0]] = Vt.T
+
+    # >>> first pass: column means and range of (F - mu)
+    Q, m = np.empty((nobs, l)), np.zeros(ndim)
+    for rows, F in emsvd_blocks(Y, U, s, Vt, mu, block=block):
+        Q[rows] = F.dot(omega)
+        m += F.sum(axis=0)
+    m /= nobs
+    Q = np.linalg.qr(Q - m.dot(omega))[0]
+
+    # >>> power iterations
+    for i in range(power):
+        Z = np.zeros((ndim, l))
+        for rows, F in emsvd_blocks(Y, U, s, Vt, mu, block=block):
+            Z += F.T.dot(Q[rows])
+        Z = np.linalg.qr(Z - np.outer(m, Q.sum(axis=0)))[0]
+        for rows, F in emsvd_blocks(Y, U, s, Vt, mu, block=block):
+            Q[rows] = F.dot(Z)
+        Q = np.linalg.qr(Q - m.dot(Z))[0]
+
+    # >>> project to the range and make small SVD
+    B = np.zeros((l, ndim))
+    for rows, F in emsvd_blocks(Y, U, s, Vt, mu, block=block):
+        B += Q[rows].T.dot(F)
+    B -= np.outer(Q.sum(axis=0), m)
+    Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+    return Q.dot(Ub[:, :k]), s[:k], Vt[:k], m
+
+def emsvd(Y, k=None, tol=1E-3, maxiter=None, method=None, block=10000, oversample=10, power=1, seed=None, out=None, history=None, verbose=False):
     """
     Approximate SVD on data with missing values via expectation-maximization
 
@@ -695,49 +818,105 @@ def emsvd(Y, k=None, tol=1E-3, maxiter=None):
     k:          number of singular values/vectors to find (default: k=ndim)
     tol:        convergence tolerance on change in trace norm
     maxiter:    maximum number of EM steps to perform (default: no limit)
+    method:     'svd' - full SVD of the filled data matrix on each step (default if k is None),
+                'svds' - truncated SVD by scipy.sparse.linalg.svds (default if k is given),
+                'randomized' - randomized truncated SVD, warm started by the subspace from the previous step.
+                               Filled data matrix is not kept in memory: Y is read by row blocks (it can be np.memmap)
+                               and missing values are imputed on the fly from the current U, s, Vt (see randomized_svd)
+    block:      number of rows in block for 'randomized' method
+    oversample: number of oversampling vectors for 'randomized' method
+    power:      number of power iterations for 'randomized' method
+    seed:       seed of the random generator for 'randomized' method
+    out:        (nobs, ndim) array (e.g. np.memmap) to write Y_hat for 'randomized' method (default: new array)
+    history:    list to append the convergence info of each EM step: dict with 'iter', 'trace', 'rel' (relative change of trace norm) and 'time'
+    verbose:    print the convergence info
 
     Returns:
     -----------
     Y_hat:      (nobs, ndim) reconstructed data matrix
     mu_hat:     (ndim,) estimated column means for reconstructed data
-    U, s, Vt:   singular values and vectors (see np.linalg.svd and 
+    U, s, Vt:   singular values (in descending order) and vectors (see np.linalg.svd and 
                 scipy.sparse.linalg.svds for details)
     """
 
-    if k is None:
+    if method is None:
+        method = 'svd' if k is None else 'svds'
+    if method == 'svd':
         svdmethod = partial(np.linalg.svd, full_matrices=False)
-    else:
+    elif method == 'svds':
         svdmethod = partial(svds, k=k)
+    elif method == 'randomized':
+        if k is None:
+            raise ValueError("number of singular values k has to be specified for randomized SVD")
+        rng = np.random.default_rng(seed)
+    else:
+        raise ValueError("unknown SVD method: {0}".format(method))
     if maxiter is None:
         maxiter = np.inf
 
-    # initialize the missing values to their respective column means
-    mu_hat = np.nanmean(Y, axis=0, keepdims=1)
-    valid = np.isfinite(Y)
-    Y_hat = np.where(valid, Y, mu_hat)
-
+    t = Timer('emsvd', verbose=verbose)
     halt = False
     ii = 1
     v_prev = 0
 
+    if method == 'randomized':
+        # initialize the missing values to their respective column means
+        s_y, n_y = np.zeros(Y.shape[1]), np.zeros(Y.shape[1])
+        for start in range(0, Y.shape[0], block):
+            y = np.array(Y[start:start + block], dtype=float)
+            valid = np.isfinite(y)
+            s_y += np.where(valid, y, 0).sum(axis=0)
+            n_y += valid.sum(axis=0)
+        mu_hat = s_y / n_y
+        U, s, Vt = None, None, None
+    else:
+        # initialize the missing values to their respective column means
+        mu_hat = np.nanmean(Y, axis=0, keepdims=1)
+        valid = np.isfinite(Y)
+        Y_hat = np.where(valid, Y, mu_hat)
+
     while not halt:
 
-        # SVD on filled-in data
-        U, s, Vt = svdmethod(Y_hat - mu_hat)
+        if method == 'randomized':
+            # SVD on filled-in data, missing values are imputed inside with the previous model
+            U, s, Vt, mu_hat = randomized_svd(Y, k, U=U, s=s, Vt=Vt, mu=mu_hat, oversample=oversample, power=power, block=block, rng=rng)
+        else:
+            # SVD on filled-in data
+            U, s, Vt = svdmethod(Y_hat - mu_hat)
 
-        # impute missing values
-        Y_hat[~valid] = (U.dot(np.diag(s)).dot(Vt) + mu_hat)[~valid]
+            # impute missing values
+            Y_hat[~valid] = (U.dot(np.diag(s)).dot(Vt) + mu_hat)[~valid]
 
-        # update bias parameter
-        mu_hat = Y_hat.mean(axis=0, keepdims=1)
+            # update bias parameter
+            mu_hat = Y_hat.mean(axis=0, keepdims=1)
 
         # test convergence using relative change in trace norm
         v = s.sum()
-        if ii >= maxiter or ((v - v_prev) / v_prev) < tol:
+        rel = (v - v_prev) / v_prev if v_prev > 0 else np.inf
+        dt = t.time()
+        if history is not None:
+            history.append({'iter': ii, 'trace': v, 'rel': rel, 'time': dt})
+        if verbose:
+            print('emsvd: iter {0:d}, trace norm {1:.6g}, change {2:.3g}, time {3:.2f}s'.format(ii, v, rel, dt))
+        if ii >= maxiter or rel < tol:
             halt = True
         ii += 1
         v_prev = v
 
+    # singular values in descending order for all the methods (svds returns them in ascending order)
+    order = np.argsort(s)[::-1]
+    U, s, Vt = U[:, order], s[order], Vt[order]
+
+    if method == 'randomized':
+        # final imputation by the last model, the means are updated as in the full EM step
+        Y_hat = np.empty(Y.shape) if out is None else out
+        for rows, F in emsvd_blocks(Y, U, s, Vt, mu_hat, block=block):
+            Y_hat[rows] = F
+        mu_hat = np.zeros(Y.shape[1])
+        for start in range(0, Y.shape[0], block):
+            mu_hat += Y_hat[start:start + block].sum(axis=0)
+        mu_hat = (mu_hat / Y.shape[0])[np.newaxis, :]
+
     return Y_hat, mu_hat, U, s, Vt
     
 class sdss():
@@ -794,12 +973,14 @@ class sdss():
         return self.name
         
 class SDSS_fit():
-    def __init__(self, parent, num=10, timer=False):
+    def __init__(self, parent, num=10, timer=False, batch=256):
         self.parent = parent
         self.create_scale()
         self.data = []
         # set number of general values:
         self.num = num
+        # number of spectra in mini-batches of likelihood calculation:
+        self.batch = batch
         if timer:
             self.t = Timer()
         else:
@@ -970,60 +1151,92 @@ class SDSS_fit():
             w = xs[1]
             return M, w
             
-    def lnL(self, x):
+    def lnL(self, x, inds=None):
         """
-        calculate likelihood and Jacobian for model prior
+        calculate likelihood and Jacobian for model prior.
+        The covariance of each spectrum S = M M^T + D, D = diag(V + exp(w)), is inverted by Woodbury identity,
+        so only (num x num) matrices are inverted and no (Npix x Npix) matrices are formed.
+        The missing pixels have zero weights in D^-1, so the spectra are processed in mini-batches of self.batch spectra.
+        parameters:
+            - x         : packed M and w (see pack)
+            - inds      : indices of the spectra to use (e.g. for stochastic minimization), if None use all the spectra
+        return:
+            - lnL, jac  : minus log likelihood and its Jacobian
         """
         #self.time('start lnL')
         Ms, w = self.pack(x)
-        w = np.exp(w)
+        W = np.exp(w)
+        if inds is None:
+            inds = np.arange(self.Y_in.shape[0])
         lnL = 0
         chi_s = 0
         free = 0
         dM = np.zeros_like(Ms)
         dw = np.zeros_like(w)
-        for y, v in zip(self.Y_in, self.V):
-            #self.time('pre')
-            
+        for i in range(0, len(inds), self.batch):
+            y, v = self.Y_in[inds[i:i + self.batch]], self.V[inds[i:i + self.batch]]
+
             # mask nan values:
-            mask = np.logical_and(~np.isnan(y), y < np.inf)
-            mask2 = np.logical_and(~np.isnan(v), v < np.inf)
-            mask = np.logical_and(mask, mask2)
-            y = y[mask]
-            W = w[mask]
-            d = v[mask] + W
-            #self.time('mask')
-                
-            if not np.isnan(d).any():
-                num = len(y)
-                free += num
-                M = Ms[mask]
-                MT = np.transpose(M)
-                d_inv = np.reciprocal(d)
-                D_inv = np.diag(d_inv)
-                MT_D_inv = np.multiply(MT, d_inv)
-                H = np.diag(np.ones(self.num)) + np.dot(MT_D_inv, M)
-                S_inv = D_inv - np.dot(MT_D_inv.transpose(), np.dot(np.linalg.inv(H), MT_D_inv))
-                #det_S = np.log(np.linalg.det(np.dot(M, MT) + D))
-                det_S = np.sum(np.log(d)) + np.log(np.linalg.det(H))
-                #print(np.dot(d.transpose(), np.dot(S_inv, d)), det_S, num*np.log(2*np.pi))
-                alpha = np.dot(S_inv, y)
-                chi = np.dot(y.transpose(), alpha)
-                lnL += chi + det_S + num*np.log(2*np.pi)
-                chi_s += chi 
-
-                #calcuculate jac
-                dM[mask] -= np.dot(np.outer(alpha,alpha.transpose()) - S_inv, M)
-                dw[mask] -= np.multiply(W, np.multiply(alpha, alpha) - np.diag(S_inv))
-                #input()
+            mask = np.logical_and(np.isfinite(y), np.isfinite(v))
+            y = np.where(mask, y, 0)
+            d = np.where(mask, v + W, 1)
+            d_inv = np.where(mask, np.reciprocal(d), 0)
+
+            H = np.eye(self.num) + np.einsum('bp,pi,pj->bij', d_inv, Ms, Ms)
+            H_inv = np.linalg.inv(H)
+            MH_inv = np.einsum('pi,bij->bpj', Ms, H_inv)
+            alpha = d_inv * (y - np.einsum('bpj,bj->bp', MH_inv, np.dot(d_inv * y, Ms)))
+            chi = np.sum(y * alpha, axis=1)
+            det_S = np.sum(np.log(d) * mask, axis=1) + np.linalg.slogdet(H)[1]
+            num = np.sum(mask, axis=1)
+            lnL += np.sum(chi + det_S + num * np.log(2 * np.pi))
+            chi_s += np.sum(chi)
+            free += np.sum(num)
+
+            # calculate jac, using S^-1 M = D^-1 M H^-1 and diag(S^-1) = d^-1 - d^-2 diag(M H^-1 M^T):
+            dM -= np.dot(alpha.transpose(), np.dot(alpha, Ms)) - np.sum(d_inv[:, :, np.newaxis] * MH_inv, axis=0)
+            dw -= 0.5 * W * np.sum(alpha ** 2 - d_inv + d_inv ** 2 * np.sum(MH_inv * Ms, axis=2), axis=0)
         lnL *= 0.5
-        self.time('finish lnL')
-        print(lnL)
-        print(chi_s, free - len(x))
+        if len(inds) == self.Y_in.shape[0]:
+            self.time('finish lnL')
+            print(lnL)
+            print(chi_s, free - len(x))
         return (lnL, self.pack(dM, dw))
-    
-    def calc_covar(self):
-        
+
+    def minimize_stochastic(self, x0, epochs=10, lr=0.01, seed=1):
+        """
+        minimize lnL by Adam with the gradients calculated on the mini-batches of self.batch spectra,
+        for the samples of spectra that are too large for the full gradient at each step
+        parameters:
+            - x0        : initial packed M and w
+            - epochs    : number of passes over the sample
+            - lr        : learning rate
+            - seed      : seed for random generator
+        """
+        rng = np.random.default_rng(seed)
+        x, m, v = np.copy(x0), np.zeros_like(x0), np.zeros_like(x0)
+        b1, b2, n, t = 0.9, 0.999, self.Y_in.shape[0], 0
+        for e in range(epochs):
+            perm = rng.permutation(n)
+            for i in range(0, n, self.batch):
+                t += 1
+                inds = perm[i:i + self.batch]
+                g = self.lnL(x, inds=inds)[1] * n / len(inds)
+                m = b1 * m + (1 - b1) * g
+                v = b2 * v + (1 - b2) * g ** 2
+                x -= lr * m / (1 - b1 ** t) / (np.sqrt(v / (1 - b2 ** t)) + 1e-8)
+            self.time('epoch {0:d}'.format(e))
+        return x
+
+    def calc_covar(self, method='L-BFGS-B', epochs=10, lr=0.01):
+        """
+        calculate the covariance model M M^T + diag(w) of the spectra
+        parameters:
+            - method    : 'L-BFGS-B' - full gradient minimization, or 'adam' - stochastic minimization on mini-batches (see minimize_stochastic)
+            - epochs    : number of epochs for stochastic minimization
+            - lr        : learning rate for stochastic minimization
+        """
+
         # remove noise pixels and fill nan values
         snr = np.divide(self.Y, self.V)
         mask = np.nanmean(snr, axis=1) > 1
@@ -1064,8 +1277,11 @@ class SDSS_fit():
         
         # maximize likelihood
         if 1:
-            res = minimize(self.lnL, x0, method='L-BFGS-B', jac=True) #, options={'maxiter':500})
-            self.M, self.w = self.pack(res.x)
+            if method == 'adam':
+                self.M, self.w = self.pack(self.minimize_stochastic(x0, epochs=epochs, lr=lr))
+            else:
+                res = minimize(self.lnL, x0, method='L-BFGS-B', jac=True) #, options={'maxiter':500})
+                self.M, self.w = self.pack(res.x)
             self.PCA = self.M.transpose()
             self.toGUI('PCA')
             self.K = np.dot(self.M, self.M.transpose())
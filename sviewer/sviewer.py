@@ -19,7 +19,7 @@ from matplotlib.colors import to_hex
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator, MultipleLocator, FormatStrFormatter
-from multiprocessing import Process
+from multiprocessing import Pool, Process
 import numpy as np
 import pandas as pd
 import pickle
@@ -51,7 +51,7 @@ from ..profiles import add_LyaForest, add_ext, add_ext_bump, add_LyaCutoff, conv
 from ..stats import distr1d, distr2d
 from ..XQ100 import load_QSO
 from .console import *
-from .external import spectres
+from .resample import coadd, resample
 from .erosita import *
 from .fit_model import *
 from .fit import *
@@ -1364,7 +1364,7 @@ class preferencesWidget(QWidget):
 
             ind = 0
             self.fitGroup = QButtonGroup(self)
-            self.fittype = ['regular', 'fft', 'julia', 'fast']
+            self.fittype = ['regular', 'fft', 'julia', 'vector', 'fast']
             for i, f in enumerate(self.fittype):
                 s = ':' if f == 'fast' else ''
                 setattr(self, f, QRadioButton(f + s))
@@ -1376,7 +1376,7 @@ class preferencesWidget(QWidget):
             self.num_between = QLineEdit(str(self.parent.num_between))
             self.num_between.setValidator(validator)
             self.num_between.textChanged[str].connect(self.setNumBetween)
-            self.grid.addWidget(self.num_between, ind, 4)
+            self.grid.addWidget(self.num_between, ind, 5)
 
             ind += 1
             self.grid.addWidget(QLabel('Tau limit:'), ind, 0)
@@ -1386,6 +1386,14 @@ class preferencesWidget(QWidget):
             self.tau_limit.textChanged[str].connect(self.setTauLimit)
             self.grid.addWidget(self.tau_limit, ind, 1)
 
+            self.grid.addWidget(QLabel('Voigt:'), ind, 2)
+            self.voigt_calc = QComboBox()
+            self.voigt_calc.addItems(['spec', 'table'])
+            self.voigt_calc.setCurrentText(self.parent.voigt_calc)
+            self.voigt_calc.currentIndexChanged.connect(self.setVoigtCalc)
+            self.voigt_calc.setFixedSize(80, 30)
+            self.grid.addWidget(self.voigt_calc, ind, 3)
+
             ind += 1
             self.grid.addWidget(QLabel('Fit method:'), ind, 0)
             self.fitmethod = QComboBox()
@@ -1424,6 +1432,12 @@ class preferencesWidget(QWidget):
             self.animateFit.stateChanged.connect(partial(self.setChecked, 'animateFit'))
             self.grid.addWidget(self.animateFit, ind, 0)
 
+            self.pyratio_emulate = QCheckBox('pyratio emulator')
+            self.pyratio_emulate.setChecked(self.parent.pyratio_emulate)
+            self.pyratio_emulate.setToolTip('interpolate the populations of the levels tied by pyratio in the fit')
+            self.pyratio_emulate.stateChanged.connect(self.setPyratioEmulate)
+            self.grid.addWidget(self.pyratio_emulate, ind, 1)
+
         if window == 'Appearance':
             ind = 0
             self.grid.addWidget(QLabel('Spectrum view:'), ind, 0)
@@ -1550,6 +1564,14 @@ class preferencesWidget(QWidget):
     def setMethod(self):
         self.parent.fit_method = self.fitmethod.currentText()
 
+    def setVoigtCalc(self):
+        self.parent.voigt_calc = self.voigt_calc.currentText()
+        self.parent.options('voigt_calc', self.parent.voigt_calc)
+
+    def setPyratioEmulate(self):
+        self.parent.options('pyratio_emulate', self.pyratio_emulate.isChecked())
+        self.parent.fit.pyratio_emulate = self.parent.pyratio_emulate
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_F11:
             self.close()
@@ -3229,27 +3251,27 @@ class fitMCMCWidget(QWidget):
 
         elif self.sampler.currentText() in ['emcee']:
 
-            def lnprob(params, pars, priors, self):
-                #print(params)
-                for v, p in zip(params, pars):
-                    if not self.parent.fit.setValue(p, v):
-                        return -np.inf
-                self.parent.fit.update(redraw=False)
-                self.parent.julia_pars = self.parent.julia.make_pars(self.parent.fit.list(), tieds=self.parent.fit.tieds)
-                #self.parent.s.prepareFit(all=False)
-                self.parent.s.calcFit(recalc=True)
-                lp = 0
-                for k, v in priors.items():
-                    print(k, v)
-                    lp += v.lnL(p)
-                return lp - 0.5 * self.parent.s.chi2()
+            # >>> headless likelihood, which does not touch the GUI objects and can be evaluated in the worker processes:
+            lnL = calc_fit(num_between=self.parent.num_between, tau_limit=self.parent.tau_limit, voigt_calc=self.parent.voigt_calc, fit_type=self.parent.fitType)
+            lnL.set_data(self.parent.s)
+            lnL.set_model(pars, fit=self.parent.fit)
+            lnL.set_priors(self.priors)
 
             ndims = len(pars)
-            sampler = emcee.EnsembleSampler(nwalkers, ndims, lnprob, args=[pars, self.priors, self], backend=backend)
+            pool = Pool(nthreads, initializer=init_worker, initargs=(lnL,)) if nthreads > 1 else None
+            try:
+                if pool is not None:
+                    sampler = emcee.EnsembleSampler(nwalkers, ndims, lnprob_worker, pool=pool, backend=backend)
+                else:
+                    sampler = emcee.EnsembleSampler(nwalkers, ndims, lnL, backend=backend)
 
-            for i, result in enumerate(sampler.sample(init, iterations=nsteps)):
-                print(i)
-                self.parent.MCMCprogress.setText('     MCMC is running: {0:d} / {1:d}'.format(i, nsteps))
+                for i, result in enumerate(sampler.sample(init, iterations=nsteps)):
+                    self.parent.MCMCprogress.setText('     MCMC is running: {0:d} / {1:d}'.format(i, nsteps))
+                    QApplication.processEvents()
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
 
             with backend.open("a") as f:
                 g = f[backend.name]
@@ -3472,15 +3494,7 @@ class fitMCMCWidget(QWidget):
                             ax[vert, hor].text(.1, .9, str('{0:s}/{1:s} {2:d}'.format(ratio[0], ratio[1], i)), ha='left', va='top', transform=ax[vert, hor].transAxes)
                             ax[vert, hor].text(.1, .8, res.latex(f=f), ha='left', va='top', transform=ax[vert, hor].transAxes)
         else:
-            values = []
-            for k in range(burnin, samples.shape[0]):
-                for i in range(samples.shape[1]):
-                    for xi, p in zip(samples[k, i], pars):
-                        self.parent.fit.setValue(p, xi)
-                    self.parent.fit.update()
-                    values.append([p.val for p in self.parent.fit.list()])
-
-            values = np.asarray(values)
+            values = self.parent.fit.propagate(pars, samples[burnin:].reshape(-1, samples.shape[2]))
 
             if t == 'all':
                 k = len(self.parent.fit.list())  # samples.shape[1]
@@ -3664,11 +3678,12 @@ class fitMCMCWidget(QWidget):
         self.parent.s.prepareFit(-1, all=all)
         self.parent.s.calcFit(recalc=True)
         self.parent.s.calcFitComps(recalc=True)
-        fit, fit_disp, fit_comp, fit_comp_disp = [], [], [], []
+        fit, fit_disp, fit_comp, fit_comp_disp, cheb_disp = [], [], [], [], []
         for i, s in enumerate(self.parent.s):
             if s.fit.line.norm.n > 0:
                 fit.append(deepcopy(s.fit.line.norm))
                 fit_disp.append([s.fit.line.norm.y])
+                cheb_disp.append(None)
                 fit_comp_disp.append([])
                 for k, sys in enumerate(self.parent.fit.sys):
                     fit_comp_disp[i].append([s.fit_comp[k].line.norm.y])
@@ -3686,35 +3701,41 @@ class fitMCMCWidget(QWidget):
                                                  nthreads=int(self.parent.options('MCMC_threads')), nums=int(self.parent.options('MCMC_disp_num')))
 
         else:
-            for i1, i2, k in zip(np.random.randint(burnin, high=samples.shape[0], size=num), np.random.randint(0, high=samples.shape[1], size=num), range(num)):
-                for p, t in zip(pars, samples[i1, i2, :]):
-                    self.parent.fit.setValue(p, t)
-                self.parent.s.prepareFit()
-                self.parent.s.calcFit(recalc=True, redraw=False)
-                self.parent.s.calcFitComps(recalc=True)
-
-                for i, s in enumerate(self.parent.s):
-                    if s.fit.line.norm.n > 0:
-                        fit_disp[i] = np.r_[fit_disp[i], [s.fit.line.norm.inter(fit[i].x)]]
-                        for k, sys in enumerate(self.parent.fit.sys):
-                            if s.fit_comp[k].line.n() > 2 and len(fit_comp_disp[i][k]) > 0 and len(fit[i].x) > 0:
-                                fit_comp_disp[i][k] = np.r_[fit_comp_disp[i][k], [s.fit_comp[k].line.norm.inter(fit[i].x)]]
-
+            # >>> posterior predictive bands by the headless model, evaluated for the batches of samples (in parallel)
+            lnL = calc_fit(num_between=self.parent.num_between, tau_limit=self.parent.tau_limit, voigt_calc=self.parent.voigt_calc, fit_type=self.parent.fitType)
+            lnL.set_data(self.parent.s)
+            lnL.set_model(pars, fit=self.parent.fit)
+            inds = np.random.randint(burnin, high=samples.shape[0], size=num), np.random.randint(0, high=samples.shape[1], size=num)
+            grids = [s.fit.line.norm.x if s.fit.line.norm.n > 0 else np.zeros(0) for s in self.parent.s]
+            bands = predictive_bands(lnL, samples[inds], grids, threads=int(self.parent.options('MCMC_threads')))
+
+        q = int((1 - 0.683) / 2 * num)
         for i, s in enumerate(self.parent.s):
             if s.fit.line.norm.n > 0:
-                fit_disp[i] = np.sort(fit_disp[i], axis=0)
-                self.parent.s[i].fit.disp[0].set(x=fit[i].x, y=fit_disp[i][int((1-0.683)/2*num), :])
-                self.parent.s[i].fit.disp[1].set(x=fit[i].x, y=fit_disp[i][num-int((1-0.683)/2*num), :])
+                if self.parent.fitType == 'julia':
+                    fit_disp[i] = np.sort(fit_disp[i], axis=0)[[q, num - q]]
+                    if self.parent.fit.cont_fit:
+                        cheb_disp[i] = np.sort(cheb_disp[i], axis=0)[[q, num - q]]
+                    for k, sys in enumerate(self.parent.fit.sys):
+                        if len(fit_comp_disp[i][k][0]) > 0:
+                            fit_comp_disp[i][k] = np.sort(np.asarray(fit_comp_disp[i][k]), axis=0)[[q, num - q]]
+                else:
+                    fit_disp[i] = bands[i][:, 0]
+                    if self.parent.fit.cont_fit:
+                        cheb_disp[i] = bands[i][:, 1]
+                    for k, sys in enumerate(self.parent.fit.sys):
+                        fit_comp_disp[i][k] = bands[i][:, k + 2] if any([line.sys == k for line in s.fit_lines]) else [[]]
+
+                self.parent.s[i].fit.disp[0].set(x=fit[i].x, y=fit_disp[i][0])
+                self.parent.s[i].fit.disp[1].set(x=fit[i].x, y=fit_disp[i][1])
                 if self.parent.fit.cont_fit:
-                    cheb_disp[i] = np.sort(cheb_disp[i], axis=0)
-                    self.parent.s[i].cheb.disp[0].set(x=fit[i].x, y=cheb_disp[i][int((1 - 0.683) / 2 * num), :])
-                    self.parent.s[i].cheb.disp[1].set(x=fit[i].x, y=cheb_disp[i][num - int((1 - 0.683) / 2 * num), :])
+                    self.parent.s[i].cheb.disp[0].set(x=fit[i].x, y=cheb_disp[i][0])
+                    self.parent.s[i].cheb.disp[1].set(x=fit[i].x, y=cheb_disp[i][1])
 
                 for k, sys in enumerate(self.parent.fit.sys):
                     if len(fit_comp_disp[i][k][0]) > 0:
-                        fit_comp_disp[i][k] = np.sort(np.asarray(fit_comp_disp[i][k]), axis=0)
-                        self.parent.s[i].fit_comp[k].disp[0].set(x=fit[i].x, y=fit_comp_disp[i][k][int((1 - 0.683) / 2 * num), :])
-                        self.parent.s[i].fit_comp[k].disp[1].set(x=fit[i].x, y=fit_comp_disp[i][k][num - int((1 - 0.683) / 2 * num), :])
+                        self.parent.s[i].fit_comp[k].disp[0].set(x=fit[i].x, y=fit_comp_disp[i][k][0])
+                        self.parent.s[i].fit_comp[k].disp[1].set(x=fit[i].x, y=fit_comp_disp[i][k][1])
                     else:
                         self.parent.s[i].fit_comp[k].disp[0].set(x=self.parent.s[i].fit.disp[0].norm.x, y=self.parent.s[i].fit.disp[0].norm.y)
                         self.parent.s[i].fit_comp[k].disp[1].set(x=self.parent.s[i].fit.disp[1].norm.x, y=self.parent.s[i].fit.disp[1].norm.y)
@@ -5975,12 +5996,10 @@ class combineWidget(QWidget):
 
         # make unified wavelength grid:
         if self.tab.currentIndex() == 0:
-            x = set()
+            x = np.empty(0)
             for s in slist:
                 print(len(s.spec.x()[np.logical_not(s.bad_mask.x())]))
-                x.update(list(s.spec.x()[np.logical_not(s.bad_mask.x())]))
-            x = sorted(x)
-            x = np.asarray(x)
+                x = np.union1d(x, s.spec.x()[np.logical_not(s.bad_mask.x())])
 
         elif self.tab.currentIndex() == 1:
             zero, binsize = float(self.zeropoint_bin.text()), float(self.binsize.text())
@@ -6007,52 +6026,12 @@ class combineWidget(QWidget):
 
         print('x: ', len(x), x)
         # calculate combined spectrum:
-        comb = np.empty([len(slist), len(x)], dtype=float)
-        comb.fill(np.nan)
-        e_comb = np.empty([len(slist), len(x)], dtype=float)
-        e_comb.fill(np.nan)
-
-        for i, s in enumerate(slist):
-            if 0:
-                if 1:
-                    spec = s.spec.y()[:]
-                    spec[s.bad_mask.x()] = np.NaN
-                    spec = interp1d(s.spec.x(), spec, bounds_error=False, fill_value=np.NaN)
-                    err = s.spec.err()[:]
-                    err[s.bad_mask.x()] = np.NaN
-                    err = interp1d(s.spec.x(), err, bounds_error=False, fill_value=np.NaN)
-                else:
-                    spec = interp1d(s.spec.x()[np.logical_not(s.bad_mask.x())], s.spec.y()[np.logical_not(s.bad_mask.x())], bounds_error=False, fill_value=np.NaN)
-                    err = interp1d(s.spec.x()[np.logical_not(s.bad_mask.x())], s.spec.err()[np.logical_not(s.bad_mask.x())], bounds_error=False, fill_value=np.NaN)
-                comb[i] = spec(x)
-                e_comb[i] = np.power(err(x), -1)
-            else:
-                #print(spectres.spectres(s.spec.x(), s.spec.y(), x, spec_errs=s.spec.err()))
-                if (len(x) == len(s.spec.x())) and (np.max(np.abs(x - s.spec.x())) < 0.01 * np.max(np.diff(x))):
-                    comb[i], e_comb[i] = s.spec.y()[:], s.spec.err()[:]
-                else:
-                    mask_s = (s.spec.err() != 0)
-                    mask = (x > s.spec.x()[mask_s][2]) * (x < s.spec.x()[mask_s][-3])
-                    comb[i][mask], e_comb[i][mask] = spectres.spectres(s.spec.x()[mask_s], s.spec.y()[mask_s], x[mask], spec_errs=s.spec.err()[mask_s])
-                e_comb[i][np.searchsorted(x, s.spec.x()[np.where(s.bad_mask.x())[0]])] = np.nan
-
-        print(comb, e_comb)
-
         typ = self.selectcombtype.currentText()
         print(typ)
-        if typ == 'Median':
-            y = np.nanmedian(comb, axis=0)
-            err = np.power(np.nansum(np.power(e_comb, -2), axis=0), -0.5)
-
-        if typ == 'Mean':
-            y = np.nanmean(comb, axis=0)
-            err = np.power(np.nansum(np.power(e_comb, -2), axis=0), -0.5)
-
-        if typ == 'Weighted mean':
-            w = np.power(e_comb, -2)
-            y = np.nansum(comb * w, axis=0) / np.nansum(w, axis=0)
-            err = np.power(np.nansum(w, axis=0), -0.5)
-            #err = np.power(np.nansum(np.power(e_comb, -2), axis=0), -0.5)
+        comb = coadd(x, typ=typ)
+        for s in slist:
+            comb.add(s.spec.x(), s.spec.y(), s.spec.err(), bad=s.bad_mask.x())
+        y, err = comb.result()
 
         mask = np.logical_not(np.isnan(y))
         x, y, err = x[mask], y[mask], err[mask]
@@ -6220,8 +6199,8 @@ class rebinWidget(QWidget):
             if self.parent.s[self.exp_ind].spec.raw.x[0] > x[0] - binsize or self.parent.s[self.exp_ind].spec.raw.x[-1] < x[-1] + binsize:
                 self.parent.sendMessage('New wavelenght scale beyond the initial spectrum range. Please select appropriate zero point')
             else:
-                y, err = spectres.spectres(self.parent.s[self.exp_ind].spec.raw.x, self.parent.s[self.exp_ind].spec.raw.y, x,
-                                           spec_errs=self.parent.s[self.exp_ind].spec.raw.err)
+                y, err = resample(self.parent.s[self.exp_ind].spec.raw.x, self.parent.s[self.exp_ind].spec.raw.y, x,
+                                  err=self.parent.s[self.exp_ind].spec.raw.err)
 
                 self.parent.s.append(Spectrum(self.parent, name='rebinned '+str(self.exp_ind+1), data=[x, y, err]))
                 self.parent.s[-1].Resolution = np.median(self.parent.s[-1].spec.raw.x)/(float(self.binsize.text()) * 2.5)
@@ -6236,8 +6215,8 @@ class rebinWidget(QWidget):
             if self.parent.s[self.exp_ind].spec.raw.x[0] > x[0] - (x[1] - x[0]) / 2 or self.parent.s[self.exp_ind].spec.raw.x[-1] < x[-1] + (x[-1] - x[-2]) / 2:
                 self.parent.sendMessage('New wavelenght scale beyond the initial spectrum range. Please select appropriate zero point')
             else:
-                y, err = spectres.spectres(self.parent.s[self.exp_ind].spec.raw.x, self.parent.s[self.exp_ind].spec.raw.y, x,
-                                           spec_errs=self.parent.s[self.exp_ind].spec.raw.err)
+                y, err = resample(self.parent.s[self.exp_ind].spec.raw.x, self.parent.s[self.exp_ind].spec.raw.y, x,
+                                  err=self.parent.s[self.exp_ind].spec.raw.err)
 
                 self.parent.s.append(Spectrum(self.parent, name='rebinned '+str(self.exp_ind+1)))
                 self.parent.s[-1].set_data([x, y, err])
@@ -6259,8 +6238,8 @@ class rebinWidget(QWidget):
             if self.parent.s[self.exp_ind].spec.raw.x[0] > x[0] - (x[1] - x[0]) / 2 or self.parent.s[self.exp_ind].spec.raw.x[-1] < x[-1] + (x[-1] - x[-2]) / 2:
                 self.parent.sendMessage('New wavelenght scale beyond the initial spectrum range. Please select appropriate zero point')
             else:
-                y, err = spectres.spectres(self.parent.s[self.exp_ind].spec.raw.x[mask], self.parent.s[self.exp_ind].spec.raw.y[mask],
-                                           x, spec_errs=self.parent.s[self.exp_ind].spec.raw.err[mask])
+                y, err = resample(self.parent.s[self.exp_ind].spec.raw.x[mask], self.parent.s[self.exp_ind].spec.raw.y[mask],
+                                  x, err=self.parent.s[self.exp_ind].spec.raw.err[mask])
                 self.parent.s.append(Spectrum(self.parent, name='rebinned '+str(self.exp_ind+1)))
                 self.parent.s[-1].set_data([x, y, err])
 
@@ -6429,77 +6408,52 @@ class GenerateAbsWidget(QWidget):
         self.close()
 
     def boot(self):
-        if 1:
-            res, lnprobs = [], []
-        else:
-            with open('temp/res.pickle', 'rb') as f:
-                res = pickle.load(f)
+        """
+        Monte Carlo bootstrap of the current fit model: synthetic spectra on the grid with given resolution and SNR
+        (noise-free, if SNR is not checked) are fitted by the headless model in parallel (see fit.bootstrap).
+        The fitting regions are where the model is below exp(-tau limit) and which contain the active lines (at the redshift of the first system).
+        The results are written to temp/boot.hdf5.
+        """
         snr = self.gen_snr if self.snr.isChecked() else None
+        bin = (self.gen_xmin + self.gen_xmax) / 2 / self.gen_resolution / 4
+        x = np.linspace(self.gen_xmin, self.gen_xmax, int((self.gen_xmax - self.gen_xmin) / bin))
+
+        lnL = calc_fit(num_between=self.parent.num_between, tau_limit=self.parent.tau_limit, voigt_calc=self.parent.voigt_calc, fit_type=self.parent.fitType)
+        lnL.set_data([(x, np.ones_like(x), np.ones_like(x) / (snr if snr is not None else 100), None, self.gen_resolution)])
+        lnL.set_model(self.parent.fit.list_fit(), fit=self.parent.fit)
+        lnL.fit.update(redraw=False)
+        lnL.find_lines(self.parent.atomic, tlim=self.parent.tau_limit)
+
+        # >>> fitting regions with the active lines:
+        m = lnL.predict([self.parent.fit.getValue(p) for p in lnL.pars], [x])[0][0] < np.exp(-self.gen_tau)
+        m[0], m[-1] = False, False
+        starts, ends = np.flatnonzero(np.diff(m.astype(int)) == 1) + 1, np.flatnonzero(np.diff(m.astype(int)) == -1) + 1
+        l = np.sort([line.line.l() * (1 + self.parent.fit.sys[0].z.val) for line in self.parent.abs.activelist])
+        lnL.s[0].mask = np.zeros_like(m)
+        for s, e in zip(starts, ends):
+            if np.searchsorted(l, x[e - 1], side='left') > np.searchsorted(l, x[s - 1], side='right'):
+                lnL.s[0].mask[s:e] = True
+        if not np.any(lnL.s[0].mask):
+            self.parent.sendMessage('There are no fitting regions with active lines for bootstrap')
+            return
 
-        self.parent.fit.save()
-
-        for i in range(self.gen_num):
-            print(i)
-            self.parent.normalize(False)
-            if self.parent.s.ind is not None:
-                self.parent.s.remove(self.parent.s.ind)
-            self.parent.fit.load()
-            self.parent.generate(template='const', z=self.gen_z, fit=True,
-                                 xmin=self.gen_xmin, xmax=self.gen_xmax,
-                                 resolution=self.gen_resolution, snr=snr,
-                                 lyaforest=self.gen_lyaforest, lycutoff=False, Av=self.gen_Av, z_Av=self.gen_z_Av, redraw=True)
-            self.parent.normalize(True)
-            if i == 0:
-                self.parent.s.prepareFit(all=True)
-                self.parent.s.calcFit(redraw=False)
-                s = self.parent.s[self.parent.s.ind]
-                m = s.fit.y() < np.exp(-self.gen_tau)
-                m[0] = False
-                m[-1] = False
-                print(np.sum(m))
-                regions = []
-                regs = np.argwhere(np.abs(np.diff(m)))
-                for r in range(0, len(regs), 2):
-                    xmin, xmax = s.fit.x()[regs[r]], s.fit.x()[regs[r + 1]]
-                    for line in self.parent.abs.activelist:
-                        if xmin < line.line.l() * (1 + self.parent.fit.sys[0].z.val) < xmax:
-                            regions.append([xmin, xmax])
-
-            print(regions)
-            s = self.parent.s[self.parent.s.ind]
-            for r in regions:
-                s.add_points(r[0], 1.5, r[1], -0.5, remove=False, redraw=False)
-            s.set_fit_mask()
-            self.parent.s.prepareFit(all=False)
-            #self.parent.s.calcFit(redraw=False)
-
-            self.parent.fit.shake()
-            self.parent.fit.update()
-
-            if 1:
-                dof, x, unc = self.parent.julia.fitLM(self.parent.julia_spec, self.parent.fit.list(), self.parent.julia_add, tieds=self.parent.fit.tieds)
-                res.append(x)
-                self.parent.s.calcFit(redraw=False)
-                lnprobs.append(self.parent.s.chi2())
-            else:
-                self.parent.fitAbs(timer=False)
-                self.parent.fit.fromJulia(res, unc)
-                res.append([self.parent.fit.getValue(str(p)) for p in self.parent.fit.list_fit()])
-
-        with open('temp/res.pickle', 'wb') as f:
-            pickle.dump([str(p) for p in self.parent.fit.list_fit()], f)
-            pickle.dump(res, f)
-            pickle.dump(lnprobs, f)
+        def progress(done, rate):
+            self.parent.MCMCprogress.setText('     Bootstrap: {0:d} / {1:d}, {2:.1f} per s'.format(done, self.gen_num, rate))
+            QApplication.processEvents()
 
-        self.parent.fit.load()
-        self.parent.s.redraw()
+        t = Timer('bootstrap')
+        bootstrap(lnL, self.gen_num, snr=snr, noise=snr is not None, threads=int(self.parent.options('MCMC_threads')), filename='temp/boot.hdf5', callback=progress)
+        t.time('{0:d} realizations'.format(self.gen_num))
 
     def showBoot(self):
-        with open('temp/res.pickle', 'rb') as f:
-            names = [name.replace('_', ' ') for name in pickle.load(f)]
-            res = np.asarray(pickle.load(f))
-            lnprobs = np.asarray(pickle.load(f))
+        with h5py.File('temp/boot.hdf5', 'r') as f:
+            names = [p.decode() for p in f.attrs['pars']]
+            res = np.array([f[k][:] for k in names]).transpose()
+            truths = [f[k].attrs['truth'] for k in names]
+            lnprobs = f['chi2'][:]
             print(res, lnprobs)
+        names = [name.replace('_', ' ') for name in names]
+        res = res[np.all(np.isfinite(res), axis=1)]
 
         if 0:
             c = ChainConsumer()
@@ -6517,7 +6471,7 @@ class GenerateAbsWidget(QWidget):
             fig = c.plotter.plot(figsize=(20, 20),
                                  # filename="output/fit.png",
                                  display=True,
-                                 truth=[self.parent.fit.getValue(str(p)) for p in self.parent.fit.list_fit()],
+                                 truth=truths,
                                  )
         else:
             print(res.shape)
@@ -6526,7 +6480,7 @@ class GenerateAbsWidget(QWidget):
                                 labels=names,
                                 show_titles=True,
                                 plot_contours=True,
-                                truths=[self.parent.fit.getValue(str(p)) for p in self.parent.fit.list_fit()],
+                                truths=truths,
                                 )
             plt.show()
 
@@ -6815,6 +6769,8 @@ class sviewer(QMainWindow):
         self.export2d_opt = ['spectrum', 'err', 'mask', 'cr', 'sky', 'trace']
         self.num_between = int(self.options('num_between'))
         self.tau_limit = float(self.options('tau_limit'))
+        self.voigt_calc = self.options('voigt_calc') or 'spec'
+        self.pyratio_emulate = self.options('pyratio_emulate') or False
         self.fit_method = str(self.options('fit_method'))
         self.comp_view = self.options('comp_view')
         self.animateFit = self.options('animateFit')
@@ -7130,6 +7086,10 @@ class sviewer(QMainWindow):
         fitGrid.setStatusTip('Brute force calculation on the grid of parameters')
         fitGrid.triggered.connect(partial(self.profileLikelihood, num=None))
 
+        fitProfile = QAction('&Profile likelihood', self)
+        fitProfile.setStatusTip('Profile likelihood on the grid of parameters (to fit), other varied parameters are optimized in each point')
+        fitProfile.triggered.connect(partial(self.profileLikelihood, num=None, nuisance=True))
+
         fitCont = QAction('&Fit with cont...', self)
         fitCont.setStatusTip('Fit with cont unc')
         fitCont.triggered.connect(self.fitwithCont)
@@ -7202,6 +7162,7 @@ class sviewer(QMainWindow):
         fitMenu.addAction(fitLM)
         fitMenu.addAction(fitMCMC)
         fitMenu.addAction(fitGrid)
+        fitMenu.addAction(fitProfile)
         fitMenu.addAction(fitCont)
         fitMenu.addAction(resAnal)
         fitMenu.addAction(stopFit)
@@ -8855,7 +8816,7 @@ class sviewer(QMainWindow):
                 par.fit = False
         print(self.fit.list_fit())
 
-    def profileLikelihood(self, num=None, line=None):
+    def profileLikelihood(self, num=None, line=None, nuisance=False):
         if not self.normview:
             self.normalize()
 
@@ -8898,33 +8859,19 @@ class sviewer(QMainWindow):
         else:
             ind, exp_ind, all = -1, -1, True
 
-        #self.s.prepareFit(ind=ind, all=all)
-
-        if 1:
-            if len(self.fit.list_fit()) == 1:
-                p = str(self.fit.list_fit()[0])
+        if len(self.fit.list_fit()) in [1, 2]:
+            pars = [str(p) for p in self.fit.list_fit()]
+            if len(pars) == 1:
+                p = pars[0]
                 print(p)
                 if num is not None:
                     pg = np.linspace(self.fit.getValue(p, 'min'), self.fit.getValue(p, 'max'), num)
                 else:
                     pg = np.linspace(self.fit.getValue(p, 'min'), self.fit.getValue(p, 'max'), int((self.fit.getValue(p, 'max') - self.fit.getValue(p, 'min')) / self.fit.getValue(p, 'step'))+1)
-                lnL = np.zeros(pg.size)
-                for i, v in enumerate(pg):
-                    print(i, v)
-                    self.fit.setValue(p, v)
-                    self.s.prepareFit(ind=ind, exp_ind=exp_ind, all=False)
-                    self.s.calcFit(ind=ind, exp_ind=exp_ind, recalc=True)
-                    lnL[i] = self.s.chi2(exp_ind=exp_ind)
-
-                d = distr1d(pg, np.exp(np.min(lnL.flatten())-lnL))
-                d.dopoint()
-                d.plot(conf=0.683)
-
-                self.fit.setValue(p, d.point)
+                grid = pg[:, np.newaxis]
 
-            if len(self.fit.list_fit()) == 2:
-                p1, p2 = str(self.fit.list_fit()[0]), str(self.fit.list_fit()[1])
-                psv1, psv2 = self.fit.getValue(p1), self.fit.getValue(p2)
+            if len(pars) == 2:
+                p1, p2 = pars
 
                 if num is not None:
                     pg1 = np.linspace(self.fit.getValue(p1, 'min'), self.fit.getValue(p1, 'max'), num)
@@ -8937,23 +8884,42 @@ class sviewer(QMainWindow):
                         pg1 = np.linspace(self.fit.getValue(p1, 'min'), self.fit.getValue(p1, 'max'), int((self.fit.getValue(p1, 'max') - self.fit.getValue(p1, 'min')) / self.fit.getValue(p1, 'step'))+1)
                         pg2 = np.linspace(self.fit.getValue(p2, 'min'), self.fit.getValue(p2, 'max'), int((self.fit.getValue(p2, 'max') - self.fit.getValue(p2, 'min')) / self.fit.getValue(p2, 'step'))+1)
                 print(pg1, pg2)
-                lnL = np.zeros((pg2.size, pg1.size))
-                for i1, v1 in enumerate(pg1):
-                    print(i1)
-                    self.fit.setValue(p1, v1, check=False)
-                    for i2, v2 in enumerate(pg2):
-                        self.fit.setValue(p2, v2, check=False)
-                        self.s.prepareFit(ind=ind, exp_ind=exp_ind, all=True)
-                        self.s.calcFit(ind=ind, exp_ind=exp_ind, recalc=True)
-                        lnL[i2, i1] = self.s.chi2(exp_ind=exp_ind)
-
-                d = distr2d(pg1, pg2, np.exp(np.min(lnL.flatten())-lnL))
-                #d = distr2d(pg1, pg2, np.exp(- lnL / np.min(lnL.flatten())))
-                d.plot_contour(conf_levels=[0.683, 0.954], xlabel=p1.replace('_', ' '), ylabel=p2.replace('_', ' '))
+                grid = np.stack(np.meshgrid(pg1, pg2), axis=-1).reshape(-1, 2)
+
+            # >>> headless model, which grid points are calculated in the worker processes:
+            # the nuisance parameters (that vary, but are not scanned) are optimized in each point, if nuisance is True
+            self.s.prepareFit(ind=ind, exp_ind=exp_ind, all=True)
+            lnL = calc_fit(num_between=self.num_between, tau_limit=self.tau_limit, voigt_calc=self.voigt_calc, fit_type=self.fitType)
+            lnL.set_data(self.s if exp_ind == -1 else [self.s[exp_ind]])
+            if exp_ind > -1:
+                lnL.s[0].ind = exp_ind
+            lnL.set_model(pars, fit=self.fit)
+            nuis = [str(p) for p in self.fit.list() if p.vary and str(p) not in pars and str(p) not in self.fit.tieds.keys()] if nuisance else None
+
+            def progress(done, L):
+                self.MCMCprogress.setText('     Profile likelihood: {0:d} / {1:d}'.format(done, grid.shape[0]))
+                QApplication.processEvents()
+
+            L, values = profile_likelihood(lnL, grid, nuisance=nuis, threads=int(self.options('MCMC_threads')), callback=progress)
+            self.MCMCprogress.setText('')
+
+            if len(pars) == 1:
+                d = distr1d(pg, np.exp(L - np.nanmax(L)))
+                d.dopoint()
+                d.plot(conf=0.683)
+                self.fit.setValue(p, d.point)
 
+            if len(pars) == 2:
+                d = distr2d(pg1, pg2, np.exp(L - np.nanmax(L)).reshape(pg2.size, pg1.size))
+                d.plot_contour(conf_levels=[0.683, 0.954], xlabel=p1.replace('_', ' '), ylabel=p2.replace('_', ' '))
                 self.fit.setValue(p1, d.point[0])
                 self.fit.setValue(p2, d.point[1])
 
+            if nuis is not None:
+                for p, v in zip(nuis, values[np.nanargmax(L)]):
+                    self.fit.setValue(p, v)
+            self.fit.update()
+
         self.s.calcFit(ind=ind, exp_ind=exp_ind, recalc=True, redraw=True)
         self.s.chi2(exp_ind=exp_ind)
 
@@ -9005,6 +8971,8 @@ class sviewer(QMainWindow):
 
     def fitAbs(self, timer=True, redraw=True):
         t = Timer(verbose=True) if 1 else False
+        # parameter values of the last calculated model and its residuals (the model of the spectra is kept for these values)
+        last = {'x': None, 'chi': None}
 
         def fcn2min(params):
             for p in params:
@@ -9015,14 +8983,42 @@ class sviewer(QMainWindow):
                 t.time(None)
 
             self.s.prepareFit(all=False)
-            self.s.calcFit(recalc=True, redraw=self.animateFit)
+            self.s.calcFit(recalc=False, redraw=self.animateFit)
 
             if timer:
                 tim = t.time('out')
                 if self.animateFit:
                     t.sleep(max(0, 0.02-tim))
 
-            return self.s.chi()
+            last['x'], last['chi'] = [params[p].value for p in params], self.s.chi()
+            return last['chi']
+
+        def Dfun(params):
+            # analytic Jacobian of the residuals: derivatives of the line profiles, covering factors and continuum are calculated directly,
+            # the tied and derived parameters are propagated by chain rule, the rest (e.g. resolution) by finite differences.
+            # The model is recalculated only if the last one was calculated for other parameter values
+            x = [params[p].value for p in params]
+            chi0 = last['chi'] if last['x'] == x else fcn2min(params)
+            names = [params[p].name.replace('l4', '****').replace('l3', '***').replace('l2', '**').replace('l1', '*') for p in params]
+            direct = [n for n in names if n.split('_')[0] in ['cf', 'cont']]
+            dprim = self.fit.derivatives([n for n in names if n not in direct])
+            prim = sorted(set(q for d in dprim.values() for q in d))
+            deriv = self.s.chiDeriv(prim + direct)
+            jac = np.zeros((len(chi0), len(names)))
+            for i, (p, name) in enumerate(zip(params, names)):
+                if name in direct:
+                    jac[:, i] = deriv[:, len(prim) + direct.index(name)]
+                elif len(dprim[name]) > 0:
+                    jac[:, i] = np.sum([deriv[:, prim.index(q)] * v for q, v in dprim[name].items()], axis=0)
+                else:
+                    val, h = params[p].value, max(abs(params[p].value), 1) * 1e-6
+                    params[p].value = val + h
+                    jac[:, i] = (fcn2min(params) - chi0) / h
+                    params[p].value = val
+                jac[:, i] *= self.fit.pars()[name].ref(1, attr='step')
+            if last['x'] != x:
+                fcn2min(params)
+            return jac
 
         # create a set of Parameters
         params = Parameters()
@@ -9049,7 +9045,10 @@ class sviewer(QMainWindow):
                 if np.allclose(chi0, chi):
                     print('not shifted', p)
 
-        result = minner.minimize(method=self.fit_method)
+        kws = {}
+        if self.fit_method == 'leastsq' and self.fitType in ['regular', 'fast', 'vector'] and self.fit.disp_num == 0:
+            kws['Dfun'] = Dfun
+        result = minner.minimize(method=self.fit_method, **kws)
 
         print(result.message)
         self.console.set(result.message)
@@ -9093,38 +9092,29 @@ class sviewer(QMainWindow):
             self.thread.join()
 
     def bootFit(self):
+        """
+        Parametric bootstrap of the current fit: synthetic spectra are generated from the fit model on the grids of the exposures
+        with their uncertainties and fitting regions, and fitted by the headless model in parallel (see fit.bootstrap).
+        The number of realizations is taken from Generate (gen_num) options, the results are written to temp/boot.hdf5.
+        """
         print('boot')
-        if 1:
-            res = []
-        else:
-            with open('temp/res.pickle', 'rb') as f:
-                res = pickle.load(f)
-            print(res)
-        if 1:
-            for i in range(100):
-                print(i)
-                self.normalize(False)
-                self.openFile("C:/science/Noterdaeme/HE0001/MgII_boot.spv")
-                self.s.remove(self.s.ind)
-                self.generate(template='const', z=self.fit.sys[0].z.val, fit=True, xmin=4054, xmax=4078, resolution=55000, snr=20,
-                             lyaforest=0.0, lycutoff=False, Av=0.0, Av_bump=0.0, z_Av=0.0, redraw=True)
-                self.normalize(True)
-                self.console.exec_command('x 4054 4078')
-                s = self.s[self.s.ind]
-                s.add_points(4060.350, 1.5, 4060.60, -0.5, remove=False, redraw=False)
-                s.add_points(4070.770, 1.5, 4071, -0.5, remove=False, redraw=False)
-                # self.parent.s[i].add_points(self.mousePoint_saved.x(), self.mousePoint_saved.y(), self.mousePoint.x(), self.mousePoint.y(), remove=False)
-                s.set_fit_mask()
-                s.update_points()
-                s.set_res()
-                self.fit.cf_0.val = 0.95
-                self.fitAbs(timer=False)
-                print(self.fit.list_fit())
-                print([self.fit.getValue(str(p)) for p in self.fit.list_fit()])
-                res.append([self.fit.getValue(str(p)) for p in self.fit.list_fit()])
-            with open('temp/res.pickle', 'wb') as f:
-                pickle.dump(res, f)
-        print(res)
+        if not self.normview:
+            self.normalize()
+        self.s.prepareFit(all=True)
+        lnL = calc_fit(num_between=self.num_between, tau_limit=self.tau_limit, voigt_calc=self.voigt_calc, fit_type=self.fitType)
+        lnL.set_data(self.s)
+        lnL.set_model(self.fit.list_fit(), fit=self.fit)
+        num = int(self.options('gen_num'))
+
+        def progress(done, rate):
+            self.MCMCprogress.setText('     Bootstrap: {0:d} / {1:d}, {2:.1f} per s'.format(done, num, rate))
+            QApplication.processEvents()
+
+        t = Timer('bootstrap')
+        res = bootstrap(lnL, num, threads=int(self.options('MCMC_threads')), filename='temp/boot.hdf5', callback=progress)
+        t.time('{0:d} realizations'.format(num))
+        for p, m, sd in zip(lnL.pars, np.nanmean(res, axis=0), np.nanstd(res, axis=0)):
+            print('{0}: {1:.4f} +- {2:.4f}, bias {3:.4f}'.format(p, m, sd, m - self.fit.getValue(p)))
 
     def showFitResults(self):
         if not self.blindMode:
@@ -9224,7 +9214,7 @@ class sviewer(QMainWindow):
                 print(line.line, line.line != self.abs.reference.line, line.exp)
                 if line.line != self.abs.reference.line:
                     v_1 = vel_offset(self.s[line.exp].spec.x(), line.line.l() * (self.z_abs + 1))
-                    y_1 = spectres.spectres(v_1, self.s[line.exp].spec.y(), v)
+                    y_1 = resample(v_1, self.s[line.exp].spec.y(), v)
                     print(y_1)
                     m = (v_1 >= v[0]) * (v_1 <= v[-1])
                     if 1:
@@ -9868,7 +9858,7 @@ class sviewer(QMainWindow):
                     wavelength, f = l.line.l(), l.line.f()
             xv = (s.spec.x() / wavelength / (1 + self.z_abs) - 1) * 299792.46
             mask = (xv > x[0] - 299792.46 / s.resolution) * (xv < x[-1] + 299792.46 / s.resolution)
-            yi, erri = spectres.spectres((s.spec.x()[mask] / wavelength / (1 + self.z_abs) - 1) * 299792.46, s.spec.y()[mask], x, spec_errs=s.spec.err()[mask])
+            yi, erri = resample((s.spec.x()[mask] / wavelength / (1 + self.z_abs) - 1) * 299792.46, s.spec.y()[mask], x, err=s.spec.err()[mask])
             y += (1 - yi) * f / erri ** 2
             fs += f
             err += 1.0 * f / erri ** 2
@@ -17,9 +17,9 @@ from scipy.interpolate import interp1d
 import sys
 
 from spectro.sdss import SDSS
-from .external import spectres
 from .fit import fitPars
 from .lyaforest import Lyaforest_scan, plotLyalines
+from .resample import resample
 from .stack import catalog
 from .utils import add_field, slice_fields
 
@@ -517,7 +517,7 @@ class QSOlistTable(pg.TableWidget):
                     print(n, ston, w)
                     #print(x, f, err)
                     mask = (l > x[2]) * (l < x[-3])
-                    f, err = spectres.spectres(x, f, l[mask], spec_errs=err)
+                    f, err = resample(x, f, l[mask], err=err)
                     m = np.logical_not(err == 0)
                     s[mask] += m * (f / n) * w
                     err = (err / n)**(-2)
@@ -0,0 +1,10 @@
+# the repository is the package itself (imported as spectro, see sviewer/__main__.py),
+# so add its parent folder to the path and register the package under this name
+import importlib
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(root))
+if 'spectro' not in sys.modules:
+    sys.modules['spectro'] = importlib.import_module(os.path.basename(root))
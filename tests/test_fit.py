@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+fitPars = pytest.importorskip('spectro.sviewer.fit').fitPars
+
+
+@pytest.fixture
+def model():
+    """
+    Two systems with isotopic, metallicity, turbulent/kinetic b and pyratio ties of the parameters
+    """
+    f = fitPars(None)
+    f.addSys(z=2.5)
+    for sp in ['HI', 'DI', 'OI', 'SiII', 'H2j0', 'H2j1', 'H2j2', 'CI', 'CIj1']:
+        f.sys[0].addSpecies(sp)
+    f.addSys(z=2.6)
+    for sp in ['HI', 'OI']:
+        f.sys[1].addSpecies(sp)
+    f.add('me_0')
+    f.me_num = 1
+    f.add('iso', addinfo='D/H')
+    f.setValue('N_0_DI', 'iso', 'addinfo')
+    for name in ['N_0_OI', 'N_1_OI', 'N_0_SiII']:
+        f.setValue(name, 'me_0', 'addinfo')
+    f.sys[0].add('turb')
+    f.sys[0].add('kin')
+    f.setValue('b_0_OI', 'consist', 'addinfo')
+    f.setValue('b_0_SiII', 'OI', 'addinfo')
+    for a in ['Ntot', 'logn', 'logT', 'logf', 'rad', 'CMB']:
+        f.sys[0].add(a)
+    f.sys[0].rad.addinfo = 'Habing'
+    for sp in ['H2j0', 'H2j1', 'H2j2', 'CIj1']:
+        f.setValue('N_0_' + sp, 'Ntot', 'addinfo')
+    f.addTieds('b_1_HI', 'b_0_HI')
+    f.addTieds('z_1', 'z_0')
+    f.sys[0].z.min, f.sys[0].z.max = 2.49, 2.51
+    f.sys[1].z.min, f.sys[1].z.max = 2.55, 2.65
+    for name, v in [('N_0_HI', 19.5), ('N_1_HI', 18.0), ('me_0', -0.5)]:
+        f.setValue(name, v)
+    f.update(redraw=False)
+    return f
+
+
+def test_propagate(model):
+    f = model
+    names = ['z_0', 'b_0_HI', 'N_0_HI', 'N_1_HI', 'me_0', 'iso', 'turb_0', 'kin_0', 'Ntot_0', 'logn_0', 'logT_0', 'logf_0', 'rad_0', 'N_0_CI', 'CMB_0']
+    p0 = np.array([f.getValue(n) for n in names])
+    scale = np.array([1e-4, 1, .3, .3, .2, .1, 1, 1e3, .3, .3, .2, .3, .3, .3, .5])
+    samples = p0 + np.random.default_rng(1).normal(size=(10, len(names))) * scale
+    saved = [p.val for p in f.list()]
+    values = f.propagate(names, samples)
+    assert np.array_equal([p.val for p in f.list()], saved)
+
+    # reference: setValue() of each sample followed by update()
+    ref = []
+    for x in samples:
+        for v, name in zip(x, names):
+            f.setValue(name, v)
+        f.update(redraw=False)
+        ref.append([p.val for p in f.list()])
+    assert values.shape == (len(samples), len(f.list()))
+    assert np.allclose(values, ref, rtol=0, atol=1e-10)
+    assert np.array_equal(values, f.propagate(names, samples, ops=f.derivation()))
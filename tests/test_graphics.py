@@ -0,0 +1,108 @@
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt6')
+from spectro.atomic import line as aline
+from spectro.sviewer.fit import fitPars
+from spectro.sviewer.graphics import Speclist, Spectrum
+
+
+@pytest.fixture(params=[None, 50000])
+def spectrum(request):
+    """
+    Spectrum with two systems, partial covering and continuum correction, built without the GUI
+    """
+    rng = np.random.default_rng(11)
+    # small tau_limit: the cutoff of the line profiles is not differentiable, and shows up in finite differences
+    parent = types.SimpleNamespace(s=[], normview=True, voigt_calc='spec', tau_limit=1e-6)
+    fit = fitPars(parent)
+    fit.addSys(z=2.0)
+    fit.addSys(z=2.0001)
+    for i in range(2):
+        for sp, b, N in [('H2j0', 3 + i, 15), ('H2j1', 3, 14.5)]:
+            fit.setValue('b_{0}_{1}'.format(i, sp), b)
+            fit.setValue('N_{0}_{1}'.format(i, sp), N)
+    fit.add('cf_0')
+    fit.setValue('cf_0', 0.7)
+    fit.cf_fit, fit.cf_num = True, 1
+    fit.add('cont_0_0')
+    fit.add('cont_0_1')
+    fit.setValue('cont_0_1', 0.01)
+    fit.cont_fit, fit.cont_num = True, 1
+    fit.cont[0].left, fit.cont[0].right, fit.cont[0].exp = 3000, 3100, 0
+    parent.fit = fit
+
+    s = Spectrum.__new__(Spectrum)
+    s.parent, s.resolution, s.fit_cache = parent, request.param, None
+    x = np.linspace(3000, 3100, 10000)
+    err, mask = np.full_like(x, 0.05), np.ones_like(x, dtype=bool)
+    y = 1 + err * rng.normal(size=len(x))
+    s.spec = types.SimpleNamespace(norm=types.SimpleNamespace(x=x, n=len(x)), x=lambda: x, y=lambda: y, err=lambda: err)
+    s.mask = types.SimpleNamespace(norm=types.SimpleNamespace(x=np.zeros_like(x)))
+    s.fit_mask = types.SimpleNamespace(x=lambda: mask)
+    s.cont = types.SimpleNamespace(n=1)
+    s.ind = lambda: 0
+    s.fit_lines = []
+    for sys in range(2):
+        for sp in ['H2j0', 'H2j1']:
+            for l in rng.uniform(1000, 1033, 6):
+                line = aline(sp, l, 10 ** rng.uniform(-3, -1.5), 1e8)
+                line.sys, line.cf = sys, 0 if sp == 'H2j1' else -1
+                line.recalc = True
+                s.fit_lines.append(line)
+
+    s.fit = types.SimpleNamespace(line=types.SimpleNamespace(norm=types.SimpleNamespace(x=None, y=None), n=lambda: 1))
+    def set_fit(x, y):
+        s.fit.line.norm.x, s.fit.line.norm.y = x, y
+        s.fit.line.f = lambda xs: np.interp(xs, x, y)
+    s.set_fit, s.set_gfit, s.set_res = set_fit, lambda: None, lambda: None
+    return s
+
+
+def chi(s, fit_type):
+    s.parent.fit.update(redraw=False)
+    if fit_type == 'vector':
+        s.calcFit_vector(recalc=True, num_between=3, tau_limit=s.parent.tau_limit)
+    else:
+        s.calcFit(recalc=True, tau_limit=s.parent.tau_limit)
+    return s.chi()
+
+
+@pytest.mark.parametrize('fit_type', ['vector', 'regular'])
+def test_calcFitDeriv(spectrum, fit_type):
+    s, fit = spectrum, spectrum.parent.fit
+    names = ['z_0', 'z_1', 'b_0_H2j0', 'b_1_H2j1', 'N_0_H2j1', 'N_1_H2j0', 'cf_0', 'cont_0_0', 'cont_0_1']
+    chi(s, fit_type)
+    # the model is calculated only in the regions of the lines, the residuals are taken within them
+    x, xf = s.spec.x(), s.fit.line.norm.x
+    s.fit_mask.x()[:] = (x > xf[0] + 0.1) * (x < xf[-1] - 0.1)
+    deriv = s.calcFitDeriv(names, tau_limit=s.parent.tau_limit)
+    assert deriv.shape == (np.sum(s.fit_mask.x()), len(names))
+    for j, name in enumerate(names):
+        v, h = fit.getValue(name), 1e-8 if name.startswith('z') else 1e-5
+        fit.setValue(name, v + h)
+        c1 = chi(s, fit_type)
+        fit.setValue(name, v - h)
+        c0 = chi(s, fit_type)
+        fit.setValue(name, v)
+        fd = (c1 - c0) / 2 / h
+        assert np.max(np.abs(fd)) > 0
+        assert np.allclose(deriv[:, j], fd, rtol=0, atol=1e-3 * np.max(np.abs(fd))), name
+
+
+def test_chiDeriv(spectrum):
+    s, fit = spectrum, spectrum.parent.fit
+    chi(s, 'vector')
+    x, xf = s.spec.x(), s.fit.line.norm.x
+    s.fit_mask.x()[:] = (x > xf[0] + 0.1) * (x < xf[-1] - 0.1)
+    speclist = Speclist(s.parent)
+    speclist.extend([s, s])
+    names = ['N_0_H2j0', 'N_0_HI', 'b_2_H2j0', 'cf_0']
+    deriv = speclist.chiDeriv(names)
+    assert deriv.shape == (len(speclist.chi()), len(names))
+    assert np.array_equal(deriv, np.vstack([s.calcFitDeriv(names, tau_limit=s.parent.tau_limit)] * 2))
+    assert np.array_equal(speclist.chiDeriv(names, exp_ind=1), s.calcFitDeriv(names, tau_limit=s.parent.tau_limit))
+    # the parameters which are not in the model
+    assert np.all(deriv[:, 1:3] == 0) and np.all(np.any(deriv[:, [0, 3]] != 0, axis=0))
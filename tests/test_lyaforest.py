@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt6')
+from spectro.sviewer.lyaforest import correl3, matched_filter
+
+
+def chi2_ref(y, fit, mask, err):
+    """
+    Direct chi-square of the template shifted along the spectrum, used as the reference
+    """
+    n, m = len(y), fit.shape[0]
+    chi2 = np.empty((n - m + 1,) + fit.shape[1:])
+    for i in range(n - m + 1):
+        chi2[i] = np.sum(mask * ((y[i:i + m] - fit.T) / err[i:i + m]).T ** 2, axis=0)
+    return chi2
+
+
+@pytest.fixture
+def spectrum():
+    rng = np.random.default_rng(4)
+    n = 3000
+    err = 0.05 + 0.05 * rng.random(n)
+    y = 1 + err * rng.normal(size=n)
+    templates = [1 - 0.8 * np.exp(-np.linspace(-3, 3, m)[:, np.newaxis] ** 2 * np.array([1, 2, 4])) for m in [31, 45]]
+    masks = [(rng.random(t.shape) > 0.2).astype(float) for t in templates]
+    return y, err, templates, masks
+
+
+def test_matched_filter(spectrum):
+    y, err, templates, masks = spectrum
+    for chi2, t, m in zip(matched_filter(y, templates, masks, err=err, chunk=500), templates, masks):
+        ref = chi2_ref(y, t, m, err)
+        assert np.allclose(chi2, ref, rtol=1e-10, atol=1e-8)
+    assert np.allclose(correl3(y, templates[0], masks[0], err=err), chi2_ref(y, templates[0], masks[0], err), rtol=1e-10, atol=1e-8)
+
+
+def test_matched_filter_extreme_weights(spectrum):
+    y, err, templates, masks = spectrum
+    err = np.copy(err)
+    err[[100, 1500, 2990]] = 1e-9
+    chi2 = matched_filter(y, templates, masks, err=err)[0]
+    ref = chi2_ref(y, templates[0], masks[0], err)
+    assert np.all(chi2 >= 0)
+    assert np.allclose(chi2, ref, rtol=1e-10, atol=1e-8)
+
+
+def test_matched_filter_bad_pixels(spectrum):
+    y, err, templates, masks = spectrum
+    y, err = np.copy(y), np.copy(err)
+    y[200], err[700] = np.nan, 0
+    chi2 = matched_filter(y, templates[:1], masks[:1], err=err)[0]
+    m = templates[0].shape[0]
+    for j in [200, 700]:
+        shifts = np.arange(j - m + 1, j + 1)
+        assert np.all(np.isinf(chi2[shifts][masks[0][j - shifts] != 0]))
+    good = np.isfinite(chi2)
+    assert np.allclose(chi2[good], chi2_ref(np.nan_to_num(y), templates[0], masks[0], np.where(err == 0, 1, err))[good], rtol=1e-10, atol=1e-8)
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from spectro.profiles import calctau_lines, convolve_res, convolve_res2, convolve_res2_update, tau, tau_lines_sparse, voigt, voigt_table
+
+# >>> reference (pure python) implementations of the convolutions before the compiled kernels
+
+def gauss(x, s):
+    return 1 / np.sqrt(2 * np.pi) / s * np.exp(-.5 * (x / s) ** 2)
+
+def errf(x):
+    a = [0.3480242, -0.0958798, 0.7478556]
+    t = 1 / (1 + 0.47047 * np.abs(x))
+    return np.sign(x) * (1 - t * (a[0] + t * (a[1] + t * a[2])) * np.exp(-x**2))
+
+def errf_v2(x):
+    a = [-1.26551223, 1.00002368, 0.37409196, 0.09678418, -0.18628806, 0.27886807, -1.13520398, 1.48851587, -0.82215223, 0.17087277]
+    t = 1 / (1 + 0.5 * np.abs(x))
+    tau = t * np.exp(-x ** 2 + a[0] + t * (a[1] + t * (a[2] + t * (a[3] + t * (a[4] + t * (a[5] + t * (a[6] + t * (a[7] + t * (a[8] + t * a[9])))))))))
+    if x >= 0:
+        return 1 - tau
+    else:
+        return tau - 1
+
+def convolve_res_ref(l, f, R):
+    delta = 3.0
+    n = len(l)
+    fc = np.zeros_like(f)
+    d = [l[1] - l[0]]
+    for i in range(1, n-1):
+        d.append((l[i + 1] - l[i - 1]) / 2)
+    d.append(l[-1]-l[-2])
+    il = 0
+    for i, x in enumerate(l):
+        sig = x / R / 2.355
+        k = il
+        while l[k] < x - delta * sig:
+            k += 1
+        il = k
+        s = f[k] * (1 - errf(np.abs(l[k] - x - d[0]/2) / np.sqrt(2) / sig)) / 2
+        while k < n and l[k] < x + delta * sig:
+            s += f[k] * gauss(l[k] - x, sig) * d[k]
+            k += 1
+        k -= 1
+        s += f[k] * (1 - errf(np.abs(l[k] - x + d[k]/2) / np.sqrt(2) / sig)) / 2
+        fc[i] = s
+    return fc
+
+def convolve_res2_ref(l, f, R):
+    delta = 3.0
+    n = len(l)
+    fc = np.zeros_like(f)
+    f = 1 - f
+    il = 0
+    for i, x in enumerate(l):
+        sig = x / R / 2.355
+        k = il
+        while l[k] < x - delta * sig:
+            k += 1
+        il = k
+        s = f[il] * (1 - errf_v2((x - l[il]) / np.sqrt(2) / sig)) / 2
+        while k < n-1 and l[k+1] < x + delta * sig:
+            s += (f[k+1] * gauss(l[k+1] - x, sig) + f[k] * gauss(l[k] - x, sig)) / 2 * (l[k+1] - l[k])
+            k += 1
+        s += f[k] * (1 - errf_v2(np.abs(l[k] - x) / np.sqrt(2) / sig)) / 2
+        fc[i] = s
+    return 1 - fc
+
+@pytest.fixture(scope='module')
+def spectrum():
+    """
+    unevenly spaced grid with absorption lines (similar to the one created by makegrid)
+    """
+    rng = np.random.default_rng(1)
+    l = np.sort(rng.uniform(5000, 5010, 3000))
+    f = np.ones_like(l)
+    for l0, w, d in zip(rng.uniform(5000, 5010, 5), rng.uniform(0.02, 0.2, 5), rng.uniform(0.1, 1, 5)):
+        f *= 1 - d * np.exp(-.5 * ((l - l0) / w) ** 2)
+    return l, f
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_convolve_res(spectrum, parallel):
+    l, f = spectrum
+    assert np.allclose(convolve_res(l, f, 50000, parallel=parallel), convolve_res_ref(l, f, 50000), rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_convolve_res2(spectrum, parallel):
+    l, f = spectrum
+    assert np.allclose(convolve_res2(l, f, 50000, parallel=parallel), convolve_res2_ref(l, f, 50000), rtol=0, atol=1e-12)
+
+def test_convolve_res2_variable_resolution(spectrum):
+    l, f = spectrum
+    assert np.allclose(convolve_res2(l, f, np.full_like(l, 30000)), convolve_res2(l, f, 30000), rtol=0, atol=0)
+
+def test_convolve_res2_update(spectrum):
+    l, f = spectrum
+    fc = convolve_res2(l, f, 50000)
+    f1 = np.copy(f)
+    f1[1000:1100] *= 0.5
+    assert np.allclose(convolve_res2_update(l, f1, 50000, fc, [(1000, 1100)]), convolve_res2(l, f1, 50000), rtol=0, atol=1e-14)
+
+
+# >>> multi-line optical depth against the loop over tau.calctau of single lines
+
+@pytest.fixture
+def lines():
+    x = np.linspace(3640, 3700, 20000)
+    # Lya forest and metal lines with the different widths and column densities, including damped wings and weak lines
+    l = np.array([1215.6701, 1215.6701, 1215.6701, 1025.7223, 1334.5323, 1526.7070])
+    f = np.array([0.4164, 0.4164, 0.4164, 0.07912, 0.1278, 0.133])
+    g = np.array([6.265e8, 6.265e8, 6.265e8, 1.897e8, 2.88e8, 1.13e9])
+    logN = np.array([13.5, 20.3, 11.0, 14.5, 14.0, 12.5])
+    b = np.array([25.0, 10.0, 5.0, 30.0, 3.0, 8.0])
+    z = np.array([2.0, 2.005, 2.01, 2.56, 1.74, 1.4])
+    return x, l, f, g, logN, b, z
+
+
+def tau_loop(x, l, f, g, logN, b, z, resolution, tlim, calc='spec'):
+    return [tau(l=li, f=fi, g=gi, logN=Ni, b=bi, z=zi, resolution=resolution, calc=calc).calctau(x, tlim=tlim)
+            for li, fi, gi, Ni, bi, zi in zip(l, f, g, logN, b, z)]
+
+
+@pytest.mark.parametrize('resolution', [None, 50000])
+def test_calctau_lines(lines, resolution):
+    ref = tau_loop(*lines, resolution=resolution, tlim=0.01)
+    assert np.allclose(calctau_lines(*lines, resolution=resolution, tlim=0.01), np.sum(ref, axis=0), rtol=1e-12, atol=0)
+    groups = np.array([0, 0, 1, 1, 2, 2])
+    t = calctau_lines(*lines, resolution=resolution, tlim=0.01, groups=groups, ngroups=4)
+    assert t.shape == (4, len(lines[0]))
+    for i in range(4):
+        assert np.allclose(t[i], np.sum([r for r, gr in zip(ref, groups) if gr == i], axis=0), rtol=1e-12, atol=0)
+
+
+def test_tau_lines_sparse(lines):
+    ref = tau_loop(*lines, resolution=50000, tlim=0.01)
+    k, ind, t = tau_lines_sparse(*lines, resolution=50000, tlim=0.01)
+    for i, r in enumerate(ref):
+        dense = np.zeros_like(r)
+        dense[ind[k == i]] = t[k == i]
+        assert np.allclose(dense, r, rtol=1e-12, atol=0)
+
+
+def test_calctau_lines_table(lines):
+    ref = np.sum(tau_loop(*lines, resolution=50000, tlim=0.01, calc='table'), axis=0)
+    assert np.allclose(calctau_lines(*lines, resolution=50000, tlim=0.01, calc='table'), ref, rtol=1e-12, atol=0)
+
+
+# >>> table driven Voigt function against the direct calculation by wofz
+
+@pytest.mark.parametrize('a', [0.0, 1e-7, 1e-4, 1e-2, 0.05, 0.1, 0.2, 1.0])
+def test_voigt_table(a):
+    # the table (|u| < 15), the asymptotic expansion (|u| > 15) and the direct calculation (a > 0.1)
+    u = np.concatenate([np.linspace(-30, 30, 60001), [-15.0, 15.0, -14.99, 14.99, 100.0, -1e4]])
+    assert np.max(np.abs(voigt_table(a, u) - voigt(a, u, calc='spec'))) < 1e-10
+
+
+def test_voigt_table_arrays():
+    rng = np.random.default_rng(2)
+    a, u = 10 ** rng.uniform(-7, 0, 10000), rng.uniform(-40, 40, 10000)
+    assert np.max(np.abs(voigt_table(a, u) - voigt(a, u, calc='spec'))) < 1e-10
+    assert voigt_table(a.reshape(100, 100), u.reshape(100, 100)).shape == (100, 100)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from spectro.pyratio import pyratio, emulator, emulator_axes
+
+
+@pytest.fixture(scope='module')
+def pr():
+    pr = pyratio(z=2.5, pumping='simple', radiation='simple', sed_type='Habing')
+    pr.set_pars(['T', 'n', 'f', 'rad', 'CMB'])
+    pr.add_spec('CI', num=3)
+    for k, v in [('T', 2.), ('n', 2.), ('f', -1.), ('rad', 0.), ('CMB', 9.5)]:
+        pr.pars[k].value = v
+    return pr
+
+
+def log_fractions(x):
+    return np.log10(x / np.sum(x, axis=1)[:, np.newaxis])
+
+
+def dense_error(e, pr, num=20000):
+    rng = np.random.default_rng(5)
+    values = {p: emulator_axes.get(p, (None, lambda u: u))[1](rng.uniform(u[0], u[-1], num)) for p, u in zip(e.pars, e.axes)}
+    le, lm = log_fractions(pr.balance_grid(e.name, e.full(values))), log_fractions(e(values))
+    return np.nanmax(np.where(le > -6, np.abs(le - lm), 0))
+
+
+def test_emulator_accuracy(pr):
+    e = emulator(pr, 'CI', {'T': [1, 3], 'n': [0, 4]}, fixed={'f': -1., 'rad': 0., 'CMB': 9.5})
+    assert e.valid
+    error = dense_error(e, pr)
+    # the check at the cell centers does not underestimate the error much, and the dense error is within tolerance
+    assert e.error > 0.5 * error
+    assert error < 0.01
+
+
+def test_emulator_invalid(pr):
+    # coarse grid fails the accuracy check and all the points are calculated exactly
+    e = emulator(pr, 'CI', {'T': [1, 3], 'n': [0, 4]}, fixed={'f': -1., 'rad': 0., 'CMB': 9.5}, size=25, tol=1e-4)
+    assert not e.valid
+    assert dense_error(e, pr, num=500) < 1e-12
+
+
+def test_emulator_outside(pr):
+    e = emulator(pr, 'CI', {'T': [1.5, 2.5], 'n': [1, 3]}, fixed={'f': -1., 'rad': 0., 'CMB': 9.5})
+    values = {'T': np.array([1.0, 2.0, 3.0]), 'n': np.array([2.0, 0.5, 2.0])}
+    assert np.allclose(log_fractions(e(values)), log_fractions(pr.balance_grid('CI', e.full(values))), atol=1e-12)
+
+
+@pytest.mark.parametrize('emulate', [False, True])
+def test_fit_populations(emulate):
+    fitPars = pytest.importorskip('spectro.sviewer.fit').fitPars
+    f = fitPars(None)
+    f.pyratio_emulate = emulate
+    f.addSys(z=2.5)
+    for sp in ['CI', 'CIj1', 'CIj2']:
+        f.sys[0].addSpecies(sp)
+    for a, v in [('Ntot', 14.), ('logn', 2.), ('logT', 2.), ('logf', -1.), ('rad', 0.), ('CMB', 9.5)]:
+        f.sys[0].add(a)
+        f.setValue('{0}_0'.format(a), v)
+    f.sys[0].rad.addinfo = 'Habing'
+    for s in ['CI', 'CIj1', 'CIj2']:
+        f.setValue('N_0_' + s, 'Ntot', 'addinfo')
+    f.sys[0].logT.min, f.sys[0].logT.max, f.sys[0].logn.min, f.sys[0].logn.max = 1., 3., 0., 4.
+    for a in ['logf', 'rad', 'CMB', 'Ntot']:
+        f.setValue('{0}_0'.format(a), 0, 'vary')
+    f.setValue('logT_0', 1.77)
+    f.update(redraw=False)
+
+    pr = f.sys[0].pr
+    for k, v in [('T', 1.77), ('n', 2.), ('f', -1.), ('rad', 0.), ('CMB', 9.5)]:
+        pr.pars[k].value = v
+    col = pr.predict(name='CI', level=-1, logN=14.)
+    assert len(getattr(pr, 'emulators', {})) == int(emulate)
+    assert np.allclose([f.sys[0].sp[s].N.val for s in ['CI', 'CIj1', 'CIj2']], col, atol=0.01 if emulate else 1e-10)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from spectro.sviewer.resample import bin_edges, coadd, edges_slice, rebin_matrix, resample
+
+
+def resample_ref(x, y, x_new, err, fill_value=np.nan):
+    """
+    Loop version of the flux conserving resampling (as in spectres), used as the reference
+    """
+    e, e_new = bin_edges(x), bin_edges(x_new)
+    widths = np.diff(e)
+    y_new, err_new = np.full(len(x_new), fill_value), np.full(len(x_new), fill_value)
+    for j in range(len(x_new)):
+        if e_new[j] < e[0] or e_new[j + 1] > e[-1]:
+            continue
+        start = np.searchsorted(e, e_new[j], side='right') - 1
+        stop = np.searchsorted(e, e_new[j + 1], side='left') - 1
+        w = widths[start:stop + 1].copy()
+        w[0] = e[start + 1] - e_new[j]
+        w[-1] -= e[stop + 1] - e_new[j + 1]
+        if start == stop:
+            w[0] = e_new[j + 1] - e_new[j]
+        y_new[j] = np.sum(w * y[start:stop + 1]) / np.sum(w)
+        err_new[j] = np.sqrt(np.sum((w * err[start:stop + 1]) ** 2)) / np.sum(w)
+    return y_new, err_new
+
+
+@pytest.fixture
+def grids():
+    rng = np.random.default_rng(2)
+    x = np.sort(4000 + 100 * rng.random(2000))
+    x_new = np.linspace(3990, 4110, 700)
+    y = 1 + rng.normal(size=len(x))
+    err = 0.1 + rng.random(len(x))
+    return x, y, err, x_new
+
+
+def test_edges_slice(grids):
+    x = grids[0]
+    e = bin_edges(x)
+    for start, stop in [(0, 10), (5, 100), (1990, 2000), (0, 2000), (7, 7)]:
+        assert np.array_equal(edges_slice(x, start, stop), e[start:stop + 1])
+
+
+@pytest.mark.parametrize('cache', [True, False])
+def test_resample(grids, cache):
+    x, y, err, x_new = grids
+    y_ref, err_ref = resample_ref(x, y, x_new, err)
+    y_new, err_new = resample(x, y, x_new, err=err, cache=cache)
+    assert np.array_equal(np.isnan(y_new), np.isnan(y_ref))
+    assert np.allclose(y_new, y_ref, equal_nan=True, rtol=0, atol=1e-12)
+    assert np.allclose(err_new, err_ref, equal_nan=True, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('rows', [slice(0, 50), slice(100, 400), slice(650, 700), slice(300, 300)])
+def test_resample_rows(grids, rows):
+    x, y, err, x_new = grids
+    y_all, err_all = resample(x, y, x_new, err=err)
+    y_new, err_new = resample(x, y, x_new, err=err, rows=rows, cache=False)
+    assert np.allclose(y_new, y_all[rows], equal_nan=True, rtol=0, atol=1e-12)
+    assert np.allclose(err_new, err_all[rows], equal_nan=True, rtol=0, atol=1e-12)
+    assert rebin_matrix(x, x_new)[0][rows].shape == (len(y_new), len(x))
+
+
+@pytest.mark.parametrize('typ', ['Weighted mean', 'Mean', 'Median'])
+def test_coadd(typ):
+    rng = np.random.default_rng(3)
+    x = np.linspace(5000, 5100, 3000)
+    exposures = []
+    for i in range(5):
+        xe = np.sort(5000 + i * 3 + 90 * rng.random(1500))
+        exposures.append((xe, 1 + rng.normal(size=len(xe)), 0.5 + rng.random(len(xe))))
+
+    # dense stack of the projected exposures as the reference
+    stack, e_stack = np.full((len(exposures), len(x)), np.nan), np.full((len(exposures), len(x)), np.nan)
+    for k, (xe, ye, ee) in enumerate(exposures):
+        mask = (x > xe[2]) * (x < xe[-3])
+        stack[k, mask], e_stack[k, mask] = resample_ref(xe, ye, x[mask], ee)
+    with np.errstate(all='ignore'):
+        if typ == 'Median':
+            y_ref = np.nanmedian(stack, axis=0)
+        elif typ == 'Mean':
+            y_ref = np.nanmean(stack, axis=0)
+        else:
+            y_ref = np.nansum(stack * e_stack ** -2, axis=0) / np.nansum(e_stack ** -2, axis=0)
+
+    c = coadd(x, typ=typ, chunk=700)
+    for e in exposures:
+        c.add(*e)
+    y, err = c.result()
+    assert np.allclose(y, y_ref, equal_nan=True, rtol=0, atol=1e-10)
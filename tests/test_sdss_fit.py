@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+pytest.importorskip('PyQt6')
+from spectro.sviewer.sdss_fit import SDSS_fit, emsvd
+
+
+def lnL_ref(Ms, w, Y, V, num):
+    """
+    Dense per-spectrum likelihood of SDSS_fit (before Woodbury batching), used as the reference
+    """
+    W = np.exp(w)
+    lnL, dM, dw = 0, np.zeros_like(Ms), np.zeros_like(w)
+    for y, v in zip(Y, V):
+        mask = np.isfinite(y) * np.isfinite(v)
+        y, d, M = y[mask], v[mask] + W[mask], Ms[mask]
+        S_inv = np.linalg.inv(np.dot(M, M.T) + np.diag(d))
+        alpha = np.dot(S_inv, y)
+        lnL += np.dot(y, alpha) + np.linalg.slogdet(np.dot(M, M.T) + np.diag(d))[1] + len(y) * np.log(2 * np.pi)
+        dM[mask] -= np.dot(np.outer(alpha, alpha) - S_inv, M)
+        dw[mask] -= 0.5 * W[mask] * (alpha ** 2 - np.diag(S_inv))
+    return 0.5 * lnL, dM, dw
+
+
+@pytest.fixture
+def model():
+    rng = np.random.default_rng(6)
+    s = SDSS_fit.__new__(SDSS_fit)
+    s.num, s.Npix, s.batch, s.t = 3, 40, 4, None
+    s.Y_in = rng.normal(size=(11, s.Npix))
+    s.V = 0.1 + rng.random((11, s.Npix))
+    s.Y_in[rng.random(s.Y_in.shape) < 0.1] = np.nan
+    s.V[rng.random(s.V.shape) < 0.05] = np.inf
+    x = s.pack(0.3 * rng.normal(size=(s.Npix, s.num)), -1 + 0.1 * rng.normal(size=s.Npix))
+    return s, x
+
+
+def test_lnL(model):
+    s, x = model
+    lnL, jac = s.lnL(x)
+    ref, dM, dw = lnL_ref(*s.pack(x), s.Y_in, s.V, s.num)
+    assert np.isclose(lnL, ref, rtol=1e-12)
+    assert np.allclose(jac, s.pack(dM, dw), rtol=1e-10, atol=1e-10)
+
+
+def test_lnL_jac(model):
+    s, x = model
+    jac, eps = s.lnL(x)[1], 1e-6
+    for i in [0, 5, s.num * s.Npix + 3, len(x) - 1]:
+        dx = np.zeros_like(x)
+        dx[i] = eps
+        assert np.isclose(jac[i], (s.lnL(x + dx)[0] - s.lnL(x - dx)[0]) / 2 / eps, rtol=1e-5, atol=1e-6)
+
+
+def test_lnL_inds(model):
+    s, x = model
+    inds = np.array([1, 4, 7, 8, 10])
+    lnL, jac = s.lnL(x, inds=inds)
+    ref, dM, dw = lnL_ref(*s.pack(x), s.Y_in[inds], s.V[inds], s.num)
+    assert np.isclose(lnL, ref, rtol=1e-12)
+    assert np.allclose(jac, s.pack(dM, dw), rtol=1e-10, atol=1e-10)
+
+
+@pytest.fixture
+def lowrank():
+    rng = np.random.default_rng(7)
+    Y = rng.normal(size=(200, 4)).dot(rng.normal(size=(4, 60)) * np.array([[8], [4], [2], [1]])) + 5 + 0.01 * rng.normal(size=(200, 60))
+    return Y
+
+
+@pytest.mark.parametrize('method', ['svd', 'svds', 'randomized'])
+def test_emsvd_complete(lowrank, method):
+    Y_hat, mu, U, s, Vt = emsvd(lowrank, k=4, method=method, seed=1)
+    ref = np.linalg.svd(lowrank - lowrank.mean(axis=0), compute_uv=False)[:4]
+    assert np.all(np.diff(s[:4]) <= 0)
+    assert np.allclose(s[:4], ref, rtol=1e-6)
+
+
+@pytest.mark.parametrize('method', ['svds', 'randomized'])
+def test_emsvd_missing(lowrank, method):
+    Y = np.copy(lowrank)
+    missing = np.random.default_rng(8).random(Y.shape) < 0.05
+    Y[missing] = np.nan
+    Y_hat, mu, U, s, Vt = emsvd(Y, k=4, method=method, tol=1e-8, maxiter=500, seed=1, block=64)
+    ref = emsvd(Y, k=4, method='svds', tol=1e-8, maxiter=500)
+    assert np.all(np.diff(s) <= 0)
+    assert np.allclose(s, ref[3][:4], rtol=1e-4)
+    assert np.allclose(Y_hat[missing], lowrank[missing], atol=0.1)
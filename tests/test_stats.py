@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from scipy import integrate, optimize
+from scipy.stats import kstest, norm
+
+from spectro.stats import distr1d, distr2d, grid_interp
+
+
+@pytest.fixture
+def gauss2d():
+    x, y = np.linspace(-5, 5, 81), np.linspace(-8, 8, 101)
+    X, Y = np.meshgrid(x, y)
+    return x, y, np.exp(-X ** 2 / 2 - Y ** 2 / 2 / 4)
+
+
+def test_distr2d_scattered(gauss2d):
+    x, y, z = gauss2d
+    X, Y = np.meshgrid(x, y)
+    ind = np.random.default_rng(9).permutation(z.size)
+    # duplicated cell with different value: the first one is kept, as in the loop over the cells
+    xs, ys, zs = np.r_[X.flatten()[ind], X.flat[ind[0]]], np.r_[Y.flatten()[ind], Y.flat[ind[0]]], np.r_[z.flatten()[ind], -1]
+    d, ref = distr2d(xs, ys, zs), distr2d(x, y, z)
+    assert np.array_equal(d.x, x) and np.array_equal(d.y, y)
+    assert np.allclose(d.z, ref.z, rtol=1e-14)
+
+
+def test_grid_interp(gauss2d):
+    x, y, z = gauss2d
+    inter = grid_interp(x, y, z)
+    assert np.allclose(inter(x, y), z, atol=1e-12)
+    assert np.allclose(inter(x[10], y), z[:, 10][:, np.newaxis], atol=1e-12)
+    assert np.allclose(inter(x, y[20]), z[20], atol=1e-12)
+    assert np.all(inter(np.array([-6, 6]), y) == 0) and np.all(inter(x, np.array([-9, 9])) == 0)
+
+
+@pytest.mark.parametrize('conf', [0.683, 0.954])
+def test_distr2d_level(gauss2d, conf):
+    d = distr2d(*gauss2d)
+    d.dopoint()
+    # highest density region of bivariate normal distribution: pdf = (1 - conf) * zmax
+    assert np.isclose(d.level(conf), (1 - conf) * d.zmax, rtol=5e-3)
+    # the same level by bisection of the Simpson integral over the fine grid
+    x, y = np.linspace(-5, 5, 300), np.linspace(-8, 8, 300)
+    ref = optimize.bisect(d.func, 0, d.zmax, args=(conf, x, y, d.inter(x, y)), xtol=1e-8)
+    assert np.isclose(d.level(conf), ref, rtol=2e-3)
+    xint, yint, level = d.dointerval(conf)
+    r = np.sqrt(-2 * np.log(1 - conf))
+    assert np.allclose(xint, [-r, r], atol=0.15) and np.allclose(yint, [-2 * r, 2 * r], atol=0.2)
+
+
+@pytest.fixture
+def skewed():
+    x = np.linspace(0, 10, 400)
+    return x, x ** 2 * np.exp(-x)
+
+
+def test_distr1d_cdf_ppf(skewed):
+    d = distr1d(*skewed)
+    xs = np.array([0.0, 0.3, 1.7, 2.0, 5.55, 10.0])
+    ref = [integrate.quad(d.inter, 0, x, epsabs=1e-12, limit=500)[0] for x in xs]
+    assert np.allclose(d.cdf(xs), ref, atol=1e-9)
+    q = np.linspace(0, d.F[-1], 50)
+    assert np.allclose(d.cdf(d.ppf(q)), q, atol=1e-12)
+
+
+@pytest.mark.parametrize('conf', [0.683, 0.9])
+def test_distr1d_interval(skewed, conf):
+    d = distr1d(*skewed)
+    xmin, xmax = d.dointerval(conf)[0]
+    # reference: the level is found by bisection, the mass between the crossings by quad
+    cross = lambda level, a, b: optimize.bisect(lambda x: d.inter(x) - level, a, b, xtol=1e-12)
+    mass = lambda level: integrate.quad(d.inter, cross(level, 0, d.point), cross(level, d.point, 10), epsabs=1e-12, limit=500)[0] - conf
+    level = optimize.bisect(mass, 1.01 * max(d.y[0], d.y[-1]), float(d.ymax) * (1 - 1e-9), xtol=1e-12)
+    assert np.allclose([xmin, xmax], [cross(level, 0, d.point), cross(level, d.point, 10)], atol=1e-6)
+    assert np.isclose(d.inter(xmin), d.inter(xmax), rtol=1e-6)
+
+
+@pytest.mark.parametrize('kind', ['left', 'right'])
+def test_distr1d_oneside(kind):
+    x = np.linspace(-6, 6, 2001)
+    d = distr1d(x, norm.pdf(x))
+    interval = d.dointerval(0.9, kind=kind)[0]
+    ref = [-6, norm.ppf(0.9)] if kind == 'left' else [norm.ppf(0.1), 6]
+    assert np.allclose(interval, ref, atol=1e-4)
+
+
+def test_distr1d_rvs():
+    x = np.linspace(-6, 6, 2001)
+    d = distr1d(x, norm.pdf(x))
+    np.random.seed(10)
+    assert kstest(d.rvs(5000), norm.cdf).pvalue > 0.01